@@ -0,0 +1,123 @@
+import numpy as np
+import pandas as pd
+
+from nonmotorists import classify_injury
+
+AGGREGATE_TABLES = {
+    'CrashDayAreaAgg': ['DateKey', 'LocationAreaKey'],
+    'CrashHourAgg': ['DateKey', 'Hour'],
+    'CrashWeatherAgg': ['DateKey', 'TemperatureBucket', 'PrecipitationBucket']
+}
+""" aggregate tables by their grain, every table is partitioned by DateKey """
+
+PARTITION_COLUMN = 'DateKey'
+""" day partition column of aggregate tables, YYYYMMDD """
+
+AGGREGATE_FACT_COLUMNS = ['ReportNumber', 'VehicleCrashKey', 'DriverAtFault', 'DriverInjurySeverity',
+                          'NonMotoristTotal', 'NonMotoristInjury', 'NonMotoristFatal', 'DateHourKey', 'LocationAreaKey']
+""" VehicleCrashFact columns aggregates are computed from """
+
+AGGREGATE_WEATHER_COLUMNS = ['LocationAreaKey', 'DateHourKey', 'Temperature', 'Precipitation', 'Snow']
+""" WeatherFact columns weather buckets are computed from """
+
+TEMPERATURE_BINS = [-np.inf, 0, 10, 20, 30, np.inf]
+TEMPERATURE_LABELS = ['below 0', '0 to 10', '10 to 20', '20 to 30', 'above 30']
+
+
+def crash_totals(fact):
+    """
+    Aggregate vehicle level fact rows to crash reports.
+
+    Args:
+        fact (DataFrame): VehicleCrashFact rows with AGGREGATE_FACT_COLUMNS
+
+    Returns:
+        DataFrame: one row per report with day, hour, area and driver and non motorist totals
+    """
+    severity = fact['DriverInjurySeverity'].astype(str).map(classify_injury)
+    drivers = fact.assign(InjuredDrivers=severity.isin(['Injury', 'Fatal']).astype(int),
+                          FatalDrivers=(severity == 'Fatal').astype(int),
+                          AtFaultDrivers=fact['DriverAtFault'].astype(bool).astype(int))
+
+    crashes = drivers.groupby('ReportNumber').agg(
+        DateHourKey=pd.NamedAgg('DateHourKey', 'first'),
+        LocationAreaKey=pd.NamedAgg('LocationAreaKey', 'first'),
+        Vehicles=pd.NamedAgg('VehicleCrashKey', 'count'),
+        InjuredDrivers=pd.NamedAgg('InjuredDrivers', 'sum'),
+        FatalDrivers=pd.NamedAgg('FatalDrivers', 'sum'),
+        AtFaultDrivers=pd.NamedAgg('AtFaultDrivers', 'sum'),
+        # non motorist totals are report level, repeated for every vehicle
+        NonMotorists=pd.NamedAgg('NonMotoristTotal', 'first'),
+        NonMotoristInjuries=pd.NamedAgg('NonMotoristInjury', 'first'),
+        NonMotoristFatalities=pd.NamedAgg('NonMotoristFatal', 'first')).reset_index()
+
+    crashes['DateKey'] = crashes['DateHourKey'].astype('int64') // 100
+    crashes['Hour'] = crashes['DateHourKey'].astype('int64') % 100
+    return crashes
+
+
+def summarize(crashes, grain):
+    """ sums crash totals over given grain columns """
+    summary = crashes.groupby(grain).agg(
+        Crashes=pd.NamedAgg('ReportNumber', 'count'),
+        Vehicles=pd.NamedAgg('Vehicles', 'sum'),
+        InjuredDrivers=pd.NamedAgg('InjuredDrivers', 'sum'),
+        FatalDrivers=pd.NamedAgg('FatalDrivers', 'sum'),
+        AtFaultDrivers=pd.NamedAgg('AtFaultDrivers', 'sum'),
+        NonMotorists=pd.NamedAgg('NonMotorists', 'sum'),
+        NonMotoristInjuries=pd.NamedAgg('NonMotoristInjuries', 'sum'),
+        NonMotoristFatalities=pd.NamedAgg('NonMotoristFatalities', 'sum')).reset_index()
+    return summary
+
+
+def precipitation_bucket(precipitation, snow):
+    if pd.isna(precipitation):
+        return 'UNKNOWN'
+    elif snow > 0:
+        return 'snow'
+    elif precipitation == 0:
+        return 'dry'
+    elif precipitation < 2.5:
+        return 'light'
+    else:
+        return 'heavy'
+
+
+def weather_buckets(crashes, weather):
+    """ assigns temperature and precipitation buckets of crash hour and area to crashes """
+    weather = weather[AGGREGATE_WEATHER_COLUMNS]
+    crashes = crashes.merge(weather, on=['LocationAreaKey', 'DateHourKey'], how='left')
+    buckets = pd.cut(crashes['Temperature'], bins=TEMPERATURE_BINS, labels=TEMPERATURE_LABELS, right=False)
+    crashes['TemperatureBucket'] = buckets.astype(str).replace('nan', 'UNKNOWN')
+    crashes['PrecipitationBucket'] = [precipitation_bucket(precipitation, snow) for precipitation, snow
+                                      in zip(crashes['Precipitation'], crashes['Snow'])]
+    return crashes
+
+
+def aggregates_pipeline(fact, weather, history):
+    """
+    Compute aggregate tables for all days present in the fact table.
+
+    Args:
+        fact (DataFrame): VehicleCrashFact rows of the window
+        weather (DataFrame): WeatherFact rows of the window
+        history (DataFrame): previously loaded fact rows of the same days, replaced by rows of the window with
+            the same VehicleCrashKey, empty if nothing was loaded for these days yet
+
+    Returns:
+        tuple: CrashDayAreaAgg, CrashHourAgg and CrashWeatherAgg tables
+    """
+    fact = fact[AGGREGATE_FACT_COLUMNS]
+    if not history.empty:
+        history = history[~history['VehicleCrashKey'].isin(fact['VehicleCrashKey'])]
+        fact = pd.concat([history[AGGREGATE_FACT_COLUMNS], fact], ignore_index=True)
+
+    crashes = crash_totals(fact)
+
+    day_area = summarize(crashes, AGGREGATE_TABLES['CrashDayAreaAgg'])
+
+    hour = summarize(crashes, AGGREGATE_TABLES['CrashHourAgg'])
+    hour['WeekDayNumber'] = pd.to_datetime(hour['DateKey'].astype(str), format='%Y%m%d').dt.weekday
+
+    weather_summary = summarize(weather_buckets(crashes, weather), AGGREGATE_TABLES['CrashWeatherAgg'])
+    return day_area, hour, weather_summary
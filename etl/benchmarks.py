@@ -0,0 +1,227 @@
+import sys
+import tracemalloc
+from contextlib import contextmanager
+from time import perf_counter
+
+import pandas as pd
+
+from utils import soda_montgomery_request, read_soda_json, read_soda_csv, read_fueleconomy_vehicles, \
+    get_soda_client, Static
+from nonmotorists import extract_nonmoto_data
+from weather import extract_weather_data, get_openmeteo_client
+from mock_services import MockServices, synthetic_sources
+from drivers import drivers_pipeline, map_vehicle
+from fuzzy import MAPPER_INDEXES
+from engines import TRANSFORM_ENGINES
+from config import Config
+
+MATCHING_MODES = {
+    'difflib': {'FUZZY_INDEX': False},
+    'trigram compatible': {'FUZZY_INDEX': True, 'FUZZY_COMPATIBLE': True},
+    'trigram': {'FUZZY_INDEX': True, 'FUZZY_COMPATIBLE': False}
+}
+""" Config settings of compared make and model matching modes """
+
+
+@contextmanager
+def configured(**settings):
+    """ temporarily overrides Config attributes """
+    previous = {name: getattr(Config, name) for name in settings}
+    for name, value in settings.items():
+        setattr(Config, name, value)
+    try:
+        yield
+    finally:
+        for name, value in previous.items():
+            setattr(Config, name, value)
+
+
+def benchmark_vehicle_matching(drivers=None, start_date='2023-12-01 00:00:00', end_date='2023-12-31 23:00:00'):
+    """
+    Compare make and model matching modes on distinct vehicles of driver records.
+
+    Args:
+        drivers (DataFrame): raw driver records, requested from the portal for given window if None
+        start_date (str): window start in "YYYY-MM-DD HH:MM:SS" format
+        end_date (str): window end in "YYYY-MM-DD HH:MM:SS" format
+
+    Returns:
+        DataFrame: seconds of each mode including index build and share of VehicleKeys equal to difflib ones
+    """
+    if drivers is None:
+        drivers = soda_montgomery_request('drivers', start_date, end_date)
+    vehicles = drivers_pipeline(drivers)[['VehicleMake', 'VehicleModel', 'VehicleYear']].drop_duplicates()
+    items = list(vehicles.itertuples(index=False, name=None))
+    print(f'{len(drivers)} driver records, {len(items)} distinct vehicles')
+
+    keys = {}
+    results = []
+    for mode, settings in MATCHING_MODES.items():
+        MAPPER_INDEXES.clear()
+        with configured(**settings):
+            start = perf_counter()
+            keys[mode] = [map_vehicle(*item) for item in items]
+            seconds = perf_counter() - start
+        agreement = sum(key == expected for key, expected in zip(keys[mode], keys['difflib'])) / max(1, len(items))
+        results.append({'Mode': mode, 'Seconds': round(seconds, 3), 'DifflibAgreement': round(agreement, 4)})
+        print(f'{mode}: {seconds:.2f}s, {agreement:.2%} of VehicleKeys equal to difflib')
+    return pd.DataFrame(results)
+
+
+def benchmark_soda_extraction(dataset='drivers', start_date='2023-12-01', end_date='2023-12-31'):
+    """
+    Compare JSON records and streamed CSV export extraction of a portal dataset.
+
+    Args:
+        dataset (str): type of dataset to pull, available options: 'incidents', 'drivers', 'non-motorists'
+        start_date (str): window start in "YYYY-MM-DD" format
+        end_date (str): window end in "YYYY-MM-DD" format
+
+    Returns:
+        DataFrame: seconds, peak traced memory and final frame size of each extraction path
+    """
+    where_clause = f"crash_date_time >= '{start_date}' AND crash_date_time <= '{end_date}'"
+    results = []
+    for mode, read in [('json', read_soda_json), ('csv', read_soda_csv)]:
+        tracemalloc.start()
+        start = perf_counter()
+        data = read(dataset, where_clause)
+        seconds = perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        frame_mb = data.memory_usage(deep=True).sum() / 2 ** 20
+        results.append({'Mode': mode, 'Rows': len(data), 'Seconds': round(seconds, 3),
+                        'PeakMB': round(peak / 2 ** 20, 1), 'FrameMB': round(frame_mb, 1)})
+        print(f'{mode}: {len(data)} rows in {seconds:.2f}s, peak {peak / 2 ** 20:.1f}MB, frame {frame_mb:.1f}MB')
+    return pd.DataFrame(results)
+
+
+ENGINE_STAGES = {
+    'vehicles': 'vehicles',
+    'drivers': 'drivers',
+    'roads': 'incidents',
+    'nonmotorists': 'non-motorists',
+    'crashes': 'incidents'
+}
+""" transform stages compared between engines with the raw dataset they consume """
+
+
+def benchmark_transform_engines(raw=None, start_date='2023-12-01 00:00:00', end_date='2023-12-31 23:00:00',
+                                threads=(1, None)):
+    """
+    Compare pandas and duckdb transform engines on raw datasets, duckdb with given numbers of threads.
+
+    Args:
+        raw (dict): raw frames by dataset name ('incidents', 'drivers', 'non-motorists', 'vehicles'),
+            missing datasets are requested for given window
+        start_date (str): window start in "YYYY-MM-DD HH:MM:SS" format
+        end_date (str): window end in "YYYY-MM-DD HH:MM:SS" format
+        threads (tuple): duckdb thread counts, None uses all cores
+
+    Returns:
+        DataFrame: seconds of every stage and engine and if output is identical to pandas output
+    """
+    raw = {} if raw is None else dict(raw)
+    for dataset in set(ENGINE_STAGES.values()) - set(raw):
+        if dataset == 'vehicles':
+            raw[dataset] = read_fueleconomy_vehicles()
+        else:
+            raw[dataset] = soda_montgomery_request(dataset, start_date, end_date)
+
+    modes = [('pandas', 'pandas', None)] + [(f'duckdb threads={count or "all"}', 'duckdb', count) for count in threads]
+    results = []
+    outputs = {}
+    for stage, dataset in list(ENGINE_STAGES.items()) + [('fact_join', None)]:
+        for mode, engine, count in modes:
+            if stage == 'fact_join':
+                arguments = [outputs['drivers'], outputs['crashes']]
+            else:
+                arguments = [raw[dataset].copy()]
+            with configured(ENGINE_THREADS=count):
+                start = perf_counter()
+                output = TRANSFORM_ENGINES[engine][stage](*arguments)
+                seconds = perf_counter() - start
+            if engine == 'pandas':
+                outputs[stage] = output
+            identical = output.equals(outputs[stage]) and output.dtypes.equals(outputs[stage].dtypes)
+            results.append({'Stage': stage, 'Engine': mode, 'Rows': len(output), 'Seconds': round(seconds, 3),
+                            'Identical': identical})
+            print(f'{stage} {mode}: {seconds:.2f}s, {"identical" if identical else "DIFFERENT"} output')
+    return pd.DataFrame(results)
+
+
+@contextmanager
+def mocked_sources(services):
+    """ redirects extraction to running mock services, without http cache and weather store """
+    with configured(WEATHER_STORE=False, **services.settings()):
+        get_soda_client.cache_clear()
+        try:
+            with get_openmeteo_client().session.cache_disabled():
+                yield services
+        finally:
+            get_soda_client.cache_clear()
+
+
+def benchmark_extraction(services=None, start_date='2023-12-01', end_date='2023-12-31', profiles=None):
+    """
+    Run extraction of every source against local mock services and measure its throughput and requests.
+
+    Args:
+        services (MockServices): mock services with recorded or synthetic data, synthetic data
+            of the window are served if None
+        start_date (str): window start in "YYYY-MM-DD" format
+        end_date (str): window end in "YYYY-MM-DD" format
+        profiles (dict): NetworkProfile by source of created mock services
+
+    Returns:
+        DataFrame: rows, seconds, throughput, requests, injected failures, retries and errors of every extraction
+    """
+    if services is None:
+        services = MockServices(*synthetic_sources(start_date, end_date), profiles=profiles)
+    extractions = [(f'soda {dataset} {mode}', 'soda', {'SODA_CSV_EXPORT': mode == 'csv'},
+                    lambda dataset=dataset: soda_montgomery_request(dataset, start_date, end_date))
+                   for dataset in ['incidents', 'drivers', 'non-motorists'] for mode in ['json', 'csv']]
+    extractions += [
+        ('soda non-motorists aggregated', 'soda', {},
+         lambda: extract_nonmoto_data(soda_montgomery_request, start_date, end_date, aggregate=True)),
+        ('fueleconomy vehicles', 'fueleconomy', {}, read_fueleconomy_vehicles),
+        ('openmeteo weather', 'openmeteo', {},
+         lambda: extract_weather_data(Static.ZIPCODE_GEOMETRY, start_date, end_date))
+    ]
+
+    services.start()
+    results = []
+    try:
+        with mocked_sources(services):
+            for name, source, settings, extract in extractions:
+                services.reset_stats()
+                error = None
+                rows = 0
+                with configured(**settings):
+                    start = perf_counter()
+                    try:
+                        rows = len(extract())
+                    except (Exception, ) as e:
+                        error = str(e)
+                    seconds = perf_counter() - start
+                stats = services.source_stats(source)
+                results.append({'Extraction': name, 'Rows': rows, 'Seconds': round(seconds, 3),
+                                'RowsPerSecond': round(rows / max(seconds, 1e-9)),
+                                'MBPerSecond': round(stats['Bytes'] / 2 ** 20 / max(seconds, 1e-9), 2),
+                                **stats, 'Error': error})
+                print(f"{name}: {rows} rows in {seconds:.2f}s, {stats['Requests']} requests, "
+                      f"{stats['Failures']} failed, {stats['Retries']} retries" + (f', ERROR {error}' if error else ''))
+    finally:
+        services.stop()
+    return pd.DataFrame(results)
+
+
+if __name__ == "__main__":
+    # optional argument is CSV export of raw driver records, a month is requested from the portal otherwise
+    raw_drivers = pd.read_csv(sys.argv[1], low_memory=False) if len(sys.argv) > 1 else None
+    print(benchmark_vehicle_matching(raw_drivers))
+    if raw_drivers is None:
+        print(benchmark_soda_extraction())
+        print(benchmark_transform_engines())
+    # offline against local mock services
+    print(benchmark_extraction())
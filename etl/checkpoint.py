@@ -0,0 +1,106 @@
+import hashlib
+import json
+import os
+import re
+import shutil
+import threading
+from glob import glob
+
+import pandas as pd
+import pyarrow as pa
+
+from config import Config
+
+FINGERPRINT_FILES = ['static/car_makes.txt', 'static/area_mapper.csv', 'static/ZIPCODES.csv']
+""" mapper files affecting outputs, car_models.csv is excluded as it is updated by the run itself """
+
+
+def code_fingerprint():
+    """ returns short hash of ETL modules, static mappers and configuration affecting transformations """
+    digest = hashlib.sha1()
+    module_dir = os.path.dirname(os.path.abspath(__file__))
+    modules = [path for path in sorted(glob(os.path.join(module_dir, '*.py'))) if not path.endswith('tests.py')]
+    for path in modules + FINGERPRINT_FILES:
+        with open(path, 'rb') as f:
+            digest.update(f.read())
+    digest.update(f"initialization={Config.DWH_INITIALIZATION}".encode())
+    return digest.hexdigest()[:12]
+
+
+class RunCheckpoint:
+    """
+    Stores outputs of finished phases and names of loaded tables of a single ETL run in a local run directory
+    keyed by window and code fingerprint, so a failed run can be resumed.
+    """
+
+    def __init__(self, start_date, end_date, directory=None, variant=None):
+        """
+        Args:
+            start_date (str): start of the window
+            end_date (str): end of the window
+            directory (str): checkpoints directory, defaults to Config.CHECKPOINT_DIR
+            variant (str): suffix separating runs of the same window with different outputs, e.g. sampled runs
+        """
+        directory = Config.CHECKPOINT_DIR if directory is None else directory
+        window = f"{re.sub(r'[^0-9]', '', start_date)[:10]}-{re.sub(r'[^0-9]', '', end_date)[:10]}"
+        run = f"{window}-{code_fingerprint()}" if variant is None else f"{window}-{code_fingerprint()}-{variant}"
+        self.directory = os.path.join(directory, run)
+        self.manifest_path = os.path.join(self.directory, 'manifest.json')
+        self.manifest = {'phases': [], 'loaded_tables': []}
+        # tables are marked from concurrent loader threads
+        self.lock = threading.Lock()
+        if os.path.isfile(self.manifest_path):
+            with open(self.manifest_path) as f:
+                self.manifest = json.load(f)
+
+    def _save_manifest(self):
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self.manifest_path, 'w') as f:
+            json.dump(self.manifest, f)
+
+    def completed_phases(self):
+        return list(self.manifest['phases'])
+
+    def save_phase(self, phase, frames):
+        """
+        Save outputs of a finished phase.
+
+        Args:
+            phase (str): phase name
+            frames (dict): mapping of output name to DataFrame
+        """
+        phase_dir = os.path.join(self.directory, phase)
+        os.makedirs(phase_dir, exist_ok=True)
+        for name, frame in frames.items():
+            try:
+                frame.to_parquet(os.path.join(phase_dir, f"{name}.parquet"), index=False,
+                                 compression=Config.OUTPUT_COMPRESSION)
+            except (pa.ArrowException, ) as e:
+                # columns with mixed python types cannot be stored in parquet
+                print(f"{name}: checkpoint saved as pickle,", e)
+                frame.to_pickle(os.path.join(phase_dir, f"{name}.pkl"))
+        self.manifest['phases'].append(phase)
+        self._save_manifest()
+        print(f"Checkpoint of {phase} phase saved to {phase_dir}")
+
+    def load_phase(self, phase):
+        """ returns mapping of output name to DataFrame saved for given phase """
+        frames = {}
+        for path in sorted(glob(os.path.join(self.directory, phase, '*'))):
+            name, extension = os.path.splitext(os.path.basename(path))
+            frames[name] = pd.read_parquet(path) if extension == '.parquet' else pd.read_pickle(path)
+        return frames
+
+    def is_loaded(self, table_name):
+        return table_name in self.manifest['loaded_tables']
+
+    def mark_loaded(self, table_name):
+        with self.lock:
+            self.manifest['loaded_tables'].append(table_name)
+            self._save_manifest()
+
+    def clear(self):
+        """ removes run directory, e.g. after successful run or before a fresh attempt """
+        if os.path.isdir(self.directory):
+            shutil.rmtree(self.directory)
+        self.manifest = {'phases': [], 'loaded_tables': []}
@@ -13,6 +13,135 @@ class Config:
     DEBUG = False
     """ if output files are saved locally """
 
+    OUTPUT_DIR = 'out'
+    """ directory for output files saved in debug mode """
+
+    OUTPUT_FORMAT = 'parquet'
+    """ format of output files, available options: 'parquet', 'csv' """
+
+    OUTPUT_PARTITIONED = True
+    """ if parquet outputs with DateHourKey are partitioned by year and month """
+
+    OUTPUT_COMPRESSION = 'zstd'
+    """ compression codec of parquet outputs """
+
+    OUTPUT_APPEND = False
+    """ if new windows are appended to existing outputs instead of overwriting them """
+
+    STAGE_WORKERS = 1
+    """ number of processes running independent transformation stages, 1 runs stages serially """
+
+    TRANSFORM_ENGINE = 'pandas'
+    """ engine of transformations and fact join, available options: 'pandas', 'duckdb' (multi-core, optional) """
+
+    ENGINE_THREADS = None
+    """ number of threads of the duckdb transform engine, all cores if None """
+
+    MAPPING_WORKERS = 1
+    """ number of processes mapping distinct vehicles, roads and locations in shards, 1 maps serially """
+
+    MAPPING_SERIAL_BELOW = 2000
+    """ number of distinct mapped items below which mapping runs serially, as starting workers costs more """
+
+    MAPPING_START_METHOD = 'spawn'
+    """ start method of mapping worker processes, 'spawn' or 'forkserver' as runs fork while loader threads run """
+
+    MEMORY_BUDGET_MB = None
+    """ megabytes of tables held by a run above which completed tables are spilled to disk, unlimited if None """
+
+    SPILL_DIR = 'store/spill'
+    """ directory of tables spilled by runs exceeding memory budget """
+
+    FUZZY_INDEX = True
+    """ if makes and models are matched with trigram index of mappers instead of linear difflib scan """
+
+    FUZZY_COMPATIBLE = True
+    """ if trigram index returns the same matches as difflib, otherwise only choices sharing a trigram are scored """
+
+    PIPELINED_LOAD = False
+    """ if tables are loaded in background as soon as they are final, while remaining stages are computed """
+
+    LOAD_WORKERS = 4
+    """ maximal number of tables loaded concurrently, each on its own dwh connection """
+
+    LOAD_QUARANTINE = True
+    """ if tables are loaded in separately committed batches, rows rejected by dwh are isolated and quarantined """
+
+    LOAD_BATCH_SIZE = 10000
+    """ rows per committed batch of quarantined loads, failed batches are bisected down to single rows """
+
+    QUARANTINE_DIR = 'store/quarantine'
+    """ directory of csv files with rows rejected by dwh and their errors, one file per table """
+
+    QUARANTINE_MAX_ROWS = 100
+    """ rejected rows of a table above which its load fails """
+
+    CHECKPOINTS = False
+    """ if outputs of every phase are saved locally so a failed run can be resumed, costs a write of every phase """
+
+    CHECKPOINT_DIR = 'store/checkpoints'
+    """ directory of run checkpoints """
+
+    SAMPLE_FRACTION = None
+    """ fraction of reports kept for development runs saved to output sink, selected by report hash, None keeps all """
+
+    AGGREGATES = False
+    """ if daily aggregate tables for reporting are computed and loaded with facts, SQL Server needs DWH_MIGRATE """
+
+    STRICT_INTEGRITY = False
+    """ if load is aborted when fact table contains foreign keys missing from dimensions """
+
+    INCREMENTAL_EXTRACT = False
+    """ if regular updates extract crash reports changed on the portal since Metadata watermarks, not planned windows """
+
+    ADAPTIVE_WINDOWS = True
+    """ if windows of regular updates and backfills are sized from portal row counts instead of whole months """
+
+    WINDOW_TARGET_ROWS = 200000
+    """ target number of crash, driver and hourly weather rows extracted in a single window """
+
+    WINDOW_MAX_MONTHS = 12
+    """ maximal number of months merged into a single window """
+
+    MICRO_BATCH_HOURS = None
+    """ hours of regular update windows in micro-batch mode, e.g. 1 or 24, used instead of incremental extraction """
+
+    WEATHER_ARCHIVE_LAG_DAYS = 5
+    """ days Open-Meteo takes to archive weather, extracted again before micro-batch windows and never http cached """
+
+    FUELECONOMY_REFRESH_HOURS = 24
+    """ hours a downloaded fueleconomy file is reused by runs sharing a source cache, e.g. micro-batches """
+
+    WATERMARK_LAG_HOURS = 24
+    """ hours subtracted from last update time when Metadata has no watermark yet, covers portal timezone offset """
+
+    WEATHER_STORE = True
+    """ if extracted weather is kept in local store and only missing days are requested """
+
+    WEATHER_STORE_DIR = 'store/weather'
+    """ directory of local weather store """
+
+    WEATHER_GRID_RESOLUTION = 0.1
+    """ degrees between Open-Meteo archive grid points, areas snapped to the same cell share one request, None disables """
+
+    SODA_CSV_EXPORT = False
+    """ if portal rows are streamed from CSV export instead of JSON records, exports without ':updated_at' fall back """
+
+    SODA_AGGREGATE_NONMOTORISTS = True
+    """ if non-motorist totals per report are aggregated by the portal, so only one row per report is downloaded """
+
+    SODA_DOMAIN = 'data.montgomerycountymd.gov'
+    """ montgomery data portal domain, can point to a local mock portal e.g. '127.0.0.1:8080' """
+
+    SODA_URI_PREFIX = 'https://'
+    """ scheme of montgomery data portal requests """
+
+    FUELECONOMY_URL = 'https://www.fueleconomy.gov/feg/epadata/vehicles.csv'
+    """ url of fueleconomy vehicles file """
+
+    OPENMETEO_ARCHIVE_URL = 'https://archive-api.open-meteo.com/v1/archive'
+    """ url of Open-Meteo historical weather archive """
+
     N_RETRIES = 3
     """ number of retries for query to soda """
 
@@ -39,3 +168,24 @@ class Config:
 
     DWH_PASSWORD = os.getenv("DWH_PASSWORD")
     """ SQL Server user password """
+
+    DWH_BACKEND = os.getenv("DWH_BACKEND", default='sqlserver')
+    """ data warehouse backend, available options: 'sqlserver', 'sqlite', 'duckdb' (embedded, no server needed) """
+
+    DWH_PATH = os.getenv("DWH_PATH", default='store/vehicle_crashes_dwh.db')
+    """ database file of embedded data warehouse backends """
+
+    DWH_MIGRATE = True
+    """ if columns and tables missing from SQL Server dwh, e.g. RowHash or aggregates, are added before loading """
+
+    FACT_UPSERT = True
+    """ if VehicleCrashFact rows corrected on the portal are updated by RowHash, otherwise stored rows are kept """
+
+    SERVICE_HOST = '127.0.0.1'
+    """ address of service mode control interface, local only by default """
+
+    SERVICE_PORT = 8765
+    """ port of service mode control interface """
+
+    SERVICE_INTERVAL_HOURS = 24
+    """ hours between scheduled regular updates in service mode, 0 runs updates only on demand """
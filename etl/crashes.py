@@ -5,34 +5,49 @@ from shapely.geometry import Point
 
 from roads import generate_roaddim_key
 from utils import Static
+from sharding import map_distinct
 from config import Config
 
 
+CRASH_RAW_COLUMNS = ['report_number', 'local_case_number', 'agency_name', 'acrs_report_type', 'crash_date_time',
+                     'hit_run', 'route_type', 'lane_direction', 'lane_number',
+                     'number_of_lanes', 'road_grade', 'nontraffic', 'road_name', 'cross_street_type',
+                     'cross_street_name', 'off_road_description',
+                     'at_fault', 'collision_type', 'surface_condition', 'light', 'traffic_control', 'junction',
+                     'intersection_type',
+                     'road_alignment', 'road_condition', 'road_division', 'latitude', 'longitude']
+""" portal incidents columns kept for crash data """
+
+CRASH_COLUMNS = ['ReportNumber', 'LocalCaseNumber', 'AgencyName', 'ACRSReportType', 'Datetime', 'HitRun',
+                 'RouteType', 'LaneDirection', 'LaneNumber',
+                 'NumberOfLanes', 'RoadGrade', 'NonTraffic', 'RoadName', 'CrossStreetType', 'CrossStreetName',
+                 'OffRoadIncident',
+                 'AccidentAtFault', 'CollisionType', 'SurfaceCondition', 'Light', 'TrafficControl', 'Junction',
+                 'IntersectionType',
+                 'RoadAlignment', 'RoadCondition', 'RoadDivision', 'Latitude', 'Longitude']
+""" names of kept columns """
+
+CRASH_NUMERIC_COLUMNS = ['LaneNumber', 'NumberOfLanes', 'Latitude', 'Longitude']
+""" columns converted to numbers """
+
+CRASH_UNKNOWN_COLUMNS = ['AgencyName', 'ACRSReportType', 'RouteType', 'LaneDirection', 'RoadGrade', 'RoadName',
+                         'CrossStreetType', 'CrossStreetName', 'AccidentAtFault',
+                         'CollisionType', 'SurfaceCondition', 'Light', 'TrafficControl', 'Junction',
+                         'IntersectionType', 'RoadAlignment', 'RoadCondition', 'RoadDivision']
+""" str columns with missing values changed to UNKNOWN """
+
+
 def filter_columns(data):
     """ keeps only necessary columns with changed names and format """
     # keep columns
-    data = data[['report_number', 'local_case_number', 'agency_name', 'acrs_report_type', 'crash_date_time', 'hit_run',
-                 'route_type', 'lane_direction', 'lane_number',
-                 'number_of_lanes', 'road_grade', 'nontraffic', 'road_name', 'cross_street_type', 'cross_street_name',
-                 'off_road_description',
-                 'at_fault', 'collision_type', 'surface_condition', 'light', 'traffic_control', 'junction',
-                 'intersection_type',
-                 'road_alignment', 'road_condition', 'road_division', 'latitude', 'longitude']]
+    data = data[CRASH_RAW_COLUMNS]
 
     # change names
-    data.columns = ['ReportNumber', 'LocalCaseNumber', 'AgencyName', 'ACRSReportType', 'Datetime', 'HitRun',
-                    'RouteType', 'LaneDirection', 'LaneNumber',
-                    'NumberOfLanes', 'RoadGrade', 'NonTraffic', 'RoadName', 'CrossStreetType', 'CrossStreetName',
-                    'OffRoadIncident',
-                    'AccidentAtFault', 'CollisionType', 'SurfaceCondition', 'Light', 'TrafficControl', 'Junction',
-                    'IntersectionType',
-                    'RoadAlignment', 'RoadCondition', 'RoadDivision', 'Latitude', 'Longitude']
+    data.columns = CRASH_COLUMNS
     # change format
     data = data.astype(str)
-    data['LaneNumber'] = pd.to_numeric(data['LaneNumber'])
-    data['NumberOfLanes'] = pd.to_numeric(data['NumberOfLanes'])
-    data['Latitude'] = pd.to_numeric(data['Latitude'])
-    data['Longitude'] = pd.to_numeric(data['Longitude'])
+    for col in CRASH_NUMERIC_COLUMNS:
+        data[col] = pd.to_numeric(data[col])
     return data
 
 
@@ -41,16 +56,10 @@ def change_to_unknown(string):
 
 
 def handle_nans(data):
-    data = data.copy()
-    #
     data['LaneNumber'] = data['LaneNumber'].fillna(0)
     data['NumberOfLanes'] = data['NumberOfLanes'].fillna(0)
     # str columns changed to unknown
-    columns_to_unknown = ['AgencyName', 'ACRSReportType', 'RouteType', 'LaneDirection', 'RoadGrade', 'RoadName',
-                          'CrossStreetType', 'CrossStreetName', 'AccidentAtFault',
-                          'CollisionType', 'SurfaceCondition', 'Light', 'TrafficControl', 'Junction',
-                          'IntersectionType', 'RoadAlignment', 'RoadCondition', 'RoadDivision']
-    for col in columns_to_unknown:
+    for col in CRASH_UNKNOWN_COLUMNS:
         data[col] = data[col].apply(change_to_unknown)
     # Datetime, HitRun, NonTraffic, OffRoadIncident handled in transform
     return data
@@ -65,7 +74,6 @@ def map_to_datetime(date_str):
 
 
 def transform_columns(data):
-    data = data.copy()
     # nothing to clean 'ReportNumber', 'LocalCaseNumber', 'AgencyName'
     # clean acrs report type
     data['ACRSReportType'] = data['ACRSReportType'].apply(lambda x: x.replace("Crash", ""))
@@ -101,12 +109,16 @@ def map_location(lat, long, gdf):
     return int(area_key)
 
 
+def map_area(lat, long):
+    """ maps crash coordinates to LocationAreaKey using Static area mapper """
+    return map_location(lat, long, Static.AREA_MAPPER)
+
+
 def mapping_pipeline(crashes, nonmoto_agg):
     # Add RoadKey and CrossStreetKey
-    crashes_joined = crashes.copy()
-    crashes_joined['RoadKey'] = crashes.apply(lambda x: generate_roaddim_key(x.RoadName, x.RouteType), axis=1)
-    crashes_joined['CrossStreetKey'] = crashes.apply(
-        lambda x: generate_roaddim_key(x.CrossStreetName, x.CrossStreetType), axis=1)
+    crashes_joined = map_distinct(crashes, ['RoadName', 'RouteType'], generate_roaddim_key, 'RoadKey')
+    crashes_joined = map_distinct(crashes_joined, ['CrossStreetName', 'CrossStreetType'], generate_roaddim_key,
+                                  'CrossStreetKey')
     crashes_joined.drop(['RoadName', 'RouteType', 'CrossStreetName', 'CrossStreetType'], axis=1, inplace=True)
 
     # Add non motorists aggregated measures
@@ -119,7 +131,12 @@ def mapping_pipeline(crashes, nonmoto_agg):
     crashes_nonmoto.drop('Datetime', inplace=True, axis=1)
 
     # Add LocationAreaKey
-    crashes_nonmoto['LocationAreaKey'] = crashes_nonmoto.apply(
-        lambda x: map_location(x.Latitude, x.Longitude, Static.AREA_MAPPER), axis=1)
+    crashes_nonmoto = map_distinct(crashes_nonmoto, ['Latitude', 'Longitude'], map_area, 'LocationAreaKey',
+                                   mappers=['AREA_MAPPER'])
 
     return crashes_nonmoto
+
+
+def join_vehicle_crashes(drivers, crashes):
+    """ joins mapped drivers data with mapped crashes data into vehicle crash facts """
+    return drivers.merge(crashes, on='ReportNumber')
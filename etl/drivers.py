@@ -5,6 +5,9 @@ import pandas as pd
 
 from utils import Static
 from vehicles import generate_vehicle_key
+from sharding import map_distinct
+from fuzzy import MAPPER_INDEXES
+from config import Config
 
 
 def change_to_unknown(string):
@@ -44,17 +47,29 @@ def map_vehicle_type(vehicle):
         return 'OTHER'
 
 
+DRIVER_RAW_COLUMNS = ['report_number', 'vehicle_id', 'driver_at_fault', 'injury_severity', 'driver_substance_abuse',
+                      'driver_distracted_by', 'vehicle_body_type', 'vehicle_movement',
+                      'vehicle_going_dir', 'vehicle_damage_extent', 'speed_limit', 'parked_vehicle', 'vehicle_year',
+                      'vehicle_make', 'vehicle_model']
+""" portal drivers columns kept for drivers data """
+
+DRIVER_COLUMNS = ['ReportNumber', 'VehicleCrashKey', 'DriverAtFault', 'DriverInjurySeverity', 'DriverSubstanceAbuse',
+                  'DriverDistractedBy', 'VehicleType', 'VehicleMovement',
+                  'VehicleGoingDir', 'VehicleDamageExtent', 'SpeedLimit', 'ParkedVehicle', 'VehicleYear',
+                  'VehicleMake', 'VehicleModel']
+""" names of kept columns """
+
+DRIVER_UNKNOWN_COLUMNS = ['DriverSubstanceAbuse', 'DriverDistractedBy', 'VehicleType', 'VehicleMovement',
+                          'VehicleGoingDir',
+                          'VehicleDamageExtent', 'VehicleMake', 'VehicleModel']
+""" str columns with missing values changed to UNKNOWN """
+
+
 def prepare_data(data):
     """ selects columns, renames them and changes types """
-    data = data[['report_number', 'vehicle_id', 'driver_at_fault', 'injury_severity', 'driver_substance_abuse',
-                 'driver_distracted_by', 'vehicle_body_type', 'vehicle_movement',
-                 'vehicle_going_dir', 'vehicle_damage_extent', 'speed_limit', 'parked_vehicle', 'vehicle_year',
-                 'vehicle_make', 'vehicle_model']]
-
-    data.columns = ['ReportNumber', 'VehicleCrashKey', 'DriverAtFault', 'DriverInjurySeverity', 'DriverSubstanceAbuse',
-                    'DriverDistractedBy', 'VehicleType', 'VehicleMovement',
-                    'VehicleGoingDir', 'VehicleDamageExtent', 'SpeedLimit', 'ParkedVehicle', 'VehicleYear',
-                    'VehicleMake', 'VehicleModel']
+    data = data[DRIVER_RAW_COLUMNS]
+
+    data.columns = DRIVER_COLUMNS
     data = data.astype(str)
     data['VehicleYear'] = data['VehicleYear'].astype(int)
     return data
@@ -62,21 +77,16 @@ def prepare_data(data):
 
 def handle_nans(data):
     """ handles na values """
-    data = data.copy()
     data['SpeedLimit'] = data['SpeedLimit'].fillna(0)
     data['VehicleYear'] = data['VehicleYear'].fillna(0)
     # str columns changed to unknown
-    columns_to_unknown = ['DriverSubstanceAbuse', 'DriverDistractedBy', 'VehicleType', 'VehicleMovement',
-                          'VehicleGoingDir',
-                          'VehicleDamageExtent', 'VehicleMake', 'VehicleModel']
-    for col in columns_to_unknown:
+    for col in DRIVER_UNKNOWN_COLUMNS:
         data[col] = data[col].apply(change_to_unknown)
     return data
 
 
 def transform_columns(data):
     """ performs neccessary transformations """
-    data = data.copy()
     # clean primary key
     data['VehicleCrashKey'] = data['VehicleCrashKey'].apply(lambda x: x.replace('-', ''))
     # boolean if driver at fault
@@ -114,6 +124,10 @@ def map_makes(make):
     except KeyError:
         new_make = 'No match found'
 
+    if new_make == 'No match found' and Config.FUZZY_INDEX:
+        found_make = MAPPER_INDEXES.brands().match(make, cutoff=0.5)
+        return 'Unknown' if found_make is None else found_make
+
     if new_make == 'No match found':
         makes_lower = [m.lower() for m in list(Static.BRANDS_DICT.values())]
         found_makes = get_close_matches(make.lower(), makes_lower, n=1, cutoff=0.5)
@@ -128,13 +142,21 @@ def map_makes(make):
     return new_make
 
 
-def map_models(model, make, year):
-    """ maps crash data models to fueleconomy car models """
+def map_models(model, make, year, models_dict=None):
+    """ maps crash data models to fueleconomy car models, models_dict replaces Static.MODELS_DICT """
+    models_dict = Static.MODELS_DICT if models_dict is None else models_dict
     if model.lower() in ['4s', 'tk']:
         return 'Unknown'
 
+    if Config.FUZZY_INDEX:
+        try:
+            found_model = MAPPER_INDEXES.models(year, make, models_dict).match(model, cutoff=0.2)
+        except KeyError:
+            return 'Unknown'
+        return 'Unknown' if found_model is None else found_model
+
     try:
-        models_raw = list(set(Static.MODELS_DICT[(year, make)]))
+        models_raw = list(set(models_dict[(year, make)]))
         models_lower = [m.lower() for m in models_raw]
         found_models_lower = get_close_matches(model.lower(), models_lower, n=1, cutoff=0.2)
     except KeyError:
@@ -155,11 +177,21 @@ def map_year(year, model):
         return year
 
 
-def drivers_mapping_pipeline(data):
-    data = data.copy()
-    data['MappedMake'] = data['VehicleMake'].apply(map_makes)
-    data['MappedModel'] = data.apply(lambda x: map_models(x.VehicleModel, x.MappedMake, x.VehicleYear), axis=1)
-    data['MappedYear'] = data.apply(lambda x: map_year(x.VehicleYear, x.MappedModel), axis=1)
-    data['VehicleKey'] = data.apply(lambda x: generate_vehicle_key(x.MappedMake, x.MappedModel, x.MappedYear), axis=1)
-    data = data.drop(['VehicleYear', 'VehicleMake', 'VehicleModel', 'MappedMake', 'MappedModel', 'MappedYear'], axis=1)
+def map_vehicle(make, model, year, models_dict=None):
+    """ maps crash data vehicle to VehicleKey of fueleconomy vehicle """
+    mapped_make = map_makes(make)
+    mapped_model = map_models(model, mapped_make, year, models_dict)
+    mapped_year = map_year(year, mapped_model)
+    return generate_vehicle_key(mapped_make, mapped_model, mapped_year)
+
+
+def drivers_mapping_pipeline(data, models_dict=None):
+    """
+    maps vehicles to VehicleKey, models_dict replaces Static.MODELS_DICT, it is passed to the mapping
+    and to worker processes without changing Static
+    """
+    kwargs = None if models_dict is None else {'models_dict': models_dict}
+    data = map_distinct(data, ['VehicleMake', 'VehicleModel', 'VehicleYear'], map_vehicle, 'VehicleKey',
+                        mappers=['BRANDS_DICT'], kwargs=kwargs)
+    data = data.drop(['VehicleYear', 'VehicleMake', 'VehicleModel'], axis=1)
     return data
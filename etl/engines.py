@@ -0,0 +1,291 @@
+import importlib.util
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from crashes import crashes_pipeline, map_to_datetime, join_vehicle_crashes, CRASH_RAW_COLUMNS, CRASH_COLUMNS, \
+    CRASH_NUMERIC_COLUMNS, CRASH_UNKNOWN_COLUMNS
+from drivers import drivers_pipeline, DRIVER_RAW_COLUMNS, DRIVER_COLUMNS, DRIVER_UNKNOWN_COLUMNS
+from roads import road_pipeline, generate_roaddim_key
+from nonmotorists import nonmoto_pipeline, is_aggregated
+from vehicles import vehicles_pipeline, prepare_vehicles_data, handle_nans_vehicles, generate_blank_models, \
+    generate_vehicle_key
+from config import Config
+
+VEHICLE_MODE_COLUMNS = ['BodyClass', 'Cylinders', 'Displacement', 'Transmission', 'Drivetrain', 'FuelType',
+                        'CityMPG', 'HighwayMPG']
+""" vehicle columns aggregated by the most frequent value of every base model """
+
+
+def connect(threads=None):
+    """ returns in-memory duckdb connection, threads default to Config.ENGINE_THREADS, all cores if None """
+    import duckdb
+
+    conn = duckdb.connect()
+    threads = Config.ENGINE_THREADS if threads is None else threads
+    if threads:
+        conn.execute(f"SET threads = {int(threads)}")
+    return conn
+
+
+def run_query(query, **frames):
+    """ runs query on given frames registered under their argument names, returns result DataFrame """
+    conn = connect()
+    try:
+        for name, frame in frames.items():
+            conn.register(name, frame)
+        return conn.sql(query).df()
+    finally:
+        conn.close()
+
+
+def text_frame(data, columns):
+    """
+    returns given raw columns prepared for text expressions, columns which are not object are converted
+    with astype(str) beforehand and None is replaced by 'None' as astype(str) does, only NaN becomes 'nan'
+    """
+    data = data[columns]
+    converted = {}
+    for col in columns:
+        if data[col].dtype != object:
+            converted[col] = data[col].astype(str)
+            continue
+        missing = data[col].isna().values
+        if missing.any():
+            values = data[col].values.copy()
+            nones = np.flatnonzero(missing)[values[missing] == None]  # noqa: E711, elementwise comparison
+            if len(nones):
+                values[nones] = 'None'
+                converted[col] = values
+    return data.assign(**converted) if converted else data
+
+
+def text(column):
+    """ SQL expression of raw column as converted with astype(str), missing values become 'nan' """
+    return f"""coalesce(CAST("{column}" AS VARCHAR), 'nan')"""
+
+
+def unknown(expression, nan_case_sensitive=False):
+    """ SQL expression of change_to_unknown, roads compare 'nan' case sensitively """
+    nan = f"{expression} = 'nan'" if nan_case_sensitive else f"lower({expression}) = 'nan'"
+    return (f"CASE WHEN lower({expression}) IN ('unknown', 'n/a') OR {nan} OR {expression} = '' "
+            f"THEN 'UNKNOWN' ELSE {expression} END")
+
+
+def contains_any(expression, words):
+    return "(" + " OR ".join(f"contains({expression}, '{word}')" for word in words) + ")"
+
+
+def crashes_engine_pipeline(crashes_raw):
+    """ duckdb version of crashes_pipeline, output is identical """
+    if crashes_raw.empty:
+        return crashes_pipeline(crashes_raw)
+
+    expressions = []
+    for raw_col, col in zip(CRASH_RAW_COLUMNS, CRASH_COLUMNS):
+        expression = text(raw_col)
+        if col in CRASH_UNKNOWN_COLUMNS:
+            expression = unknown(expression)
+        if col == 'ACRSReportType':
+            expression = f"replace({expression}, 'Crash', '')"
+        elif col == 'Datetime':
+            expression = f"try_strptime({expression}, '%Y-%m-%dT%H:%M:%S.%f')"
+        elif col in ['HitRun', 'NonTraffic']:
+            expression = f"{expression} = 'Yes'"
+        elif col == 'OffRoadIncident':
+            expression = f"{expression} NOT IN ('nan', '')"
+        expressions.append(f'{expression} AS "{col}"')
+
+    data = run_query(f"SELECT {', '.join(expressions)} FROM raw",
+                     raw=text_frame(crashes_raw, CRASH_RAW_COLUMNS))
+    data.index = crashes_raw.index
+
+    # numbers are parsed like pandas, so integer columns keep integer type
+    for col in CRASH_NUMERIC_COLUMNS:
+        data[col] = pd.to_numeric(data[col])
+    data['LaneNumber'] = data['LaneNumber'].fillna(0)
+    data['NumberOfLanes'] = data['NumberOfLanes'].fillna(0)
+    if data['Datetime'].isna().any():
+        # unparsed dates are kept as empty strings like the pandas path does
+        data['Datetime'] = crashes_raw['crash_date_time'].astype(str).apply(map_to_datetime)
+    else:
+        data['Datetime'] = data['Datetime'].astype('datetime64[ns]')
+    return data
+
+
+def drivers_engine_pipeline(raw_data):
+    """ duckdb version of drivers_pipeline, output is identical """
+    if raw_data.empty:
+        return drivers_pipeline(raw_data)
+
+    columns = {}
+    for raw_col, col in zip(DRIVER_RAW_COLUMNS, DRIVER_COLUMNS):
+        columns[col] = unknown(text(raw_col)) if col in DRIVER_UNKNOWN_COLUMNS else text(raw_col)
+
+    substance = columns['DriverSubstanceAbuse']
+    cleaned = (f"regexp_replace(replace(replace(replace(lower({substance}), 'present', ''), 'contributed', ''), "
+               f"'detected', ''), '^\\s+|\\s+$', '', 'g')")
+    vehicle = f"lower({columns['VehicleType']})"
+    vehicle_type = f"""CASE
+        WHEN {contains_any(vehicle, ['passenger', 'utility', 'pickup', 'van', 'wagon', 'limousine'])}
+            AND NOT contains({vehicle}, 'over') THEN 'PASSENGER'
+        WHEN contains({vehicle}, 'emergency') THEN 'EMERGENCY'
+        WHEN {contains_any(vehicle, ['motorcycle', 'moped'])} THEN 'MOTORCYCLE'
+        WHEN contains({vehicle}, 'bus') THEN 'BUS'
+        WHEN contains({vehicle}, 'truck') THEN 'TRUCK'
+        WHEN contains({vehicle}, 'unknown') THEN 'UNKNOWN'
+        ELSE 'OTHER' END"""
+
+    columns['SubstanceAbuseContributed'] = f"contains(lower({substance}), 'contributed')"
+    columns['VehicleCrashKey'] = f"replace({columns['VehicleCrashKey']}, '-', '')"
+    columns['DriverAtFault'] = f"{columns['DriverAtFault']} = 'Yes'"
+    columns['DriverSubstanceAbuse'] = (f"CASE WHEN contains({cleaned}, 'combin') THEN 'COMBINATION' "
+                                       f"ELSE upper({cleaned}) END")
+    columns['VehicleType'] = vehicle_type
+    columns['ParkedVehicle'] = f"{columns['ParkedVehicle']} = 'Yes'"
+    columns['VehiclesCrashedTotal'] = f"count(*) OVER (PARTITION BY {columns['ReportNumber']})"
+
+    raw = text_frame(raw_data, DRIVER_RAW_COLUMNS).assign(Position=np.arange(len(raw_data)))
+    expressions = ", ".join(f'{expression} AS "{col}"' for col, expression in columns.items())
+    data = run_query(f"SELECT {expressions} FROM raw ORDER BY Position", raw=raw)
+
+    # years are parsed like pandas, invalid years fail the same way
+    year = data['VehicleYear'].astype(int)
+    data['VehicleYear'] = year.where((year >= 1900) & (year <= datetime.now().year + 1), 0)
+    return data
+
+
+def road_engine_pipeline(crashes_raw):
+    """ duckdb version of road_pipeline, output is identical """
+    if crashes_raw.empty:
+        return road_pipeline(crashes_raw)
+
+    raw = text_frame(crashes_raw, ['road_name', 'route_type', 'cross_street_name', 'cross_street_type'])
+    raw = raw.assign(Position=np.arange(len(raw)))
+    data = run_query(f"""
+        WITH roads AS (
+            SELECT {unknown(text('road_name'), True)} AS RoadName, {unknown(text('route_type'), True)} AS RouteType,
+                   Position
+            FROM raw
+            UNION ALL
+            SELECT {unknown(text('cross_street_name'), True)}, {unknown(text('cross_street_type'), True)},
+                   Position + {len(raw)}
+            FROM raw
+        )
+        SELECT RoadName, RouteType, min(Position) AS Position FROM roads
+        GROUP BY RoadName, RouteType ORDER BY Position""", raw=raw)
+
+    # first occurrences keep index of their source rows like drop_duplicates
+    road_dim = data[['RoadName', 'RouteType']].set_axis(crashes_raw.index[data['Position'] % len(raw)])
+    road_dim['RoadKey'] = [generate_roaddim_key(name, route_type)
+                           for name, route_type in zip(road_dim['RoadName'], road_dim['RouteType'])]
+    return road_dim
+
+
+def nonmoto_engine_pipeline(raw_data):
+    """ duckdb version of nonmoto_pipeline, output is identical """
+    if raw_data.empty or is_aggregated(raw_data):
+        return nonmoto_pipeline(raw_data)
+
+    words = f"string_split(lower({text('injury_severity')}), ' ')"
+    return run_query(f"""
+        WITH classified AS (
+            SELECT {text('report_number')} AS ReportNumber,
+                   CASE WHEN list_contains({words}, 'fatal') THEN 'Fatal'
+                        WHEN list_contains({words}, 'no') THEN 'No injury'
+                        WHEN list_contains({words}, 'injury') THEN 'Injury'
+                        ELSE 'No injury' END AS InjurySeverity
+            FROM raw
+        )
+        SELECT ReportNumber, count(InjurySeverity) AS NonMotoristTotal,
+               CAST(sum(CAST(InjurySeverity = 'Injury' AS INTEGER)) AS BIGINT) AS NonMotoristInjury,
+               CAST(sum(CAST(InjurySeverity = 'Fatal' AS INTEGER)) AS BIGINT) AS NonMotoristFatal
+        FROM classified GROUP BY ReportNumber ORDER BY ReportNumber""",
+                     raw=text_frame(raw_data, ['report_number', 'injury_severity']))
+
+
+def vehicles_engine_pipeline(raw_data):
+    """ duckdb version of vehicles_pipeline, transmissions, drivetrains and models are aggregated in one query """
+    vehicles = handle_nans_vehicles(prepare_vehicles_data(raw_data))
+    # blank models are not changed by transmission and drivetrain mapping, so they are added first
+    vehicles = generate_blank_models(vehicles)
+    if vehicles.empty:
+        return vehicles_pipeline(raw_data)
+
+    gears = """coalesce(nullif(regexp_extract(Transmission, '\\d+'), ''), 'CVT')"""
+    mapped = f"""
+        SELECT Make, "Year", BaseModel, BodyClass, Cylinders, Displacement,
+            CASE WHEN Transmission = 'Unknown' THEN Transmission
+                 WHEN contains(Transmission, 'Automatic') THEN 'Automatic ' || {gears}
+                 WHEN contains(Transmission, 'Manual') THEN 'Manual ' || {gears}
+                 ELSE Transmission END AS Transmission,
+            CASE WHEN Drivetrain = 'Front-Wheel Drive' THEN 'FWD'
+                 WHEN Drivetrain = 'Rear-Wheel Drive' THEN 'RWD'
+                 WHEN Drivetrain IN ('4-Wheel or All-Wheel Drive', 'All-Wheel Drive') THEN 'AWD'
+                 WHEN Drivetrain IN ('4-Wheel Drive', 'Part-time 4-Wheel Drive') THEN '4WD'
+                 WHEN Drivetrain = '2-Wheel Drive' THEN '2WD'
+                 ELSE Drivetrain END AS Drivetrain,
+            FuelType, CityMPG, HighwayMPG
+        FROM vehicles"""
+    # most frequent value of every column, ties resolved by the smallest value like Series.mode
+    modes = ", ".join(f'''first("{col}" ORDER BY "{col}Count" DESC, "{col}" ASC) FILTER (WHERE "{col}" IS NOT NULL)
+                       AS "{col}"''' for col in VEHICLE_MODE_COLUMNS)
+    counts = ", ".join(f'''count(*) OVER (PARTITION BY Make, "Year", BaseModel, "{col}") AS "{col}Count"'''
+                       for col in VEHICLE_MODE_COLUMNS)
+    data = run_query(f"""
+        WITH mapped AS ({mapped}),
+        counted AS (SELECT *, {counts} FROM mapped)
+        SELECT Make, "Year", BaseModel, {modes}
+        FROM counted GROUP BY Make, "Year", BaseModel ORDER BY Make, "Year", BaseModel""", vehicles=vehicles)
+
+    data.insert(3, 'VehicleKey', [generate_vehicle_key(make, model, year) for make, model, year
+                                  in zip(data['Make'], data['BaseModel'], data['Year'])])
+    return data
+
+
+def join_engine_vehicle_crashes(drivers, crashes):
+    """ duckdb version of join_vehicle_crashes, only row positions are joined so column types are kept """
+    if set(drivers.columns) & set(crashes.columns) != {'ReportNumber'}:
+        return join_vehicle_crashes(drivers, crashes)
+
+    pairs = run_query("""
+        SELECT d.Position AS DriverPosition, c.Position AS CrashPosition
+        FROM d JOIN c ON d.ReportNumber = c.ReportNumber
+        ORDER BY DriverPosition, CrashPosition""",
+                      d=pd.DataFrame({'ReportNumber': drivers['ReportNumber'].values,
+                                      'Position': np.arange(len(drivers))}),
+                      c=pd.DataFrame({'ReportNumber': crashes['ReportNumber'].values,
+                                      'Position': np.arange(len(crashes))}))
+    left = drivers.iloc[pairs['DriverPosition'].values].reset_index(drop=True)
+    right = crashes.drop(columns='ReportNumber').iloc[pairs['CrashPosition'].values].reset_index(drop=True)
+    return pd.concat([left, right], axis=1)
+
+
+TRANSFORM_ENGINES = {
+    'pandas': {
+        'vehicles': vehicles_pipeline,
+        'drivers': drivers_pipeline,
+        'roads': road_pipeline,
+        'nonmotorists': nonmoto_pipeline,
+        'crashes': crashes_pipeline,
+        'fact_join': join_vehicle_crashes
+    },
+    'duckdb': {
+        'vehicles': vehicles_engine_pipeline,
+        'drivers': drivers_engine_pipeline,
+        'roads': road_engine_pipeline,
+        'nonmotorists': nonmoto_engine_pipeline,
+        'crashes': crashes_engine_pipeline,
+        'fact_join': join_engine_vehicle_crashes
+    }
+}
+""" stage functions of every transform engine """
+
+
+def engine_functions(engine=None):
+    """ returns stage functions of transform engine, defaults to Config.TRANSFORM_ENGINE """
+    engine = Config.TRANSFORM_ENGINE if engine is None else engine
+    if engine == 'duckdb' and importlib.util.find_spec('duckdb') is None:
+        raise ImportError("duckdb transform engine needs optional duckdb package, install it with 'pip install duckdb'")
+    return TRANSFORM_ENGINES[engine]
@@ -1,24 +1,179 @@
 from datetime import datetime, timedelta
+from time import perf_counter
 from dateutil.relativedelta import *
 
 import pandas as pd
 
-from vehicles import vehicles_pipeline
-from drivers import drivers_pipeline, drivers_mapping_pipeline
-from crashes import crashes_pipeline, mapping_pipeline
-from nonmotorists import nonmoto_pipeline
-from roads import road_pipeline
+from drivers import drivers_mapping_pipeline
+from crashes import mapping_pipeline
+from nonmotorists import extract_nonmoto_data
 from weather import extract_weather_data, transform_weather_fact
 from datehour import generate_date_hour_dim
 from location import generate_location_area_dim
-from insertion import load_data_to_dwh, check_last_update
-from utils import load_models_dict, update_models_mapper, soda_montgomery_request, Static
+from insertion import ConnectionPool, load_data_to_dwh, upsert_data_to_dwh, add_row_hash, replace_partitions_in_dwh, \
+    check_last_update, check_watermarks, fetch_table_keys, fetch_rows_in_ranges, migrate_dwh, WATERMARK_COLUMNS, \
+    LoadStats
+from integrity import check_referential_integrity
+from aggregates import aggregates_pipeline, AGGREGATE_TABLES, AGGREGATE_FACT_COLUMNS, AGGREGATE_WEATHER_COLUMNS, \
+    PARTITION_COLUMN
+from utils import refresh_models_mapper, load_models_dict, soda_montgomery_request, soda_montgomery_changes, \
+    soda_montgomery_reports, read_fueleconomy_vehicles, sample_mask, Static
+from output import get_output_sink
+from loader import TableLoader
+from stages import Stage, StageExecutor
+from checkpoint import RunCheckpoint
+from memory import MemoryBudget, materialize
+from windows import plan_window
+from engines import engine_functions
 from config import Config
 
 
+FINAL_TABLES = {
+    'datehour_data': 'DateHourDim',
+    'vehicles_data': 'VehicleDim',
+    'road_data': 'RoadDim',
+    'location_data': 'LocationAreaDim',
+    'weather_data': 'WeatherFact',
+    'day_area_agg': 'CrashDayAreaAgg',
+    'hour_agg': 'CrashHourAgg',
+    'weather_agg': 'CrashWeatherAgg'
+}
+""" dimension, weather and aggregate tables final as soon as their stage finishes, by stage output name """
+
+LOAD_DEPENDENCIES = {
+    'WeatherFact': ['DateHourDim', 'LocationAreaDim'],
+    'VehicleCrashFact': ['RoadDim', 'VehicleDim', 'LocationAreaDim', 'DateHourDim', 'WeatherFact']
+}
+""" tables which have to be loaded before given table, remaining tables are loaded concurrently """
+
+PHASE_OUTPUTS = {
+    'extract': ['crash_data', 'drivers_data', 'nonmotorists_data', 'vehicles_data', 'weather_data', 'datehour_data',
+                'source_watermarks'],
+    'transform': ['vehicles_data', 'drivers_data', 'road_data', 'nonmotorists_data', 'crash_data', 'location_data',
+                  'weather_data'],
+    'join': ['drivers_data'],
+    'aggregate': ['day_area_agg', 'hour_agg', 'weather_agg']
+}
+""" ETL attributes checkpointed after each phase """
+
+PHASE_TABLES = {
+    'extract': ['datehour_data'],
+    'transform': ['vehicles_data', 'road_data', 'location_data', 'weather_data'],
+    'join': ['drivers_data'],
+    'aggregate': ['day_area_agg', 'hour_agg', 'weather_agg']
+}
+""" ETL attributes holding completed tables after each phase, they may be spilled to disk until loaded """
+
+TABLE_ATTRIBUTES = ['crash_data', 'drivers_data', 'nonmotorists_data', 'vehicles_data', 'road_data', 'weather_data',
+                    'datehour_data', 'location_data', 'day_area_agg', 'hour_agg', 'weather_agg']
+""" ETL attributes holding tables, counted against memory budget """
+
+NEW_ROW_KEYS = {
+    'VehicleDim': 'VehicleKey',
+    'RoadDim': 'RoadKey',
+    'DateHourDim': 'DateHourKey',
+    'WeatherFact': 'WeatherKey'
+}
+""" tables of which runs keeping dimension keys load only rows with keys not loaded into dwh yet, by key column """
+
+UPSERT_TABLES = ['VehicleCrashFact']
+""" tables loaded with RowHash column, rows corrected upstream are updated in place instead of skipped """
+
+SOURCE_ATTRIBUTES = {
+    'incidents': 'crash_data',
+    'drivers': 'drivers_data',
+    'non-motorists': 'nonmotorists_data'
+}
+""" ETL attributes storing raw data of portal datasets """
+
+STAGE_ATTRIBUTES = {
+    'vehicles_data': 'vehicles_data',
+    'models_dict': 'models_dict',
+    'drivers_data': 'drivers_data',
+    'road_data': 'road_data',
+    'nonmotorists_data': 'nonmotorists_data',
+    'crash_data': 'crash_data',
+    'location_data': 'location_data',
+    'weather_data': 'weather_data',
+    'drivers_mapped': 'drivers_data',
+    'crash_mapped': 'crash_data',
+    'fact_data': 'drivers_data',
+    'day_area_agg': 'day_area_agg',
+    'hour_agg': 'hour_agg',
+    'weather_agg': 'weather_agg'
+}
+""" ETL attributes storing stage outputs """
+
+
+def expects_table(table_name):
+    """ if table is produced in current run, location dimension is generated only during initialization """
+    if table_name in AGGREGATE_TABLES:
+        return Config.AGGREGATES
+    return table_name != 'LocationAreaDim' or Config.DWH_INITIALIZATION
+
+
+def upserts_table(table_name):
+    """ if table is loaded with RowHash column and upserted, see Config.FACT_UPSERT """
+    return Config.FACT_UPSERT and table_name in UPSERT_TABLES
+
+
+def load_dependencies():
+    """ load dependencies limited to tables produced in current run """
+    return {table_name: [name for name in dependencies if expects_table(name)]
+            for table_name, dependencies in LOAD_DEPENDENCIES.items()}
+
+
+def transform_stages(engine=None, reports=True):
+    """
+    transformation stages, each depends only on its own raw input except the models mapper update,
+    engine defaults to Config.TRANSFORM_ENGINE, crash datasets are transformed only if window has reports
+    """
+    functions = engine_functions(engine)
+    stages = [
+        Stage('vehicles', functions['vehicles'], ['vehicles_raw'], ['vehicles_data']),
+        # mapper is updated on disk and loaded into Static of the main process
+        Stage('models_mapper', refresh_models_mapper, ['vehicles_data'], ['models_dict'], in_process=True)
+    ]
+    if reports:
+        stages += [
+            Stage('drivers', functions['drivers'], ['drivers_raw'], ['drivers_data']),
+            Stage('roads', functions['roads'], ['crash_raw'], ['road_data']),
+            Stage('nonmotorists', functions['nonmotorists'], ['nonmotorists_raw'], ['nonmotorists_data']),
+            Stage('crashes', functions['crashes'], ['crash_raw'], ['crash_data'])
+        ]
+    if Config.DWH_INITIALIZATION:
+        stages.append(Stage('location', generate_location_area_dim, ['zipcode_geometry'], ['location_data']))
+    stages.append(Stage('weather', transform_weather_fact, ['weather_raw'], ['weather_data']))
+    return stages
+
+
+def join_stages(engine=None):
+    """
+    foreign key generation stages, sharded mapping starts its own process pool from the main process,
+    engine defaults to Config.TRANSFORM_ENGINE
+    """
+    sharded = Config.MAPPING_WORKERS > 1
+    return [
+        Stage('drivers_mapping', drivers_mapping_pipeline, ['drivers_data', 'models_dict'], ['drivers_mapped'],
+              in_process=sharded),
+        Stage('crashes_mapping', mapping_pipeline, ['crash_data', 'nonmotorists_data'], ['crash_mapped'],
+              in_process=sharded),
+        Stage('fact_join', engine_functions(engine)['fact_join'], ['drivers_mapped', 'crash_mapped'], ['fact_data'],
+              in_process=True)
+    ]
+
+
+def aggregate_stages():
+    """ aggregate tables stage, computed from final fact and weather tables """
+    return [
+        Stage('aggregates', aggregates_pipeline, ['fact_data', 'weather_data', 'fact_history'],
+              ['day_area_agg', 'hour_agg', 'weather_agg'])
+    ]
+
+
 class ETL:
 
-    def __init__(self):
+    def __init__(self, checkpoint=None, pool=None, dimension_keys=None, sample=None, engine=None, source_cache=None):
         self.crash_data = pd.DataFrame()
         self.drivers_data = pd.DataFrame()
         self.nonmotorists_data = pd.DataFrame()
@@ -27,137 +182,552 @@ class ETL:
         self.weather_data = pd.DataFrame()
         self.datehour_data = pd.DataFrame()
         self.location_data = pd.DataFrame()
-        self.merged_data = pd.DataFrame()
-
-    def extract_data(self, start_date, end_date):
-        """ load data from different sources """
+        self.day_area_agg = pd.DataFrame()
+        self.hour_agg = pd.DataFrame()
+        self.weather_agg = pd.DataFrame()
+        self.integrity_report = pd.DataFrame()
+        self.source_watermarks = pd.DataFrame(columns=['Dataset', 'Watermark'])
+        self.models_dict = Static.MODELS_DICT
+        self.loader = None
+        self.pool = None
+        self.shared_pool = pool
+        self.dimension_keys = dimension_keys
+        self.source_cache = source_cache
+        self.sample = sample
+        self.engine = engine
+        self.checkpoint = checkpoint
+        self.memory = MemoryBudget() if Config.MEMORY_BUDGET_MB is not None else None
+
+    def save_checkpoint(self, phase):
+        """ saves outputs of finished phase, failure to save does not stop the run """
+        if self.checkpoint is None:
+            return
+        try:
+            self.checkpoint.save_phase(phase, {name: self.frame(name) for name in PHASE_OUTPUTS[phase]})
+        except (Exception, ) as e:
+            print(f"WARNING: checkpoint of {phase} phase not saved", e)
+
+    def restore_checkpoint(self):
+        """ restores outputs of phases finished in previous attempt, returns names of restored phases """
+        if self.checkpoint is None:
+            return []
+        phases = self.checkpoint.completed_phases()
+        for phase in phases:
+            for name, frame in self.checkpoint.load_phase(phase).items():
+                setattr(self, name, frame)
+            print(f"Outputs of {phase} phase restored from {self.checkpoint.directory}")
+        if 'transform' in phases:
+            # mapper file was updated by previous attempt
+            self.models_dict = load_models_dict(return_=True)
+        return phases
+
+    def frame(self, name, columns=None):
+        """ returns table stored in attribute, reading it back if it was spilled to disk """
+        return materialize(getattr(self, name), columns)
+
+    def take(self, names):
+        """ hands tables over to stages, attributes are emptied so stages hold the only reference """
+        frames = {}
+        for name in names:
+            frames[name] = self.frame(name)
+            setattr(self, name, pd.DataFrame())
+        return frames
+
+    def enforce_memory_budget(self, phases):
+        """ spills completed tables of finished phases if tables held by the run exceed memory budget """
+        if self.memory is None:
+            return
+        completed = [name for phase in phases for name in PHASE_TABLES[phase]]
+        tables = {name: getattr(self, name) for name in TABLE_ATTRIBUTES}
+        for name, spilled in self.memory.enforce(tables, completed).items():
+            setattr(self, name, spilled)
+
+    def release_spilled(self):
+        """ removes tables spilled by the run """
+        if self.memory is not None:
+            self.memory.clear()
+
+    def saves_locally(self):
+        """ if tables are saved to output sink instead of dwh, sampled runs never load into dwh """
+        return Config.DEBUG or self.sample is not None
+
+    def is_loaded(self, table_name):
+        return self.checkpoint is not None and self.checkpoint.is_loaded(table_name)
+
+    def mark_loaded(self, table_name):
+        if self.checkpoint is not None:
+            self.checkpoint.mark_loaded(table_name)
+
+    def start_loader(self):
+        """ starts background loader, tables are loaded as soon as they are final and tables they reference are loaded """
+        if self.shared_pool is not None:
+            self.pool = self.shared_pool
+        elif not self.saves_locally():
+            self.pool = ConnectionPool(Config.LOAD_WORKERS)
+        self.loader = TableLoader(self.load_table, workers=Config.LOAD_WORKERS, dependencies=load_dependencies())
+
+    def stop_loader(self):
+        """ waits for background loader to finish, returns mapping of table name to load result """
+        if self.loader is None:
+            return {}
+        loader, self.loader = self.loader, None
+        try:
+            results = loader.close()
+        finally:
+            if self.pool is not None and self.pool is not self.shared_pool:
+                self.pool.close()
+            self.pool = None
+        for table_name, seconds in loader.timings.items():
+            print(f'{table_name}: loaded in {seconds:.1f}s')
+        print(f'Tables loaded in {loader.wall_time():.1f}s, sum of table load times {sum(loader.timings.values()):.1f}s')
+        return results
+
+    def publish(self, table, table_name):
+        """ queues final table for loading if background loader is running """
+        if self.loader is not None:
+            self.loader.submit(table, table_name)
+
+    def extract_data(self, start_date, end_date, watermarks=None, weather_start=None):
+        """
+        load data from different sources, crash reports changed since watermarks replace the window if given,
+        weather is extracted from weather start if given and only hours already archived are kept
+        """
         print("-----")
-        print(f'RUNNING EXTRACTION from {start_date} to {end_date}')
-
-        crash_data = soda_montgomery_request('incidents', start_date=start_date, end_date=end_date)
-        self.crash_data = crash_data
-        print('crash data rows:', len(self.crash_data))
-
-        drivers_data = soda_montgomery_request('drivers', start_date=start_date, end_date=end_date)
-        self.drivers_data = drivers_data
-        print('drivers data rows:', len(self.drivers_data))
+        if watermarks is None:
+            print(f'RUNNING EXTRACTION from {start_date} to {end_date}')
+
+            crash_data = soda_montgomery_request('incidents', start_date=start_date, end_date=end_date)
+            self.crash_data = self.sampled(crash_data)
+            print('crash data rows:', len(self.crash_data))
+
+            if self.sample is None:
+                drivers_data = soda_montgomery_request('drivers', start_date=start_date, end_date=end_date)
+                nonmotorists_data = extract_nonmoto_data(soda_montgomery_request, start_date, end_date)
+            else:
+                # only sampled reports are requested instead of the whole window
+                reports = sorted(self.crash_data['report_number']) if not self.crash_data.empty else []
+                drivers_data = soda_montgomery_reports('drivers', reports)
+                nonmotorists_data = extract_nonmoto_data(soda_montgomery_reports, reports)
+
+            self.drivers_data = drivers_data
+            print('drivers data rows:', len(self.drivers_data))
+
+            self.nonmotorists_data = nonmotorists_data
+            print('non motorists data rows:', len(self.nonmotorists_data))
+        else:
+            print(f'RUNNING INCREMENTAL EXTRACTION of reports changed since {min(watermarks.values())}')
 
-        nonmotorists_data = soda_montgomery_request('non-motorists', start_date=start_date, end_date=end_date)
-        self.nonmotorists_data = nonmotorists_data
-        print('non motorists data rows:', len(self.nonmotorists_data))
+            self.extract_changes(watermarks)
+            ranges = self.changed_ranges()
+            if not ranges:
+                print('No crash reports changed since last update')
+                return
+            print(f'changed reports cover {len(ranges)} day ranges from {ranges[0][0]} to {ranges[-1][1]}')
 
-        vehicles_data = pd.read_csv("https://www.fueleconomy.gov/feg/epadata/vehicles.csv", low_memory=False)
-        self.vehicles_data = vehicles_data
+        self.vehicles_data = self.fueleconomy_vehicles()
         print('vehicles data rows:', len(self.vehicles_data))
 
-        weather_data = extract_weather_data(Static.ZIPCODES, start_date=start_date, end_date=end_date)
-        self.weather_data = weather_data
+        # incremental runs extract weather and hours of changed days only, not the whole span between them
+        ranges = [(start_date, end_date)] if watermarks is None else ranges
+        weather_ranges = ranges if weather_start is None or watermarks is not None else [(weather_start, end_date)]
+        self.weather_data = pd.concat([extract_weather_data(Static.ZIPCODE_GEOMETRY, start_date=start, end_date=end)
+                                       for start, end in weather_ranges], ignore_index=True)
+        if weather_start is not None and not self.weather_data.empty:
+            archived = self.weather_data['temperature_2m'].notna()
+            print(f'weather rows not archived yet: {(~archived).sum()}, they are extracted again by later runs')
+            self.weather_data = self.weather_data[archived].reset_index(drop=True)
         print('weather data rows:', len(self.weather_data))
 
-        self.datehour_data = generate_date_hour_dim(start_date=start_date, end_date=end_date)
+        self.datehour_data = pd.concat([generate_date_hour_dim(start_date=start, end_date=end) for start, end in ranges],
+                                       ignore_index=True)
         print('datehour data rows:', len(self.datehour_data))
+        self.publish(self.datehour_data, 'DateHourDim')
+
+    def fueleconomy_vehicles(self):
+        """ downloads fueleconomy file, reused from source cache kept by the caller until refresh hours pass """
+        if self.source_cache is None:
+            return read_fueleconomy_vehicles()
+        downloaded, vehicles_data = self.source_cache.get('vehicles', (None, None))
+        if downloaded is None or datetime.now() - downloaded > timedelta(hours=Config.FUELECONOMY_REFRESH_HOURS):
+            vehicles_data = read_fueleconomy_vehicles()
+            self.source_cache['vehicles'] = (datetime.now(), vehicles_data)
+        else:
+            print(f'fueleconomy file downloaded at {downloaded:%Y-%m-%d %H:%M} reused')
+        return vehicles_data.copy()
+
+    def extract_changes(self, watermarks):
+        """
+        load rows of crash datasets changed since their watermarks, together with unchanged rows of other datasets
+        belonging to the same reports, so that changed reports are transformed and joined complete
+        """
+        changes = {dataset: self.sampled(soda_montgomery_changes(dataset, watermarks[dataset]))
+                   for dataset in SOURCE_ATTRIBUTES}
+        reports = set()
+        for data in changes.values():
+            if not data.empty:
+                reports.update(data['report_number'])
+
+        updated = []
+        for dataset, name in SOURCE_ATTRIBUTES.items():
+            changed = changes[dataset]
+            present = set(changed['report_number']) if not changed.empty else set()
+            related = soda_montgomery_reports(dataset, sorted(reports - present))
+            setattr(self, name, pd.concat([changed, related], ignore_index=True))
+            print(f'{dataset} data rows: {len(changed)} changed, {len(related)} of related reports')
+
+            latest = pd.Timestamp(watermarks[dataset])
+            if not changed.empty:
+                # portal timestamps are UTC, stored as naive datetimes
+                latest = max(latest, pd.to_datetime(changed[':updated_at'], utc=True).max().tz_localize(None))
+            updated.append((dataset, latest))
+        self.source_watermarks = pd.DataFrame(updated, columns=['Dataset', 'Watermark'])
+
+    def sampled(self, data):
+        """ keeps rows of sampled reports if run is sampled """
+        if self.sample is None or data.empty:
+            return data
+        return data[sample_mask(data['report_number'], self.sample)].reset_index(drop=True)
+
+    def changed_ranges(self):
+        """ returns start and end hours of runs of consecutive days with crash dates of extracted reports """
+        if self.crash_data.empty:
+            return []
+        days = pd.to_datetime(self.crash_data['crash_date_time']).dt.normalize().drop_duplicates().sort_values()
+        runs = (days.diff() != pd.Timedelta(days=1)).cumsum()
+        return [(run.min().strftime('%Y-%m-%d 00:00:00'), run.max().strftime('%Y-%m-%d 23:00:00'))
+                for _, run in days.groupby(runs)]
+
+    def updated_watermarks(self):
+        """ returns latest portal ':updated_at' of extracted rows of every crash dataset """
+        return {dataset: pd.Timestamp(watermark).to_pydatetime()
+                for dataset, watermark in zip(self.source_watermarks['Dataset'], self.source_watermarks['Watermark'])}
+
+    def window(self):
+        """ returns start and end of extracted hourly window, None if nothing was extracted """
+        if self.datehour_data.empty:
+            return None
+        dates = self.frame('datehour_data', ['Datetime'])['Datetime']
+        return dates.min().strftime('%Y-%m-%d %H:%M:%S'), dates.max().strftime('%Y-%m-%d %H:%M:%S')
+
+    def has_reports(self):
+        """ if window has crash reports with drivers, short windows of micro-batches may have none """
+        return not (self.crash_data.empty or self.drivers_data.empty)
+
+    def on_stage_output(self, name, value):
+        """ keeps final tables and publishes them as soon as stages produce them, later stages may release them """
+        if name in FINAL_TABLES:
+            setattr(self, name, value)
+            self.publish(value, FINAL_TABLES[name])
+
+    def run_stages(self, stages, data):
+        """ runs stages on given data and stores known outputs as attributes """
+        data = StageExecutor(stages, release=True).run(data, on_output=self.on_stage_output)
+        for stage in stages:
+            for name in stage.outputs:
+                # outputs consumed by later stages were already released
+                if name in STAGE_ATTRIBUTES and name in data:
+                    setattr(self, STAGE_ATTRIBUTES[name], data[name])
 
     def transform_data(self):
         """ run transformations """
         print("-----")
         print('RUNNING TRANSFORMATIONS')
 
-        self.vehicles_data = vehicles_pipeline(self.vehicles_data)
-        print('Vehicles data transformed')
-
-        update_models_mapper(self.vehicles_data[['Make', 'Year', 'BaseModel']])
-        load_models_dict()  # needs to be loaded after vehicles pipeline and updating mapper
-
-        self.drivers_data = drivers_pipeline(self.drivers_data)
-        print('Drivers data transformed')
-
-        # crash data is still raw
-        self.road_data = road_pipeline(self.crash_data)
-        print('Roads data transformed')
-
-        self.nonmotorists_data = nonmoto_pipeline(self.nonmotorists_data)
-        print('Non-motorists data transformed')
-
-        self.crash_data = crashes_pipeline(self.crash_data)
-        print('Crashes data transformed')
-
-        self.weather_data = transform_weather_fact(self.weather_data)
-        print('Weather data transformed')
-
-        if Config.DWH_INITIALIZATION:
-            self.location_data = generate_location_area_dim(Static.ZIPCODES)
-            print('Location data generated')
+        reports = self.has_reports()
+        if not reports:
+            print('No crash reports in the window, only vehicles and weather are transformed')
+        # raw frames are released as soon as their last stage finishes
+        raw = self.take(['vehicles_data', 'drivers_data', 'crash_data', 'nonmotorists_data', 'weather_data'])
+        self.run_stages(transform_stages(self.engine, reports=reports), {
+            'vehicles_raw': raw.pop('vehicles_data'),
+            'drivers_raw': raw.pop('drivers_data'),
+            'crash_raw': raw.pop('crash_data'),
+            'nonmotorists_raw': raw.pop('nonmotorists_data'),
+            'weather_raw': raw.pop('weather_data'),
+            'zipcode_geometry': Static.ZIPCODE_GEOMETRY
+        })
 
     def join_data(self):
         """ generate foreign keys """
         print("-----")
         print('RUNNING JOINING')
+        if not self.has_reports():
+            print('No crash reports in the window, skipping')
+            return
 
-        self.drivers_data = drivers_mapping_pipeline(self.drivers_data)
-        print('Drivers data mapped')
+        data = self.take(['drivers_data', 'crash_data', 'nonmotorists_data'])
+        data['models_dict'] = self.models_dict
+        self.run_stages(join_stages(self.engine), data)
 
-        self.crash_data = mapping_pipeline(self.crash_data, self.nonmotorists_data)
-        print('Crashes data mapped')
-
-        self.drivers_data = self.drivers_data.merge(self.crash_data, on='ReportNumber')
-        print('Vehicle Crashes joined')
+    def aggregate_data(self):
+        """ compute aggregate tables of days present in the window """
+        print("-----")
+        print('RUNNING AGGREGATION')
+        if self.drivers_data.empty:
+            print('No crash reports in the window, skipping')
+            return
+
+        history = pd.DataFrame()
+        weather = self.frame('weather_data')
+        if not self.saves_locally():
+            # partitions are replaced by whole days, window may hold only some hours of its days (micro-batches,
+            # windows ending mid-day) or changed reports only, remaining reports of its days are read from dwh
+            days = sorted(set(self.frame('drivers_data', ['DateHourKey'])['DateHourKey'].astype('int64') // 100))
+            ranges = [(day * 100, day * 100 + 23) for day in days]
+            history = fetch_rows_in_ranges('VehicleCrashFact', AGGREGATE_FACT_COLUMNS, 'DateHourKey', ranges,
+                                           pool=self.shared_pool)
+            loaded_weather = fetch_rows_in_ranges('WeatherFact', AGGREGATE_WEATHER_COLUMNS, 'DateHourKey', ranges,
+                                                  pool=self.shared_pool)
+            if history is None or loaded_weather is None:
+                raise ConnectionError("previously loaded reports of affected days not fetched from dwh")
+            print('previously loaded fact rows of affected days:', len(history))
+            if not loaded_weather.empty:
+                # weather of hours outside the window buckets reports read from dwh
+                weather = pd.concat([weather, loaded_weather], ignore_index=True).drop_duplicates(
+                    ['LocationAreaKey', 'DateHourKey'], ignore_index=True)
+
+        self.run_stages(aggregate_stages(), {
+            'fact_data': self.frame('drivers_data'),
+            'weather_data': weather,
+            'fact_history': history
+        })
+
+    def loaded_keys(self, table_name, key_column):
+        """ returns keys of dimension already loaded into dwh, cached between runs if cache is kept by the caller """
+        if self.dimension_keys is not None and table_name in self.dimension_keys:
+            return self.dimension_keys[table_name]
+        keys = fetch_table_keys(table_name, [key_column], pool=self.shared_pool)
+        if keys is not None and self.dimension_keys is not None:
+            self.dimension_keys[table_name] = keys
+        return keys
+
+    def new_rows(self, table, table_name):
+        """
+        drops rows already loaded into dwh from dimensions and weather of runs keeping dimension keys (micro-batches),
+        loaded keys of hourly tables are fetched for hours of the table only, table is kept if keys are not available
+        """
+        key_column = NEW_ROW_KEYS.get(table_name)
+        if key_column is None or self.dimension_keys is None or table.empty:
+            return table
+        if 'DateHourKey' in table.columns:
+            hours = table['DateHourKey'].astype('int64')
+            keys = fetch_rows_in_ranges(table_name, [key_column], 'DateHourKey', [(int(hours.min()), int(hours.max()))],
+                                        pool=self.shared_pool)
+        else:
+            keys = self.loaded_keys(table_name, key_column)
+        if keys is None:
+            return table
+        new = table[~table[key_column].isin(keys[key_column])]
+        print(f'{table_name}: {len(table) - len(new)} rows already loaded, {len(new)} new rows')
+        return new
+
+    def remember_keys(self):
+        """ adds keys of dimensions loaded in this run to the cache """
+        if self.dimension_keys is None or self.saves_locally():
+            return
+        for table_name, table, key_column in [('VehicleDim', self.vehicles_data, 'VehicleKey'),
+                                              ('RoadDim', self.road_data, 'RoadKey')]:
+            if table_name in self.dimension_keys and not table.empty:
+                keys = pd.concat([self.dimension_keys[table_name], materialize(table, [key_column])])
+                self.dimension_keys[table_name] = keys.drop_duplicates(ignore_index=True)
+
+    def check_integrity(self):
+        """ checks foreign keys of the fact table against dimension key sets """
+        print("-----")
+        print('RUNNING INTEGRITY CHECK')
+        if self.drivers_data.empty:
+            print('No crash reports in the window, skipping')
+            return True
+
+        dimensions = {'VehicleDim': [self.frame('vehicles_data')],
+                      'RoadDim': [self.frame('road_data')],
+                      'LocationAreaDim': [self.frame('location_data')],
+                      'WeatherFact': [self.frame('weather_data')],
+                      'DateHourDim': [self.frame('datehour_data')]}
+
+        if not Config.DWH_INITIALIZATION:
+            # location keys are static, other dimensions generated in this window are only partial
+            dimensions['LocationAreaDim'] += [Static.AREA_MAPPER, pd.DataFrame({'LocationAreaKey': [0]})]
+            for table_name, key_column in [('VehicleDim', 'VehicleKey'), ('RoadDim', 'RoadKey')]:
+                keys = self.loaded_keys(table_name, key_column)
+                if keys is None:
+                    print(f'WARNING: {table_name} keys not fetched from dwh, checking against current window only')
+                else:
+                    dimensions[table_name].append(keys)
+
+        self.integrity_report = check_referential_integrity(self.frame('drivers_data'), dimensions)
+        print(self.integrity_report.to_string(index=False))
+
+        consistent = self.integrity_report['OrphanRows'].sum() == 0
+        if not consistent:
+            print('WARNING: Fact table contains orphaned foreign keys')
+        return consistent
+
+    def tables(self):
+        """ tables to load, in order satisfying foreign keys """
+        tables = {'RoadDim': self.road_data,
+                  'VehicleDim': self.vehicles_data}
+        if Config.DWH_INITIALIZATION:
+            tables['LocationAreaDim'] = self.location_data
+        tables['DateHourDim'] = self.datehour_data
+        tables['WeatherFact'] = self.weather_data
+        if self.drivers_data.empty:
+            return tables
+        tables['VehicleCrashFact'] = self.drivers_data
+        # aggregates of sampled reports would understate daily counts
+        if Config.AGGREGATES and self.sample is None:
+            tables['CrashDayAreaAgg'] = self.day_area_agg
+            tables['CrashHourAgg'] = self.hour_agg
+            tables['CrashWeatherAgg'] = self.weather_agg
+        return tables
+
+    def load_table(self, table, table_name):
+        """ loads table to dwh or saves it locally in debug and sampled runs, tables loaded before are skipped """
+        if self.is_loaded(table_name):
+            print(f'{table_name}: loaded in previous attempt, skipping')
+            return True
+
+        table = materialize(table)
+        if not self.saves_locally():
+            table = self.new_rows(table, table_name)
+        if upserts_table(table_name):
+            table = add_row_hash(table)
+
+        if self.saves_locally():
+            sink = get_output_sink()
+            sink.write(table, table_name)
+            print(f'{table_name}: saved to {sink.path(table_name)}')
+            loaded = True
+        elif upserts_table(table_name):
+            loaded = upsert_data_to_dwh(table, table_name, pool=self.pool)
+        elif table_name in AGGREGATE_TABLES:
+            loaded = replace_partitions_in_dwh(table, table_name, PARTITION_COLUMN, pool=self.pool)
+        else:
+            loaded = load_data_to_dwh(table, table_name, pool=self.pool)
 
-    def merge_data(self):
-        """ merges all data for testing purposes """
-        try:
-            self.merged_data = self.drivers_data.merge(
-                self.vehicles_data, on='VehicleKey').merge(
-                self.road_data, left_on='RoadKey', right_on='RoadKey').merge(
-                self.road_data, left_on='CrossStreetKey', right_on='RoadKey').merge(
-                self.location_data, on='LocationAreaKey').merge(
-                self.weather_data, on=['LocationAreaKey', 'DateHourKey']).merge(
-                self.datehour_data, on='DateHourKey'
-            )
-        except (Exception, ) as e:
-            print(e)
-        fact_rows = len(self.drivers_data)
-        merged_rows = len(self.merged_data)
-        print('Vehicle Crashes table rows:', fact_rows)
-        print('Merged table rows:', merged_rows)
-        if fact_rows > merged_rows:
-            print('WARNING: Data cannot be fully merged')
+        if loaded:
+            self.mark_loaded(table_name)
+        return loaded
 
     def load_data(self):
-        """ load data to dwh"""
+        """
+        load data to dwh, independent tables concurrently and fact table after all dimensions are committed,
+        returns mapping of table name to load result
+        """
         print("-----")
         print("RUNNING DWH INSERTION")
 
-        if Config.DEBUG:
-            self.drivers_data.to_csv("out/VehicleCrashFact.csv", index=False)
-            self.vehicles_data.to_csv("out/VehicleDim.csv", index=False)
-            self.road_data.to_csv("out/RoadDim.csv", index=False)
-            self.weather_data.to_csv("out/WeatherFact.csv", index=False)
-            self.datehour_data.to_csv("out/DateHourDim.csv", index=False)
-            if Config.DWH_INITIALIZATION:
-                self.location_data.to_csv("out/LocationAreaDim.csv", index=False)
-            self.merged_data.to_csv("out/MergedData.csv", index=False)
-            print('Tables saved succesfully')
-
-        else:
-            load_data_to_dwh(self.road_data, 'RoadDim')
-            load_data_to_dwh(self.vehicles_data, 'VehicleDim')
-            if Config.DWH_INITIALIZATION:
-                load_data_to_dwh(self.location_data, 'LocationAreaDim')
-            load_data_to_dwh(self.datehour_data, 'DateHourDim')
-            load_data_to_dwh(self.weather_data, 'WeatherFact')
-            load_data_to_dwh(self.drivers_data, 'VehicleCrashFact')
-
-
-def etl_pipeline(start_date=None, end_date=None, message=None):
-    """ runs ETL pipeline """
+        if self.loader is None:
+            self.start_loader()
+            for table_name, table in self.tables().items():
+                if table_name != 'VehicleCrashFact':
+                    self.publish(table, table_name)
+
+        # dimensions were queued when final in pipelined mode
+        if not self.drivers_data.empty:
+            self.publish(self.drivers_data, 'VehicleCrashFact')
+        return self.stop_loader()
+
+
+def plan_next_window(start, limit=None, batch_hours=None):
+    """
+    Plan window of regular update or backfill starting at given hour.
+
+    Args:
+        start (datetime): first hour of the window
+        limit (datetime): last hour the window may cover, end of yesterday if None, last complete hour in micro-batches
+        batch_hours (int): hours of micro-batch window, planned from row counts or as a month if None
+
+    Returns:
+        tuple: last hour of the window in "YYYY-MM-DD HH:MM:SS" format and its estimated rows, None if there is
+            nothing left to process, windows of fixed month length have no estimate
+    """
+    if batch_hours:
+        if limit is None:
+            limit = datetime.now().replace(minute=0, second=0, microsecond=0) - timedelta(hours=1)
+        if start > limit:
+            return None
+        end = min(start + timedelta(hours=batch_hours - 1), limit)
+        return end.strftime("%Y-%m-%d %H:%M:%S"), None
+    if Config.ADAPTIVE_WINDOWS:
+        try:
+            planned = plan_window(start, limit)
+            if planned is None:
+                return None
+            end, rows = planned
+            return end.strftime("%Y-%m-%d %H:%M:%S"), rows
+        except (Exception, ) as e:
+            print("WARNING: window row counts not available, falling back to a month long window", e)
+    end = start + relativedelta(months=1) - timedelta(hours=1)
+    if limit is not None:
+        if start > limit:
+            return None
+        end = min(end, limit)
+    return end.strftime("%Y-%m-%d %H:%M:%S"), None
+
+
+def etl_pipeline(start_date=None, end_date=None, message=None, resume=False, pool=None, dimension_keys=None,
+                 sample=None, window_rows=None, engine=None, source_cache=None, batch_hours=None, timings=None):
+    """
+    runs ETL pipeline
+
+    Args:
+        start_date (str): start of the window, reports changed since last update or next month after it if None
+        end_date (str): end of the window, reports changed since last update or next month after it if None
+        message (str): update message saved in Metadata
+        resume (bool): if run restarts from checkpoint of previous failed attempt for the same window
+        pool (ConnectionPool): dwh connections kept open by the caller, new pool is opened for the load if None
+        dimension_keys (dict): cache of dimension keys loaded into dwh, kept by the caller between runs
+        sample (float): fraction of crash reports kept for development runs, defaults to Config.SAMPLE_FRACTION
+        window_rows (int): estimated rows of window planned by the caller, saved in Metadata
+        engine (str): transform engine of the run, defaults to Config.TRANSFORM_ENGINE
+        source_cache (dict): cache of downloaded source files, kept by the caller between runs
+        batch_hours (int): hours of regular update window in micro-batch mode, defaults to Config.MICRO_BATCH_HOURS,
+            micro-batches run planned windows even if Config.INCREMENTAL_EXTRACT is set
+        timings (dict): filled with seconds of every phase of the run and its total, e.g. to measure batch latency
+
+    Returns:
+        bool: if run finished with success
+    """
+
+    sample = Config.SAMPLE_FRACTION if sample is None else sample
+    batch_hours = Config.MICRO_BATCH_HOURS if batch_hours is None else batch_hours
+    timings = {} if timings is None else timings
+    run_start = perf_counter()
+
+    # watermark columns are read and tables may be loaded as soon as they are final, columns have to exist before
+    if not Config.DEBUG and sample is None and Config.DWH_MIGRATE and not migrate_dwh(pool=pool):
+        print("Error ocurred during schema migration, aborting...")
+        return False
+
+    watermarks = None
+    if Config.INCREMENTAL_EXTRACT:
+        try:
+            print("-----")
+            print("Checking source watermarks...")
+            watermarks = check_watermarks(pool=pool)
+        except (Exception, ) as e:
+            print("WARNING: source watermarks not available, falling back to monthly windows", e)
+    # micro-batches always run planned windows
+    incremental = watermarks is not None and (start_date is None or end_date is None) and not batch_hours
 
     try:
-        if start_date is None or end_date is None:
+        if incremental:
+            # window is known only after changed reports are extracted, run is identified by its watermark
+            start_date = end_date = min(watermarks.values()).strftime("%Y-%m-%d %H:%M:%S")
+            last_end_date = check_last_update(pool=pool).strftime("%Y-%m-%d %H:%M:%S")
+            if message is None:
+                message = 'incremental update'
+        elif start_date is None or end_date is None:
             print("-----")
             print("Checking last update date...")
-            last_end_date = check_last_update()
+            last_end_date = check_last_update(pool=pool)
             start_date = last_end_date + timedelta(hours=1)
-            end_date = (start_date + relativedelta(months=1) - timedelta(hours=1)).strftime("%Y-%m-%d %H:%M:%S")
+            planned = plan_next_window(start_date, batch_hours=batch_hours)
+            if planned is None:
+                print("Data warehouse is up to date, finishing...")
+                return False
+            end_date, window_rows = planned
             start_date = start_date.strftime("%Y-%m-%d %H:%M:%S")
             if message is None:
                 message = 'regular update'
@@ -166,57 +736,167 @@ def etl_pipeline(start_date=None, end_date=None, message=None):
                 message = 'custom update'
     except (Exception, ) as e:
         print("Error ocurred during last update check, aborting...", e)
-        return
+        return False
 
-    print("-----")
-    print(f'RUNNING ETL PIPELINE from {start_date} to {end_date}')
+    weather_start = None
+    if batch_hours and not incremental:
+        # open-meteo archive fills recent hours days later, hours missing from earlier batches are extracted again
+        weather_start = (pd.Timestamp(start_date) - timedelta(days=Config.WEATHER_ARCHIVE_LAG_DAYS)).strftime(
+            "%Y-%m-%d %H:%M:%S")
 
-    etl = ETL()
+    print("-----")
+    if incremental:
+        print(f'RUNNING INCREMENTAL ETL PIPELINE of reports changed since {start_date}')
+    else:
+        print(f'RUNNING ETL PIPELINE from {start_date} to {end_date}')
+    if sample is not None:
+        print(f'SAMPLING {sample:.1%} of crash reports, tables are saved to {Config.OUTPUT_DIR} instead of dwh')
+
+    checkpoint = None
+    if Config.CHECKPOINTS or resume:
+        checkpoint = RunCheckpoint(start_date, end_date, variant=None if sample is None else f"sample{sample}")
+        if not resume:
+            checkpoint.clear()
+
+    etl = ETL(checkpoint=checkpoint, pool=pool, dimension_keys=dimension_keys, sample=sample, engine=engine,
+              source_cache=source_cache)
+    completed = etl.restore_checkpoint() if resume else []
+
+    if Config.PIPELINED_LOAD:
+        etl.start_loader()
+        # tables restored from checkpoint are queued again, the ones loaded in previous attempt are skipped
+        restored = [name for phase in completed for name in PHASE_OUTPUTS[phase]]
+        for name, table_name in FINAL_TABLES.items():
+            if name in restored and expects_table(table_name):
+                etl.publish(getattr(etl, name), table_name)
+
+    phases = [('extraction', 'extract',
+               lambda: etl.extract_data(start_date, end_date, watermarks if incremental else None,
+                                        weather_start=weather_start)),
+              ('transform', 'transform', etl.transform_data),
+              ('joining', 'join', etl.join_data)]
+    if Config.AGGREGATES and sample is None:
+        phases.append(('aggregation', 'aggregate', etl.aggregate_data))
 
     try:
-        etl.extract_data(start_date, end_date)
-    except (Exception, ) as e:
-        print("Error ocurred during extraction phase, aborting...", e)
-        return
+        finished = []
+        for label, phase, run_phase in phases:
+            if phase in completed:
+                print("-----")
+                print(f"Skipping {label} phase, outputs restored from checkpoint")
+                finished.append(phase)
+                continue
+            phase_start = perf_counter()
+            try:
+                run_phase()
+            except (Exception, ) as e:
+                print(f"Error ocurred during {label} phase, aborting...", e)
+                return False
+            timings[phase] = perf_counter() - phase_start
+            if incremental and etl.window() is None:
+                print("Nothing to update, finishing...")
+                return False
+            etl.save_checkpoint(phase)
+            finished.append(phase)
+            etl.enforce_memory_budget(finished)
+
+        if incremental:
+            start_date, end_date = etl.window()
+            # late corrections of old reports do not move the end of loaded data backwards
+            end_date = max(end_date, last_end_date)
+            watermarks = etl.updated_watermarks()
 
-    try:
-        etl.transform_data()
-    except (Exception, ) as e:
-        print("Error ocurred during transform phase, aborting...", e)
-        return
+        try:
+            consistent = etl.check_integrity()
+        except (Exception, ) as e:
+            print("Error ocurred during integrity check phase, aborting...", e)
+            return False
 
-    try:
-        etl.join_data()
-    except (Exception, ) as e:
-        print("Error ocurred during joining phase, aborting...", e)
-        return
+        if Config.STRICT_INTEGRITY and not consistent:
+            print("Orphaned foreign keys found, aborting...")
+            return False
 
-    # otherwise it cannot be merged (no access to all location and vehicles data)
-    if Config.DWH_INITIALIZATION:
+        load_start = perf_counter()
         try:
-            etl.merge_data()
-        except (Exception,):
-            pass
+            results = etl.load_data()
+            not_loaded = [table_name for table_name, loaded in results.items() if not loaded]
+            if not_loaded:
+                print(f"Tables {not_loaded} were not loaded, rerun with resume=True to retry them, aborting...")
+                return False
+            quarantined = {table_name: stats.rejected for table_name, stats in results.items()
+                           if isinstance(stats, LoadStats) and stats.rejected}
+            if quarantined:
+                print(f"WARNING: rows rejected by dwh were quarantined to {Config.QUARANTINE_DIR}: {quarantined}")
+
+            if sample is not None:
+                # sampled windows are incomplete and were not loaded, next regular update has to process them
+                print("Sampled run, Metadata not updated")
+            elif not etl.is_loaded('Metadata'):
+                update_data = pd.DataFrame({
+                    'LastUpdate': datetime.now(),
+                    'StartDate': start_date,
+                    'EndDate': end_date,
+                    'UpdateMessage': message
+                }, index=[0])
+                if watermarks is not None:
+                    # windowed runs keep previous watermarks, late changes of other months are left for incremental runs
+                    for dataset, column in WATERMARK_COLUMNS.items():
+                        update_data[column] = watermarks[dataset]
+                if window_rows is not None:
+                    update_data['WindowRows'] = window_rows
+                update_data['QuarantinedRows'] = sum(quarantined.values())
+                if not load_data_to_dwh(update_data, 'Metadata', skip_duplicates=False, pool=pool, quarantine=False):
+                    print("Metadata was not updated, rerun with resume=True to retry, aborting...")
+                    return False
+                etl.mark_loaded('Metadata')
 
-    try:
-        etl.load_data()
+        except (Exception, ) as e:
+            print("Error ocurred during load phase, aborting...", e)
+            return False
+        timings['load'] = perf_counter() - load_start
 
-        update_data = pd.DataFrame({
-            'LastUpdate': datetime.now(),
-            'StartDate': start_date,
-            'EndDate': end_date,
-            'UpdateMessage': message
-        }, index=[0])
-        load_data_to_dwh(update_data, 'Metadata', skip_duplicates=False)
+        etl.remember_keys()
+    finally:
+        etl.stop_loader()
+        etl.release_spilled()
 
-    except (Exception, ) as e:
-        print("Error ocurred during load phase, aborting...", e)
-        return
+    if checkpoint is not None:
+        checkpoint.clear()
 
+    timings['total'] = perf_counter() - run_start
+    print(f"Run finished in {timings['total']:.1f}s")
     green = '\033[92m'
     print(f"{green}ETL PROCESS FINISHED WITH SUCCESS{green}")
+    return True
+
+
+def backfill_pipeline(start_date, end_date, message='backfill', **kwargs):
+    """
+    runs ETL pipeline over a long interval in consecutive planned windows, stops at the first failed window
+
+    Args:
+        start_date (str): start of the interval in "YYYY-MM-DD HH:MM:SS" format
+        end_date (str): end of the interval in "YYYY-MM-DD HH:MM:SS" format
+        message (str): update message saved in Metadata of every window
+        kwargs: further arguments of etl_pipeline, e.g. resume, pool or sample
+
+    Returns:
+        bool: if all windows finished with success
+    """
+    start = datetime.strptime(start_date, "%Y-%m-%d %H:%M:%S")
+    limit = datetime.strptime(end_date, "%Y-%m-%d %H:%M:%S")
+    while True:
+        planned = plan_next_window(start, limit)
+        if planned is None:
+            return True
+        window_end, window_rows = planned
+        if not etl_pipeline(start.strftime("%Y-%m-%d %H:%M:%S"), window_end, message=message,
+                            window_rows=window_rows, **kwargs):
+            print(f"Backfill stopped at window starting {start}")
+            return False
+        start = datetime.strptime(window_end, "%Y-%m-%d %H:%M:%S") + timedelta(hours=1)
 
 
 if __name__ == "__main__":
-    # etl_pipeline('2017-01-01 00:00:00', '2017-12-31 23:00:00', message='custom update')
+    # backfill_pipeline('2017-01-01 00:00:00', '2017-12-31 23:00:00')
     etl_pipeline()
@@ -0,0 +1,129 @@
+from collections import Counter, defaultdict
+from difflib import SequenceMatcher
+
+from utils import Static
+from config import Config
+
+
+def trigrams(text):
+    """ returns set of character trigrams of text padded with spaces, so short words have trigrams too """
+    padded = f'  {text} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class TrigramIndex:
+    """
+    Fuzzy matching index of strings. Choices sharing most trigrams with the query are scored first with
+    difflib ratio, in compatible mode remaining choices are scored only if their length and character
+    bounds can still beat the best score, so matches are the same as difflib.get_close_matches with n=1.
+    """
+
+    def __init__(self, choices):
+        """
+        Args:
+            choices (list): matched strings, matching is case insensitive and the first original of each
+                lowercase choice is returned
+        """
+        self.originals = {}
+        for choice in choices:
+            self.originals.setdefault(choice.lower(), choice)
+        self.choices = list(self.originals)
+        self.counts = [Counter(choice) for choice in self.choices]
+        self.postings = defaultdict(list)
+        for position, choice in enumerate(self.choices):
+            for gram in trigrams(choice):
+                self.postings[gram].append(position)
+
+    def candidates(self, query):
+        """ returns positions of choices sharing a trigram with query, most shared trigrams first """
+        overlap = Counter()
+        for gram in trigrams(query):
+            overlap.update(self.postings.get(gram, []))
+        return [position for position, _ in overlap.most_common()]
+
+    def match(self, query, cutoff, compatible=None):
+        """
+        Find the closest choice to query.
+
+        Args:
+            query (str): matched string
+            cutoff (float): minimal difflib ratio of accepted match
+            compatible (bool): if all choices which could beat the best candidate are scored,
+                defaults to Config.FUZZY_COMPATIBLE
+
+        Returns:
+            str: original choice, None if no choice reaches cutoff
+        """
+        compatible = Config.FUZZY_COMPATIBLE if compatible is None else compatible
+        query = query.lower()
+        matcher = SequenceMatcher()
+        matcher.set_seq2(query)
+        best = None
+
+        def score(position):
+            nonlocal best
+            choice = self.choices[position]
+            matcher.set_seq1(choice)
+            ratio = matcher.ratio()
+            # ties are resolved like difflib, by the greater string
+            if ratio >= cutoff and (best is None or (ratio, choice) > best):
+                best = (ratio, choice)
+
+        shortlist = self.candidates(query)
+        for position in shortlist:
+            score(position)
+
+        if compatible:
+            query_counts = Counter(query)
+            scored = set(shortlist)
+            for position, choice in enumerate(self.choices):
+                if position in scored:
+                    continue
+                threshold = cutoff if best is None else best[0]
+                total = len(choice) + len(query)
+                # same upper bounds as SequenceMatcher.real_quick_ratio and quick_ratio
+                if 2.0 * min(len(choice), len(query)) / total < threshold:
+                    continue
+                if 2.0 * sum((self.counts[position] & query_counts).values()) / total < threshold:
+                    continue
+                score(position)
+
+        return None if best is None else self.originals[best[1]]
+
+
+class MapperIndexes:
+    """ trigram indexes of Static brands and models mappers, rebuilt when the mappers are reloaded """
+
+    def __init__(self):
+        self.brands_source = None
+        self.brands_index = None
+        self.models_source = None
+        self.models_indexes = {}
+
+    def clear(self):
+        """ drops built indexes, they are built again on next use """
+        self.__init__()
+
+    def brands(self):
+        """ returns index of fueleconomy brands """
+        if self.brands_source is not Static.BRANDS_DICT:
+            self.brands_index = TrigramIndex(list(Static.BRANDS_DICT.values()))
+            self.brands_source = Static.BRANDS_DICT
+        return self.brands_index
+
+    def models(self, year, make, models_dict=None):
+        """
+        returns index of fueleconomy models of given year and make, raises KeyError if there are none,
+        models_dict replaces Static.MODELS_DICT
+        """
+        models_dict = Static.MODELS_DICT if models_dict is None else models_dict
+        if self.models_source is not models_dict:
+            self.models_indexes = {}
+            self.models_source = models_dict
+        if (year, make) not in self.models_indexes:
+            self.models_indexes[(year, make)] = TrigramIndex(models_dict[(year, make)])
+        return self.models_indexes[(year, make)]
+
+
+MAPPER_INDEXES = MapperIndexes()
+""" indexes of Static mappers shared by all mappings of the process """
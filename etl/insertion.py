@@ -1,51 +1,582 @@
-import pyodbc
+import importlib.util
+import os
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+import numpy as np
 import pandas as pd
 
+from schema import STAR_SCHEMA, generate_create_statements, generate_sqlserver_migration
 from config import Config
 
 
-def load_data_to_dwh(table, table_name, skip_duplicates=True):
+class DWHBackend:
+    """ base class of data warehouse backends, statements use DB-API qmark parameters """
 
-    conn = connect_to_db()
-    if conn is None:
-        return False
+    def begin(self, conn):
+        """ starts transaction, DB-API drivers open one implicitly """
+        pass
+
+    def cursor(self, conn):
+        """ returns cursor executing statements within the transaction of the connection """
+        return conn.cursor()
+
+    def release(self, cursor):
+        cursor.close()
 
-    cursor = conn.cursor()
-    query = generate_insertion_query(table_name, table.columns, skip_duplicates=skip_duplicates)
+    def is_row_error(self, error):
+        """ if error was caused by values of written rows, other errors come from connection or dwh and abort loads """
+        return isinstance(error, (TypeError, ValueError))
 
-    for index, row in table.iterrows():
+    def is_alive(self, conn):
+        """ if connection still answers queries, servers drop connections idle for too long """
         try:
-            values = generate_cursor_values(row, table.columns)
-            cursor.execute(query, values)
-        except Exception as e:
-            print("An error occurred:", e)
-            print(row)
+            cursor = self.cursor(conn)
+            cursor.execute("SELECT 1")
+            cursor.fetchall()
+            self.release(cursor)
+            return True
+        except (Exception, ):
+            return False
+
+    def migration_statements(self):
+        """ returns statements adding columns and tables missing from an existing dwh """
+        return []
+
+    def fetch_row_hashes(self, conn, table_name, key_column, keys, batch_size=500):
+        """ returns stored RowHash of rows with given keys, queried in batches within parameter limits """
+        cursor = self.cursor(conn)
+        rows = []
+        for i in range(0, len(keys), batch_size):
+            batch = keys[i:i + batch_size]
+            placeholders = ", ".join(["?"] * len(batch))
+            cursor.execute(f"select {key_column}, RowHash from {table_name} where {key_column} in ({placeholders})",
+                           batch)
+            rows += cursor.fetchall()
+        self.release(cursor)
+        return pd.DataFrame.from_records([tuple(row) for row in rows], columns=[key_column, 'RowHash'])
+
+    def delete_partitions(self, conn, table_name, partition_column, partitions, batch_size=500):
+        """ deletes rows of given partitions in batches within parameter limits """
+        cursor = self.cursor(conn)
+        for i in range(0, len(partitions), batch_size):
+            batch = partitions[i:i + batch_size]
+            placeholders = ", ".join(["?"] * len(batch))
+            cursor.execute(f"DELETE FROM {table_name} WHERE {partition_column} IN ({placeholders})", batch)
+        self.release(cursor)
+
+    def update_table(self, conn, table, table_name, key_columns):
+        """ updates all non-key columns of rows with matching keys in a single batch """
+        columns = [col for col in table.columns if col not in key_columns]
+        assignments = ", ".join(f"{col} = ?" for col in columns)
+        conditions = " AND ".join(f"{col} = ?" for col in key_columns)
+        cursor = self.cursor(conn)
+        cursor.executemany(f"UPDATE {table_name} SET {assignments} WHERE {conditions}",
+                           generate_table_values(table[columns + key_columns]))
+        self.release(cursor)
+        return True
+
+
+class SqlServerBackend(DWHBackend):
+    """ SQL Server data warehouse accessed through pyodbc """
+
+    name = 'sqlserver'
+
+    def connect(self):
+        import pyodbc
+
+        connection_string = f"""
+            DRIVER={{{Config.DRIVER_NAME}}};
+            SERVER={{{Config.SERVER_NAME}}};
+            DATABASE={{{Config.DATABASE_NAME}}};
+            Trust_Connection=yes;
+            uid={{{Config.DWH_USER}}};
+            pwd={{{Config.DWH_PASSWORD}}};
+        """
+        return pyodbc.connect(connection_string)
+
+    def describe(self):
+        return f'{Config.DATABASE_NAME}@{Config.SERVER_NAME}'
+
+    def is_row_error(self, error):
+        import pyodbc
+
+        return isinstance(error, (pyodbc.IntegrityError, pyodbc.DataError)) or super().is_row_error(error)
+
+    def migration_statements(self):
+        # embedded backends create the current star schema on connection
+        return generate_sqlserver_migration()
+
+    def insert_table(self, conn, table, table_name, skip_duplicates=True):
+        cursor = conn.cursor()
+        query = generate_insertion_query(table_name, table.columns, skip_duplicates=skip_duplicates)
+
+        try:
+            for index, row in table.iterrows():
+                values = generate_cursor_values(row, table.columns)
+                cursor.execute(query, values)
+        finally:
             cursor.close()
+        return True
+
+    def last_update_query(self, columns):
+        # consecutive micro-batches may finish within the same second
+        return f""" select top 1 {', '.join(columns)} from Metadata
+            order by LastUpdate DESC, EndDate DESC """
+
+
+class SQLiteBackend(DWHBackend):
+    """ embedded SQLite data warehouse in a local file, star schema is created on first connection """
+
+    name = 'sqlite'
+
+    def connect(self):
+        if os.path.dirname(Config.DWH_PATH):
+            os.makedirs(os.path.dirname(Config.DWH_PATH), exist_ok=True)
+        # pooled connections are handed over between loader threads
+        conn = sqlite3.connect(Config.DWH_PATH, timeout=60, check_same_thread=False)
+        for statement in generate_create_statements():
+            conn.execute(statement)
+        conn.commit()
+        return conn
+
+    def describe(self):
+        return f'{Config.DWH_PATH} ({self.name})'
+
+    def is_row_error(self, error):
+        # values which cannot be bound as parameters raise ProgrammingError or InterfaceError
+        return isinstance(error, (sqlite3.IntegrityError, sqlite3.DataError, sqlite3.ProgrammingError,
+                                  sqlite3.InterfaceError)) or super().is_row_error(error)
+
+    def insert_table(self, conn, table, table_name, skip_duplicates=True):
+        columns = ", ".join(table.columns)
+        placeholders = ", ".join(["?"] * len(table.columns))
+        conflict = "OR IGNORE " if skip_duplicates else ""
+        query = f"INSERT {conflict}INTO {table_name} ({columns}) VALUES ({placeholders})"
+        conn.executemany(query, generate_table_values(table))
+        return True
+
+    def last_update_query(self, columns):
+        return f""" select {', '.join(columns)} from Metadata
+            order by LastUpdate DESC, EndDate DESC limit 1 """
+
+
+class DuckDBBackend(SQLiteBackend):
+    """ embedded DuckDB data warehouse in a local file, tables are appended from registered DataFrames """
+
+    name = 'duckdb'
+
+    def connect(self):
+        import duckdb
+
+        if os.path.dirname(Config.DWH_PATH):
+            os.makedirs(os.path.dirname(Config.DWH_PATH), exist_ok=True)
+        conn = duckdb.connect(Config.DWH_PATH)
+        for statement in generate_create_statements():
+            conn.execute(statement)
+        return conn
+
+    def begin(self, conn):
+        # duckdb runs in autocommit mode unless transaction is started explicitly
+        conn.begin()
+
+    def cursor(self, conn):
+        # duckdb cursors are duplicate connections with own transactions
+        return conn
+
+    def release(self, cursor):
+        pass
+
+    def is_row_error(self, error):
+        import duckdb
+
+        return isinstance(error, (duckdb.IntegrityError, duckdb.DataError, duckdb.InvalidInputException)) or \
+            DWHBackend.is_row_error(self, error)
+
+    def insert_table(self, conn, table, table_name, skip_duplicates=True):
+        columns = ", ".join(table.columns)
+        # duckdb rejects OR IGNORE on tables without primary key
+        conflict = "OR IGNORE " if skip_duplicates and STAR_SCHEMA[table_name]['primary_key'] else ""
+        conn.register('insert_frame', table)
+        try:
+            conn.execute(f"INSERT {conflict}INTO {table_name} ({columns}) SELECT {columns} FROM insert_frame")
+        finally:
+            conn.unregister('insert_frame')
+        return True
+
+
+WATERMARK_COLUMNS = {
+    'incidents': 'IncidentsWatermark',
+    'drivers': 'DriversWatermark',
+    'non-motorists': 'NonMotoristsWatermark'
+}
+""" Metadata columns storing portal ':updated_at' watermark of every crash dataset """
+
+BACKENDS = {
+    'sqlserver': SqlServerBackend,
+    'sqlite': SQLiteBackend,
+    'duckdb': DuckDBBackend
+}
+""" available data warehouse backends """
+
+
+def get_backend(name=None):
+    """ returns data warehouse backend, defaults to Config.DWH_BACKEND """
+    name = Config.DWH_BACKEND if name is None else name
+    if name == 'duckdb' and importlib.util.find_spec('duckdb') is None:
+        raise ImportError("duckdb dwh backend needs optional duckdb package, install it with 'pip install duckdb'")
+    return BACKENDS[name]()
+
+
+class ConnectionPool:
+    """ keeps open dwh connections for reuse, every concurrent load holds its own connection """
+
+    def __init__(self, size=None, backend=None):
+        """
+        Args:
+            size (int): maximal number of connections in use at once, defaults to Config.LOAD_WORKERS
+            backend: data warehouse backend, defaults to Config.DWH_BACKEND
+        """
+        self.backend = get_backend() if backend is None else backend
+        self.size = Config.LOAD_WORKERS if size is None else size
+        self.idle = queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(max(1, self.size))
+
+    @contextmanager
+    def connection(self):
+        """ yields idle or newly opened connection, None if dwh is unreachable, dead idle connections are replaced """
+        with self.slots:
+            conn = self.checkout()
+            try:
+                yield conn
+            finally:
+                if conn is not None:
+                    self.idle.put(conn)
+
+    def checkout(self):
+        """ returns idle connection still alive, new connection is opened if there is none """
+        while True:
+            try:
+                conn = self.idle.get_nowait()
+            except queue.Empty:
+                return connect_to_db(self.backend)
+            if self.backend.is_alive(conn):
+                return conn
+            print(f"WARNING: pooled connection to {self.backend.describe()} was dropped, reconnecting")
+            try:
+                conn.close()
+            except (Exception, ):
+                pass
+
+    def close(self):
+        while not self.idle.empty():
+            self.idle.get_nowait().close()
+
+
+def run_on_dwh(operation, pool=None):
+    """
+    Runs operation on pooled or newly opened connection.
+
+    Args:
+        operation (callable): called with (backend, conn), conn is None if dwh is unreachable
+        pool (ConnectionPool): pool to borrow connection from, new connection is opened and closed if None
+
+    Returns:
+        result of the operation
+    """
+    if pool is not None:
+        with pool.connection() as conn:
+            return operation(pool.backend, conn)
+
+    backend = get_backend()
+    conn = connect_to_db(backend)
+    try:
+        return operation(backend, conn)
+    finally:
+        if conn is not None:
             conn.close()
-            return False
 
-    conn.commit()
-    cursor.close()
-    conn.close()
-    print(f"{table_name}: data loaded succesfully")
-    return True
 
+class LoadStats:
+    """ outcome of a table load, truthy if the table was committed """
+
+    def __init__(self, table_name, rows=0):
+        self.table_name = table_name
+        self.rows = rows
+        self.inserted = 0
+        self.updated = 0
+        self.rejected = 0
+        self.rejected_rows = []
+        self.quarantine_path = None
+        self.completed = False
+
+    def __bool__(self):
+        return self.completed
 
-def connect_to_db():
-    connection_string = f"""
-        DRIVER={{{Config.DRIVER_NAME}}};
-        SERVER={{{Config.SERVER_NAME}}};
-        DATABASE={{{Config.DATABASE_NAME}}};
-        Trust_Connection=yes;
-        uid={{{Config.DWH_USER}}};
-        pwd={{{Config.DWH_PASSWORD}}};
+    def __repr__(self):
+        return (f"{self.table_name}: {self.inserted} rows inserted, {self.updated} updated, "
+                f"{self.rejected} quarantined of {self.rows}")
+
+    def reject(self, rows, error):
+        """ records rows rejected by dwh with the error """
+        self.rejected_rows.append(rows.assign(QuarantineError=str(error)))
+        self.rejected += len(rows)
+
+    def quarantine(self, directory=None):
+        """ appends rejected rows to local quarantine file of the table, returns its path """
+        if not self.rejected_rows:
+            return None
+        directory = Config.QUARANTINE_DIR if directory is None else directory
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"{self.table_name}.csv")
+        rows = pd.concat(self.rejected_rows).assign(QuarantinedAt=pd.Timestamp.now())
+        rows.to_csv(path, mode='a', header=not os.path.exists(path), index=False)
+        self.rejected_rows = []
+        self.quarantine_path = path
+        print(f"WARNING: {self.table_name}: {self.rejected} rows rejected by dwh, quarantined to {path}")
+        return path
+
+
+def write_in_batches(backend, conn, table, write, stats, batch_size=None, max_rejected=None):
+    """
+    Writes table in separately committed batches, batch failed on values of its rows is rolled back and bisected
+    until the failing rows are isolated and rejected. Connection and dwh errors abort writing without rejecting rows.
+
+    Args:
+        backend: data warehouse backend
+        conn: open connection
+        table (DataFrame): written rows
+        write (callable): called with (conn, batch), returns if batch was written
+        stats (LoadStats): load statistics receiving rejected rows
+        batch_size (int): rows per batch, defaults to Config.LOAD_BATCH_SIZE
+        max_rejected (int): rejected rows above which writing stops, defaults to Config.QUARANTINE_MAX_ROWS
+
+    Returns:
+        tuple: number of written rows and if all rows were either written or rejected
     """
+    batch_size = Config.LOAD_BATCH_SIZE if batch_size is None else batch_size
+    max_rejected = Config.QUARANTINE_MAX_ROWS if max_rejected is None else max_rejected
+
+    # stack of pending batches, halves of failed batch are retried first
+    pending = [table.iloc[i:i + batch_size] for i in range(0, len(table), batch_size)][::-1]
+    written = 0
+    while pending:
+        batch = pending.pop()
+        try:
+            backend.begin(conn)
+            if not write(conn, batch):
+                raise RuntimeError("batch was not written")
+            conn.commit()
+            written += len(batch)
+        except Exception as e:
+            try:
+                conn.rollback()
+            except Exception as rollback_error:
+                print(f"{stats.table_name}: batch not rolled back, aborting load...", rollback_error)
+                return written, False
+            if not backend.is_row_error(e):
+                print(f"{stats.table_name}: batch not written, aborting load...", e)
+                return written, False
+            if len(batch) > 1:
+                half = len(batch) // 2
+                pending += [batch.iloc[half:], batch.iloc[:half]]
+                continue
+            stats.reject(batch, e)
+            if stats.rejected > max_rejected:
+                print(f"{stats.table_name}: more than {max_rejected} rows rejected, aborting load...", e)
+                return written, False
+    return written, True
 
+
+def load_data_to_dwh(table, table_name, skip_duplicates=True, pool=None, quarantine=None):
+    """
+    Inserts table into dwh.
+
+    Args:
+        table (DataFrame): inserted rows
+        table_name (str): name of table
+        skip_duplicates (bool): if rows with already stored primary key are skipped
+        pool (ConnectionPool): pool to borrow connection from, new connection is opened if None
+        quarantine (bool): if rows rejected by dwh are quarantined while other rows are committed,
+            defaults to Config.LOAD_QUARANTINE, otherwise table is inserted in single transaction
+
+    Returns:
+        LoadStats: load statistics, truthy if table was loaded
+    """
+    quarantine = Config.LOAD_QUARANTINE if quarantine is None else quarantine
+    return run_on_dwh(lambda backend, conn: insert_table(backend, conn, table, table_name,
+                                                         skip_duplicates=skip_duplicates, quarantine=quarantine),
+                      pool)
+
+
+def insert_table(backend, conn, table, table_name, skip_duplicates=True, quarantine=False):
+    """ inserts table on open connection, commits on success and rolls back otherwise """
+    stats = LoadStats(table_name, len(table))
+    if conn is None:
+        return stats
+
+    if quarantine:
+        stats.inserted, stats.completed = write_in_batches(
+            backend, conn, table,
+            lambda conn, batch: backend.insert_table(conn, batch, table_name, skip_duplicates=skip_duplicates),
+            stats)
+        stats.quarantine()
+        if stats.completed:
+            print(f"{table_name}: data loaded succesfully")
+        return stats
+
+    try:
+        backend.begin(conn)
+        loaded = backend.insert_table(conn, table, table_name, skip_duplicates=skip_duplicates)
+    except Exception as e:
+        print("An error occurred:", e)
+        loaded = False
+
+    if loaded:
+        conn.commit()
+        print(f"{table_name}: data loaded succesfully")
+        stats.inserted, stats.completed = len(table), True
+    else:
+        conn.rollback()
+    return stats
+
+
+def canonical_value(value):
+    """ formats value independent of its dtype, booleans and integral numbers as integers, missing values empty """
+    if value is None or value is pd.NA or value is pd.NaT or (isinstance(value, float) and value != value):
+        return ''
+    if isinstance(value, (bool, np.bool_)):
+        return str(int(value))
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def add_row_hash(table):
+    """
+    returns copy of table with RowHash column, 64-bit hash of row values used to detect changed rows,
+    values are formatted canonically so that rows hash the same after their column dtypes drift
+    """
+    values = table.drop(columns=['RowHash'], errors='ignore')
+    # integer columns without missing values are formatted at once
+    values = pd.DataFrame({column: data.astype(str) if pd.api.types.is_integer_dtype(data) and not data.hasnans
+                           else data.map(canonical_value) for column, data in values.items()})
+    hashes = pd.util.hash_pandas_object(values, index=False).values.view('int64')
+    return table.assign(RowHash=hashes)
+
+
+def upsert_data_to_dwh(table, table_name, pool=None, quarantine=None):
+    """
+    Loads table with RowHash column, new rows are inserted, rows with changed RowHash are updated
+    and unchanged rows are skipped.
+
+    Args:
+        table (DataFrame): table with RowHash column
+        table_name (str): name of table with single column primary key
+        pool (ConnectionPool): pool to borrow connection from, new connection is opened if None
+        quarantine (bool): if rows rejected by dwh are quarantined while other rows are committed,
+            defaults to Config.LOAD_QUARANTINE
+
+    Returns:
+        LoadStats: load statistics, truthy if table was loaded
+    """
+    quarantine = Config.LOAD_QUARANTINE if quarantine is None else quarantine
+    return run_on_dwh(lambda backend, conn: upsert_table(backend, conn, table, table_name, quarantine=quarantine),
+                      pool)
+
+
+def upsert_table(backend, conn, table, table_name, quarantine=False):
+    """ upserts table on open connection, commits on success and rolls back otherwise """
+    stats = LoadStats(table_name, len(table))
+    if conn is None:
+        return stats
+
+    key_column, = STAR_SCHEMA[table_name]['primary_key']
     try:
-        conn = pyodbc.connect(connection_string)
-        print(f'Connection to {Config.DATABASE_NAME}@{Config.SERVER_NAME} succesful:', conn)
+        backend.begin(conn)
+        stored = backend.fetch_row_hashes(conn, table_name, key_column, table[key_column].tolist())
+        merged = table.merge(stored, on=key_column, how='left', suffixes=('', 'Stored'), indicator=True)
+        new_rows = merged.loc[merged['_merge'] == 'left_only', table.columns]
+        changed_rows = merged.loc[(merged['_merge'] == 'both') & (merged['RowHash'] != merged['RowHashStored']),
+                                  table.columns]
+
+        loaded = True
+        if quarantine:
+            # rows are written in own transactions below
+            conn.rollback()
+        else:
+            if len(new_rows):
+                loaded = backend.insert_table(conn, new_rows, table_name)
+            if loaded and len(changed_rows):
+                loaded = backend.update_table(conn, changed_rows, table_name, [key_column])
     except Exception as e:
-        print(f'Could not connect to {Config.DATABASE_NAME}@{Config.SERVER_NAME}:', e)
+        print("An error occurred:", e)
+        loaded = False
+
+    if loaded and quarantine:
+        stats.inserted, loaded = write_in_batches(
+            backend, conn, new_rows, lambda conn, batch: backend.insert_table(conn, batch, table_name), stats)
+        if loaded:
+            stats.updated, loaded = write_in_batches(
+                backend, conn, changed_rows,
+                lambda conn, batch: backend.update_table(conn, batch, table_name, [key_column]), stats)
+        stats.quarantine()
+    elif loaded:
+        conn.commit()
+        stats.inserted, stats.updated = len(new_rows), len(changed_rows)
+    else:
+        conn.rollback()
+
+    if loaded:
+        print(f"{table_name}: {stats.inserted} rows inserted, {stats.updated} updated, "
+              f"{len(table) - len(new_rows) - len(changed_rows)} unchanged")
+    stats.completed = loaded
+    return stats
+
+
+def migrate_dwh(pool=None):
+    """
+    Adds columns and tables of the star schema missing from an existing dwh in single transaction,
+    statements skip existing columns and tables.
+
+    Args:
+        pool (ConnectionPool): pool to borrow connection from, new connection is opened if None
+
+    Returns:
+        bool: if dwh has the current star schema
+    """
+    def migrate(backend, conn):
+        if conn is None:
+            return False
+        try:
+            backend.begin(conn)
+            cursor = backend.cursor(conn)
+            for statement in backend.migration_statements():
+                cursor.execute(statement)
+            backend.release(cursor)
+            conn.commit()
+        except Exception as e:
+            print("Could not migrate dwh schema:", e)
+            conn.rollback()
+            return False
+        return True
+
+    backend = get_backend() if pool is None else pool.backend
+    if not backend.migration_statements():
+        return True
+    return run_on_dwh(migrate, pool)
+
+
+def connect_to_db(backend=None):
+    backend = get_backend() if backend is None else backend
+
+    try:
+        conn = backend.connect()
+        print(f'Connection to {backend.describe()} succesful:', conn)
+    except Exception as e:
+        print(f'Could not connect to {backend.describe()}:', e)
         return None
 
     return conn
@@ -82,21 +613,131 @@ def generate_cursor_values(row, columns):
     return values
 
 
-def check_last_update():
-    conn = connect_to_db()
+def generate_table_values(table):
+    """ converts table to rows of python values accepted by embedded databases, timestamps as iso strings """
+    table = table.copy()
+    for col in table.columns:
+        if pd.api.types.is_datetime64_any_dtype(table[col]):
+            table[col] = table[col].dt.strftime('%Y-%m-%d %H:%M:%S')
+    table = table.astype(object).where(table.notna(), None)
+    return list(table.itertuples(index=False, name=None))
+
+
+def replace_partitions_in_dwh(table, table_name, partition_column, pool=None):
+    """
+    Replaces partitions of table present in given data, rows of other partitions are kept.
+
+    Args:
+        table (DataFrame): complete content of replaced partitions
+        table_name (str): name of table
+        partition_column (str): column identifying partitions
+        pool (ConnectionPool): pool to borrow connection from, new connection is opened if None
+
+    Returns:
+        LoadStats: load statistics, truthy if partitions were replaced
+    """
+    return run_on_dwh(lambda backend, conn: replace_partitions(backend, conn, table, table_name, partition_column),
+                      pool)
+
+
+def replace_partitions(backend, conn, table, table_name, partition_column):
+    """ deletes and inserts partitions in single transaction on open connection """
+    stats = LoadStats(table_name, len(table))
     if conn is None:
-        pass
+        return stats
 
-    query = """ select top 1 EndDate from Metadata
-            order by LastUpdate DESC """
+    partitions = sorted(table[partition_column].unique().tolist())
+    try:
+        backend.begin(conn)
+        backend.delete_partitions(conn, table_name, partition_column, partitions)
+        loaded = backend.insert_table(conn, table, table_name, skip_duplicates=False)
+    except Exception as e:
+        print("An error occurred:", e)
+        loaded = False
+
+    if loaded:
+        conn.commit()
+        print(f"{table_name}: {len(partitions)} partitions replaced")
+        stats.inserted, stats.completed = len(table), True
+    else:
+        conn.rollback()
+    return stats
+
+
+def fetch_rows_in_ranges(table_name, columns, range_column, ranges, batch_size=200, pool=None):
+    """
+    Fetches rows of a table already loaded into dwh with values of range column in any of given ranges.
+
+    Args:
+        table_name (str): name of table
+        columns (list): fetched columns
+        range_column (str): filtered column
+        ranges (list): inclusive (low, high) bounds
+        batch_size (int): number of ranges per query
+        pool (ConnectionPool): pool to borrow connection from, new connection is opened if None
+
+    Returns:
+        DataFrame: fetched rows, None if dwh is unreachable
+    """
+    def fetch(backend, conn):
+        if conn is None:
+            return None
+        cursor = conn.cursor()
+        rows = []
+        for i in range(0, len(ranges), batch_size):
+            batch = ranges[i:i + batch_size]
+            conditions = " OR ".join([f"{range_column} BETWEEN ? AND ?"] * len(batch))
+            cursor.execute(f"select {', '.join(columns)} from {table_name} where {conditions}",
+                           [bound for bounds in batch for bound in bounds])
+            rows += cursor.fetchall()
+        cursor.close()
+        return pd.DataFrame.from_records([tuple(row) for row in rows], columns=columns)
+
+    return run_on_dwh(fetch, pool=pool)
+
+
+def fetch_last_update(columns, pool=None):
+    """ returns values of given Metadata columns saved with the latest update, on pooled connection if pool is given """
+    def fetch(backend, conn):
+        if conn is None:
+            raise ConnectionError(f"could not connect to {backend.describe()}")
+        cursor = conn.cursor()
+        cursor.execute(backend.last_update_query(columns))
+        rows = cursor.fetchall()
+        cursor.close()
+        return rows[0]
+
+    return run_on_dwh(fetch, pool=pool)
+
+
+def check_last_update(pool=None):
+    end_date = fetch_last_update(['EndDate'], pool=pool)[0]
+    # embedded backends may return dates as strings
+    return pd.Timestamp(end_date).to_pydatetime()
+
+
+def check_watermarks(pool=None):
+    """
+    returns portal ':updated_at' watermark of every crash dataset saved with the latest update, datasets without
+    watermark fall back to time of that update moved back by Config.WATERMARK_LAG_HOURS
+    """
+    values = fetch_last_update(['LastUpdate'] + list(WATERMARK_COLUMNS.values()), pool=pool)
+    last_update, watermarks = pd.Timestamp(values[0]), values[1:]
 
-    cursor = conn.cursor()
-    cursor.execute(query)
+    fallback = last_update - pd.Timedelta(hours=Config.WATERMARK_LAG_HOURS)
+    return {dataset: (fallback if pd.isna(watermark) else pd.Timestamp(watermark)).to_pydatetime()
+            for dataset, watermark in zip(WATERMARK_COLUMNS, watermarks)}
 
-    rows = cursor.fetchall()
-    end_date = rows[0][0]
 
-    cursor.close()
-    conn.close()
+def fetch_table_keys(table_name, columns, pool=None):
+    """ fetches distinct key values of a table already loaded into dwh, returns None if dwh is unreachable """
+    def fetch(backend, conn):
+        if conn is None:
+            return None
+        cursor = conn.cursor()
+        cursor.execute(f"select distinct {', '.join(columns)} from {table_name}")
+        rows = cursor.fetchall()
+        cursor.close()
+        return pd.DataFrame.from_records([tuple(row) for row in rows], columns=columns)
 
-    return end_date
+    return run_on_dwh(fetch, pool=pool)
@@ -0,0 +1,70 @@
+import pandas as pd
+
+FOREIGN_KEYS = [
+    ('VehicleKey', 'VehicleDim', ['VehicleKey'], ['VehicleKey']),
+    ('RoadKey', 'RoadDim', ['RoadKey'], ['RoadKey']),
+    ('CrossStreetKey', 'RoadDim', ['CrossStreetKey'], ['RoadKey']),
+    ('LocationAreaKey', 'LocationAreaDim', ['LocationAreaKey'], ['LocationAreaKey']),
+    ('WeatherKey', 'WeatherFact', ['LocationAreaKey', 'DateHourKey'], ['LocationAreaKey', 'DateHourKey']),
+    ('DateHourKey', 'DateHourDim', ['DateHourKey'], ['DateHourKey']),
+]
+""" foreign keys of VehicleCrashFact: (name, referenced table, fact columns, referenced columns) """
+
+
+def build_key_index(frames, columns):
+    """
+    Build a hashed index of unique key values from several frames holding the same key columns.
+
+    Args:
+        frames (list): DataFrames containing key columns, e.g. keys from current window and keys already in dwh
+        columns (list): key column names
+
+    Returns:
+        Index: Index (or MultiIndex for composite keys) of unique key values
+    """
+    frames = [frame[columns] for frame in frames if frame is not None and len(frame) > 0]
+    keys = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=columns)
+    if len(columns) == 1:
+        return pd.Index(keys[columns[0]]).unique()
+    return pd.MultiIndex.from_frame(keys[columns]).unique()
+
+
+def find_orphans(fact, fact_columns, key_index):
+    """ returns unique fact key values missing from key index and number of fact rows referencing them """
+    if len(fact_columns) == 1:
+        fact_keys = pd.Index(fact[fact_columns[0]])
+    else:
+        fact_keys = pd.MultiIndex.from_frame(fact[fact_columns])
+    unique_keys = fact_keys.unique()
+    orphan_keys = unique_keys[~unique_keys.isin(key_index)]
+    orphan_rows = int(fact_keys.isin(orphan_keys).sum()) if len(orphan_keys) > 0 else 0
+    return orphan_keys, orphan_rows
+
+
+def check_referential_integrity(fact, dimensions, sample_size=5):
+    """
+    Check every foreign key of the fact table against referenced key sets without materializing joins.
+
+    Args:
+        fact (DataFrame): VehicleCrashFact table
+        dimensions (dict): mapping of referenced table name to list of DataFrames with its key columns
+        sample_size (int): number of orphaned keys reported per foreign key
+
+    Returns:
+        DataFrame: report with number of checked rows, orphaned rows, orphaned keys and sample of orphaned keys
+    """
+    report = []
+    for name, table_name, fact_columns, key_columns in FOREIGN_KEYS:
+        frames = [frame.rename(columns=dict(zip(key_columns, fact_columns)))
+                  for frame in dimensions.get(table_name, [])]
+        key_index = build_key_index(frames, fact_columns)
+        orphan_keys, orphan_rows = find_orphans(fact, fact_columns, key_index)
+        report.append({
+            'ForeignKey': name,
+            'Table': table_name,
+            'Rows': len(fact),
+            'OrphanRows': orphan_rows,
+            'OrphanKeys': len(orphan_keys),
+            'SampleKeys': list(orphan_keys[:sample_size])
+        })
+    return pd.DataFrame(report)
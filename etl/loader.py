@@ -0,0 +1,93 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+
+from config import Config
+
+
+class TableLoader:
+    """
+    Loads finished tables in background worker threads while remaining stages are still computed.
+    Independent tables are loaded concurrently, a table with dependencies starts only after all of them
+    were loaded successfully and is not loaded at all if any of them failed.
+    """
+
+    def __init__(self, load_table, workers=None, dependencies=None):
+        """
+        Args:
+            load_table (callable): function loading a single table, called with (table, table_name)
+            workers (int): maximal number of tables loaded at once, defaults to Config.LOAD_WORKERS
+            dependencies (dict): mapping of table name to names of tables which have to be loaded before it
+        """
+        self.load_table = load_table
+        self.workers = Config.LOAD_WORKERS if workers is None else workers
+        self.dependencies = {} if dependencies is None else dependencies
+        self.pending = {}
+        self.running = 0
+        self.results = {}
+        self.timings = {}
+        self.first_start = None
+        self.last_finish = None
+        self.condition = threading.Condition()
+        self.executor = ThreadPoolExecutor(max_workers=max(1, self.workers), thread_name_prefix='table-loader')
+
+    def submit(self, table, table_name):
+        """ queues table for loading """
+        print(f'{table_name}: queued for loading')
+        with self.condition:
+            self.pending[table_name] = table
+            self._release()
+
+    def close(self):
+        """ waits for all queued tables to be loaded, returns mapping of table name to load result """
+        with self.condition:
+            self.condition.wait_for(lambda: self.running == 0)
+            for table_name in self.pending:
+                missing = [name for name in self.dependencies.get(table_name, []) if name not in self.results]
+                print(f"{table_name}: not loaded, tables {missing} were never queued")
+                self.results[table_name] = False
+            self.pending = {}
+        self.executor.shutdown()
+        return self.results
+
+    def wall_time(self):
+        """ seconds from start of the first load to end of the last one """
+        if self.first_start is None:
+            return 0
+        return self.last_finish - self.first_start
+
+    def _release(self):
+        """ starts loading of pending tables with satisfied dependencies, has to be called holding the condition """
+        released = True
+        while released:
+            released = False
+            for table_name in list(self.pending):
+                dependencies = self.dependencies.get(table_name, [])
+                failed = [name for name in dependencies if name in self.results and not self.results[name]]
+                if failed:
+                    print(f"{table_name}: not loaded, tables {failed} it depends on failed")
+                    del self.pending[table_name]
+                    self.results[table_name] = False
+                    released = True
+                elif all(self.results.get(name) for name in dependencies):
+                    self.running += 1
+                    self.executor.submit(self._work, self.pending.pop(table_name), table_name)
+
+    def _work(self, table, table_name):
+        start = perf_counter()
+        with self.condition:
+            if self.first_start is None:
+                self.first_start = start
+        try:
+            result = self.load_table(table, table_name)
+        except Exception as e:
+            print(f"{table_name}: error ocurred during loading", e)
+            result = False
+        finish = perf_counter()
+        with self.condition:
+            self.results[table_name] = result
+            self.timings[table_name] = finish - start
+            self.last_finish = finish
+            self.running -= 1
+            self._release()
+            self.condition.notify_all()
@@ -1,41 +1,26 @@
 import pandas as pd
 import numpy as np
-from shapely.wkt import loads as load_wkt
-import geopandas as gpd
 
 
-def generate_location_area_dim(zipcodes):
+def generate_location_area_dim(zipcode_geometry):
     """
-    Generate a location area dimension DataFrame from the given zipcodes DataFrame.
+    Generate a location area dimension DataFrame from the given zipcode geometry table.
 
     Args:
-        zipcodes (DataFrame): A DataFrame containing ZIP codes and their geometries.
+        zipcode_geometry (DataFrame): A DataFrame containing ZIP codes with centroids and LocationAreaKey,
+            see utils.load_zipcode_geometry.
 
     Returns:
         DataFrame: A DataFrame containing the location area dimension data.
     """
-    # Convert 'the_geom' to geometry and calculate centroids
-    zipcodes['geometry'] = zipcodes['the_geom'].apply(load_wkt)
-    gdf = gpd.GeoDataFrame(zipcodes, geometry='geometry')
-    gdf['centroid'] = gdf['geometry'].centroid
-    gdf['centroid_latitude'] = gdf['centroid'].y
-    gdf['centroid_longitude'] = gdf['centroid'].x
-
-    # Generate LocationAreaKey by concatenating latitude and longitude without special characters
-    gdf['LocationAreaKey'] = (
-        gdf['centroid_longitude'].astype(str).str.replace('.', '', regex=False).str.replace('-', '', regex=False).str[:8] +
-        gdf['centroid_latitude'].astype(str).str.replace('.', '', regex=False).str.replace('-', '', regex=False).str[:8]
-    )
-
-    # Prepare the location area dimension DataFrame
     location_area_dim = pd.DataFrame({
-        'LocationAreaKey': gdf['LocationAreaKey'].astype(np.int64),
-        'Zipcode': gdf['ZIPCODE'],
-        'MailCity': gdf['MAIL_CITY'],
-        'ShapeLength': gdf['Shape_Leng'],
-        'ShapeArea': gdf['Shape_Area'],
-        'CentroidLatitude': gdf['centroid_latitude'],
-        'CentroidLongitude': gdf['centroid_longitude']
+        'LocationAreaKey': zipcode_geometry['LocationAreaKey'].astype(np.int64),
+        'Zipcode': zipcode_geometry['ZIPCODE'],
+        'MailCity': zipcode_geometry['MAIL_CITY'],
+        'ShapeLength': zipcode_geometry['Shape_Leng'],
+        'ShapeArea': zipcode_geometry['Shape_Area'],
+        'CentroidLatitude': zipcode_geometry['CentroidLatitude'],
+        'CentroidLongitude': zipcode_geometry['CentroidLongitude']
     })
 
     unknown_row = pd.DataFrame({
@@ -0,0 +1,105 @@
+import os
+import shutil
+import tempfile
+
+import pandas as pd
+import pyarrow as pa
+
+from config import Config
+
+
+class SpilledTable:
+    """ completed table moved from memory to local parquet file, read back only when it is consumed """
+
+    def __init__(self, path, rows):
+        self.path = path
+        self.rows = rows
+
+    def __len__(self):
+        return self.rows
+
+    @property
+    def empty(self):
+        return self.rows == 0
+
+    def read(self, columns=None):
+        """ returns table, or only given columns of it """
+        return pd.read_parquet(self.path, columns=columns)
+
+
+def materialize(table, columns=None):
+    """ returns DataFrame of table which may be spilled to disk """
+    if isinstance(table, SpilledTable):
+        return table.read(columns)
+    return table if columns is None else table[columns]
+
+
+def frame_bytes(table):
+    """ returns memory held by table, spilled tables hold none """
+    if isinstance(table, SpilledTable):
+        return 0
+    return int(table.memory_usage(index=True, deep=True).sum())
+
+
+class MemoryBudget:
+    """
+    Keeps memory held by tables of a run under a budget by spilling the largest completed tables
+    to a local run directory in columnar format.
+    """
+
+    def __init__(self, budget_mb=None, directory=None):
+        """
+        Args:
+            budget_mb (float): memory budget in megabytes, defaults to Config.MEMORY_BUDGET_MB
+            directory (str): spill directory, defaults to Config.SPILL_DIR
+        """
+        self.budget = (Config.MEMORY_BUDGET_MB if budget_mb is None else budget_mb) * 2 ** 20
+        self.directory = Config.SPILL_DIR if directory is None else directory
+        self.run_directory = None
+
+    def spill(self, name, frame):
+        """ writes table to spill directory, returns SpilledTable or the frame itself if it cannot be stored """
+        if self.run_directory is None:
+            os.makedirs(self.directory, exist_ok=True)
+            self.run_directory = tempfile.mkdtemp(dir=self.directory)
+        path = os.path.join(self.run_directory, f"{name}.parquet")
+        try:
+            frame.to_parquet(path, index=False, compression=Config.OUTPUT_COMPRESSION)
+        except (pa.ArrowException, ) as e:
+            # columns with mixed python types cannot be stored in parquet
+            print(f"WARNING: {name} not spilled, kept in memory", e)
+            return frame
+        return SpilledTable(path, len(frame))
+
+    def enforce(self, tables, completed):
+        """
+        Spill completed tables, largest first, until held memory fits the budget.
+
+        Args:
+            tables (dict): all tables held by the run, by name
+            completed (list): names of tables which are final and may be spilled
+
+        Returns:
+            dict: replacements of spilled tables, by name
+        """
+        sizes = {name: frame_bytes(table) for name, table in tables.items()}
+        held = sum(sizes.values())
+        spilled = {}
+        for name in sorted(completed, key=lambda name: sizes.get(name, 0), reverse=True):
+            if held <= self.budget:
+                break
+            if sizes.get(name, 0) == 0:
+                continue
+            replacement = self.spill(name, tables[name])
+            if isinstance(replacement, SpilledTable):
+                spilled[name] = replacement
+                held -= sizes[name]
+                print(f'{name}: {sizes[name] / 2 ** 20:.1f}MB spilled to {replacement.path}')
+        print(f'Tables hold {held / 2 ** 20:.1f}MB of {self.budget / 2 ** 20:.0f}MB budget')
+        return spilled
+
+    def clear(self):
+        """ removes spilled tables of the run """
+        if self.run_directory is not None and os.path.isdir(self.run_directory):
+            shutil.rmtree(self.run_directory)
+        self.run_directory = None
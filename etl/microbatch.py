@@ -0,0 +1,87 @@
+from collections import deque
+from datetime import datetime, timedelta
+from time import perf_counter
+
+import pandas as pd
+
+from insertion import check_last_update
+from etl import etl_pipeline
+from service import ETLService
+from config import Config
+
+
+class MicroBatchService(ETLService):
+    """
+    ETL service running regular updates in micro-batches, hourly or daily windows processed one after another
+    until the dwh is up to date. All batches share warm mappers, dwh connections, dimension keys and downloaded
+    sources of the service, end-to-end latency of every batch is recorded. Batches run planned windows even if
+    incremental extraction is enabled, weather hours not archived yet are extracted again by later batches.
+    """
+
+    def __init__(self, batch_hours=None, interval_hours=None, watcher=None, pipeline=etl_pipeline, max_batches=None,
+                 history=1000):
+        """
+        Args:
+            batch_hours (int): hours of batch window, defaults to Config.MICRO_BATCH_HOURS or 1 if it is not set
+            interval_hours (float): hours between scheduled updates, defaults to batch hours
+            watcher (MapperWatcher): mapper watcher, watches all Static mapper files if None
+            pipeline (callable): pipeline function, called with window arguments, warm resources and timings
+            max_batches (int): maximal number of batches run by a single update, unlimited if None
+            history (int): number of latest batches kept in latency history
+        """
+        self.batch_hours = batch_hours or Config.MICRO_BATCH_HOURS or 1
+        super().__init__(interval_hours=self.batch_hours if interval_hours is None else interval_hours,
+                         watcher=watcher, pipeline=self.run_batches)
+        self.batch_pipeline = pipeline
+        self.max_batches = max_batches
+        self.batches = deque(maxlen=history)
+
+    def run_batches(self, start_date=None, end_date=None, **kwargs):
+        """
+        runs consecutive batches until one of them has nothing to process or fails, requested window runs as
+        a single batch, returns if any batch finished with success
+        """
+        succeeded = False
+        count = 0
+        while self.max_batches is None or count < self.max_batches:
+            success = self.run_batch(start_date, end_date, **kwargs)
+            succeeded = succeeded or success
+            count += 1
+            if not success or start_date is not None:
+                break
+        return succeeded
+
+    def run_batch(self, start_date=None, end_date=None, **kwargs):
+        """ runs single batch and records its latency, returns if it finished with success """
+        kwargs['message'] = kwargs.get('message') or 'micro-batch'
+        timings = {}
+        start = perf_counter()
+        success = bool(self.batch_pipeline(start_date, end_date, batch_hours=self.batch_hours, timings=timings,
+                                           **kwargs))
+        record = {'Finished': datetime.now().strftime("%Y-%m-%d %H:%M:%S"), 'Success': success,
+                  'Seconds': round(perf_counter() - start, 3),
+                  **{f'{phase.capitalize()}Seconds': round(seconds, 3) for phase, seconds in timings.items()
+                     if phase != 'total'},
+                  'EndDate': None, 'LagHours': None}
+        if success:
+            try:
+                # data are complete up to the end of the window
+                end_date = check_last_update(pool=self.pool)
+                record['EndDate'] = end_date.strftime("%Y-%m-%d %H:%M:%S")
+                lag = datetime.now() - (end_date + timedelta(hours=1))
+                record['LagHours'] = round(lag.total_seconds() / 3600, 2)
+            except (Exception, ) as e:
+                print("WARNING: end of loaded window not available, batch lag not measured", e)
+            print(f"Micro-batch up to {record['EndDate']} finished in {record['Seconds']:.1f}s, "
+                  f"data lag {record['LagHours']} hours")
+        self.batches.append(record)
+        self.status['last_batch'] = record
+        return success
+
+    def latency_report(self):
+        """ returns recorded batches with their seconds per phase and lag of loaded data """
+        return pd.DataFrame(list(self.batches))
+
+
+if __name__ == "__main__":
+    MicroBatchService().serve()
@@ -0,0 +1,404 @@
+import json
+import os
+import random
+import re
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+import flatbuffers
+import numpy as np
+import pandas as pd
+
+from utils import SODA_DATASETS, read_fueleconomy_vehicles, soda_montgomery_request
+from crashes import CRASH_RAW_COLUMNS
+from drivers import DRIVER_RAW_COLUMNS
+
+MOCK_SOURCES = ['soda', 'fueleconomy', 'openmeteo']
+""" mocked sources, each with its own network profile and request statistics """
+
+WEATHER_VARIABLES = {
+    'temperature_2m': (5.0, 8.0),
+    'relative_humidity_2m': (70.0, 20.0),
+    'precipitation': (0.3, 0.3),
+    'rain': (0.3, 0.3),
+    'snowfall': (0.0, 0.0),
+    'windspeed_10m': (10.0, 5.0),
+    'winddirection_10m': (180.0, 170.0)
+}
+""" hourly variables of mocked weather archive with mean and daily amplitude of their synthetic values """
+
+SYSTEM_FIELDS = [':id', ':created_at', ':updated_at']
+""" portal system fields, returned only if they are not excluded """
+
+
+class NetworkProfile:
+    """ simulated network conditions of a mocked source """
+
+    def __init__(self, latency=0.0, bandwidth=None, failure_rate=0.0, failure_status=502):
+        """
+        Args:
+            latency (float): seconds before every response
+            bandwidth (float): bytes per second of response bodies, unlimited if None
+            failure_rate (float): probability of a request failing with failure_status
+            failure_status (int): HTTP status of injected failures, 502 is retried by every client
+        """
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.failure_rate = failure_rate
+        self.failure_status = failure_status
+
+
+class MockServices:
+    """
+    Local HTTP server mocking montgomery data portal, fueleconomy file and Open-Meteo archive with recorded
+    or synthetic data, see synthetic_sources and read_recording. Requests, injected failures, retries
+    and bytes sent are counted per source.
+    """
+
+    def __init__(self, datasets, vehicles, profiles=None, utc_offset=-18000, seed=0):
+        """
+        Args:
+            datasets (dict): raw portal rows by dataset name ('incidents', 'drivers', 'non-motorists'),
+                values are strings like portal values
+            vehicles (DataFrame): fueleconomy vehicles file
+            profiles (dict): NetworkProfile by source, see MOCK_SOURCES, missing sources have no delays or failures
+            utc_offset (int): utc offset seconds of mocked weather, the archive returns series in local time
+            seed (int): seed of failure injection
+        """
+        self.profiles = {source: NetworkProfile() for source in MOCK_SOURCES}
+        self.profiles.update(profiles or {})
+        self.vehicles_csv = vehicles.to_csv(index=False).encode()
+        self.utc_offset = utc_offset
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.stats = {}
+        self.reset_stats()
+        self.portal = sqlite3.connect(':memory:', check_same_thread=False)
+        self.tables = {}
+        for dataset, data in datasets.items():
+            self.tables[SODA_DATASETS[dataset]] = list(data.columns)
+            data.astype(object).where(data.notna(), None).to_sql(SODA_DATASETS[dataset], self.portal, index=False)
+        self.server = None
+
+    def reset_stats(self):
+        with self.lock:
+            self.stats = {source: {'requests': 0, 'failures': 0, 'bytes': 0, 'targets': set()}
+                          for source in MOCK_SOURCES}
+
+    def source_stats(self, source):
+        """ returns request statistics of source, retries are repeated requests of the same url """
+        with self.lock:
+            stats = self.stats[source]
+            return {'Requests': stats['requests'], 'Failures': stats['failures'],
+                    'Retries': stats['requests'] - len(stats['targets']), 'Bytes': stats['bytes']}
+
+    def record_request(self, source, target):
+        """ counts request and decides if it fails, returns True if it should fail """
+        profile = self.profiles[source]
+        with self.lock:
+            stats = self.stats[source]
+            stats['requests'] += 1
+            stats['targets'].add(target)
+            failed = profile.failure_rate > 0 and self.random.random() < profile.failure_rate
+            if failed:
+                stats['failures'] += 1
+        return failed
+
+    def record_bytes(self, source, size):
+        with self.lock:
+            self.stats[source]['bytes'] += size
+
+    def start(self, host='127.0.0.1', port=0):
+        """ starts server in background thread, returns its address 'host:port' """
+        self.server = ThreadingHTTPServer((host, port), MockHandler)
+        self.server.services = self
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, name='mock-services', daemon=True).start()
+        return f'{host}:{self.server.server_port}'
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def settings(self):
+        """ returns Config settings redirecting extraction to the running server """
+        address = f'{self.server.server_address[0]}:{self.server.server_port}'
+        return {'SODA_DOMAIN': address, 'SODA_URI_PREFIX': 'http://',
+                'FUELECONOMY_URL': f'http://{address}/feg/epadata/vehicles.csv',
+                'OPENMETEO_ARCHIVE_URL': f'http://{address}/v1/archive'}
+
+    def query_portal(self, dataset_id, params):
+        """
+        Evaluates SoQL query on stored dataset with sqlite.
+
+        Args:
+            dataset_id (str): portal dataset identifier
+            params (dict): SoQL parameters of the request
+
+        Returns:
+            DataFrame: matching rows with string values, None if value is missing
+
+        Raises:
+            ValueError: if dataset is unknown or query is not supported
+        """
+        if dataset_id not in self.tables:
+            raise ValueError(f'dataset {dataset_id} not found')
+        columns = self.tables[dataset_id]
+        if params.get('$$exclude_system_fields', 'true') != 'false':
+            columns = [column for column in columns if column not in SYSTEM_FIELDS]
+        select = params.get('$select') or ', '.join(f'"{column}"' for column in columns)
+        query = f'SELECT {soql_to_sql(select)} FROM "{dataset_id}"'
+        if params.get('$where'):
+            query += f" WHERE {soql_to_sql(params['$where'])}"
+        if params.get('$group'):
+            query += f" GROUP BY {soql_to_sql(params['$group'])}"
+        if params.get('$limit'):
+            query += f" LIMIT {int(params['$limit'])}"
+        with self.lock:
+            try:
+                rows = pd.read_sql(query, self.portal)
+            except (Exception, ) as e:
+                raise ValueError(str(e))
+        # the portal returns every value as a string
+        return rows.astype(str).where(rows.notna(), None)
+
+    def weather_message(self, params):
+        """ returns size prefixed flatbuffers message of hourly weather archive response """
+        start = datetime.strptime(params['start_date'], '%Y-%m-%d')
+        end = datetime.strptime(params['end_date'], '%Y-%m-%d') + timedelta(days=1)
+        latitude, longitude = float(params['latitude']), float(params['longitude'])
+        hours = np.arange(int((end - start).total_seconds() // 3600))
+        phase = (hours % 24) / 24 * 2 * np.pi + latitude + longitude
+        variables = [WEATHER_VARIABLES[name][0] + WEATHER_VARIABLES[name][1] * np.sin(phase)
+                     for name in params['hourly']]
+        epoch = datetime(1970, 1, 1)
+        return build_weather_message(latitude, longitude, int((start - epoch).total_seconds()) - self.utc_offset,
+                                     int((end - epoch).total_seconds()) - self.utc_offset, self.utc_offset,
+                                     variables)
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    """
+    Mocked endpoints:
+        GET /resource/{dataset}.csv, /resource/{dataset}.json - portal SoQL queries, see MockServices.query_portal
+        GET /feg/epadata/vehicles.csv - fueleconomy vehicles file
+        GET /v1/archive - Open-Meteo hourly archive in flatbuffers format
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    def reply(self, source, code, body, content_type='application/json'):
+        """ sends body after latency of source, throttled to its bandwidth """
+        profile = self.server.services.profiles[source]
+        if profile.latency:
+            time.sleep(profile.latency)
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.server.services.record_bytes(source, len(body))
+        chunk_size = 65536
+        for start in range(0, len(body), chunk_size):
+            chunk = body[start:start + chunk_size]
+            self.wfile.write(chunk)
+            if profile.bandwidth:
+                time.sleep(len(chunk) / profile.bandwidth)
+
+    def reply_error(self, source, code, message):
+        self.reply(source, code, json.dumps({'error': True, 'reason': message}).encode())
+
+    def do_GET(self):
+        services = self.server.services
+        url = urlsplit(self.path)
+        params = {key: values[0] if len(values) == 1 else values for key, values in parse_qs(url.query).items()}
+        resource = re.fullmatch(r'/resource/([\w-]+)\.(csv|json)', url.path)
+        if resource is not None:
+            source = 'soda'
+        elif url.path == '/feg/epadata/vehicles.csv':
+            source = 'fueleconomy'
+        elif url.path == '/v1/archive':
+            source = 'openmeteo'
+        else:
+            self.reply_error('soda', 404, f'unknown endpoint {url.path}')
+            return
+
+        if services.record_request(source, self.path):
+            self.reply_error(source, services.profiles[source].failure_status, 'injected failure')
+            return
+
+        if source == 'soda':
+            try:
+                rows = services.query_portal(resource.group(1), params)
+            except ValueError as e:
+                self.reply_error(source, 400, str(e))
+                return
+            if resource.group(2) == 'csv':
+                self.reply(source, 200, rows.to_csv(index=False).encode(), 'text/csv')
+            else:
+                # missing values are omitted from JSON records
+                records = [{key: value for key, value in record.items() if value is not None}
+                           for record in rows.to_dict(orient='records')]
+                self.reply(source, 200, json.dumps(records).encode())
+        elif source == 'fueleconomy':
+            self.reply(source, 200, services.vehicles_csv, 'text/csv')
+        else:
+            if isinstance(params.get('hourly'), str):
+                params['hourly'] = [params['hourly']]
+            try:
+                body = services.weather_message(params)
+            except (KeyError, ValueError) as e:
+                self.reply_error(source, 400, f'invalid parameters: {e}')
+                return
+            self.reply(source, 200, body, 'application/octet-stream')
+
+    def log_message(self, format, *args):
+        pass
+
+
+def soql_to_sql(clause):
+    """ translates SoQL clause to sqlite, system fields are quoted and case(...) becomes CASE WHEN """
+    clause = re.sub(r"(?<![\w'\"])(:\w+)", r'"\1"', clause)
+    return re.sub(r"case\((.+?), 1, true, 0\)", r"CASE WHEN \1 THEN 1 ELSE 0 END", clause)
+
+
+def build_weather_message(latitude, longitude, time_start, time_end, utc_offset, variables, interval=3600):
+    """
+    Builds Open-Meteo weather api response with hourly variables, readable by openmeteo_sdk.
+
+    Args:
+        latitude (float): latitude of grid cell
+        longitude (float): longitude of grid cell
+        time_start (int): unix time of first hour
+        time_end (int): unix time after last hour
+        utc_offset (int): utc offset seconds of location
+        variables (list): arrays of hourly values, in order of requested variables
+        interval (int): seconds between values
+
+    Returns:
+        bytes: size prefixed flatbuffers message
+    """
+    builder = flatbuffers.Builder(1024)
+    tables = []
+    for values in variables:
+        vector = builder.CreateNumpyVector(np.asarray(values, dtype=np.float32))
+        # VariableWithValues, values are its fourth field
+        builder.StartObject(4)
+        builder.PrependUOffsetTRelativeSlot(3, vector, 0)
+        tables.append(builder.EndObject())
+    builder.StartVector(4, len(tables), 4)
+    for table in reversed(tables):
+        builder.PrependUOffsetTRelative(table)
+    variables_vector = builder.EndVector()
+
+    # VariablesWithTime
+    builder.StartObject(4)
+    builder.PrependInt64Slot(0, time_start, 0)
+    builder.PrependInt64Slot(1, time_end, 0)
+    builder.PrependInt32Slot(2, interval, 0)
+    builder.PrependUOffsetTRelativeSlot(3, variables_vector, 0)
+    hourly = builder.EndObject()
+
+    # WeatherApiResponse
+    builder.StartObject(12)
+    builder.PrependFloat32Slot(0, latitude, 0)
+    builder.PrependFloat32Slot(1, longitude, 0)
+    builder.PrependInt32Slot(6, utc_offset, 0)
+    builder.PrependUOffsetTRelativeSlot(11, hourly, 0)
+    builder.FinishSizePrefixed(builder.EndObject())
+    return bytes(builder.Output())
+
+
+def synthetic_sources(start_date='2023-12-01', end_date='2023-12-31', crashes_per_day=40, seed=0):
+    """
+    Generates raw portal datasets and fueleconomy file with the columns used by the pipeline.
+
+    Args:
+        start_date (str): first day of crash reports in "YYYY-MM-DD" format
+        end_date (str): last day of crash reports in "YYYY-MM-DD" format
+        crashes_per_day (int): crash reports per day, each has one to three drivers and some non-motorists
+        seed (int): random seed
+
+    Returns:
+        tuple: raw datasets by name and vehicles DataFrame, see MockServices
+    """
+    rng = np.random.default_rng(seed)
+    year = datetime.now().year
+    makes = {'TOYOTA': ['CAMRY', 'COROLLA', 'RAV4'], 'HONDA': ['CIVIC', 'ACCORD', 'CR-V'],
+             'FORD': ['F-150', 'ESCAPE', 'FOCUS']}
+    vehicles = pd.DataFrame([{'make': make.title(), 'baseModel': model.title(), 'model': model.title(), 'year': y,
+                              'VClass': 'Compact Cars', 'cylinders': 4.0, 'displ': 2.0, 'trany': 'Automatic (S6)',
+                              'drive': 'Front-Wheel Drive', 'fuelType1': 'Regular Gasoline', 'city08': 28,
+                              'highway08': 36}
+                             for make, models in makes.items() for model in models for y in [year - 1, year]])
+    vehicles.insert(0, 'id', range(1, len(vehicles) + 1))
+
+    days = pd.date_range(start_date, end_date, freq='D')
+    n = len(days) * crashes_per_day
+    crash_times = days.repeat(crashes_per_day) + pd.to_timedelta(rng.integers(0, 86400, n), unit='s')
+    updated = crash_times + pd.to_timedelta(rng.integers(1, 72, n), unit='h')
+    reports = [f'MCP{seed:02d}{i:08d}' for i in range(n)]
+
+    def choice(values, size):
+        return rng.choice(np.array(values, dtype=object), size)
+
+    incidents = pd.DataFrame({column: choice(['Yes', 'No', 'Unknown', 'N/A'], n) for column in CRASH_RAW_COLUMNS})
+    incidents = incidents.assign(
+        report_number=reports, local_case_number=[str(230000 + i) for i in range(n)],
+        agency_name=choice(['Montgomery County Police', 'Gaithersburg Police Depar', 'Rockville Police Departme'], n),
+        acrs_report_type=choice(['Property Damage Crash', 'Injury Crash', 'Fatal Crash'], n),
+        crash_date_time=crash_times.strftime('%Y-%m-%dT%H:%M:%S.000'),
+        route_type=choice(['County', 'Maryland (State)', 'Municipality', None], n),
+        lane_number=choice(['0', '1', '2', '3'], n), number_of_lanes=choice(['1', '2', '3', '4'], n),
+        road_name=choice(['GEORGIA AVE', 'ROCKVILLE PIKE', 'RANDOLPH RD', 'VEIRS MILL RD', None], n),
+        cross_street_name=choice(['UNIVERSITY BLVD', 'MONTROSE RD', 'NORBECK RD', None], n),
+        latitude=np.round(rng.uniform(38.95, 39.3, n), 6).astype(str),
+        longitude=np.round(rng.uniform(-77.4, -76.95, n), 6).astype(str))
+    incidents[':updated_at'] = updated.strftime('%Y-%m-%dT%H:%M:%S.000Z')
+
+    vehicles_per_report = rng.integers(1, 4, n)
+    driver_reports = np.repeat(np.arange(n), vehicles_per_report)
+    m = len(driver_reports)
+    make_names = choice(list(makes), m)
+    drivers = pd.DataFrame({column: choice(['Yes', 'No', 'Unknown', 'N/A'], m) for column in DRIVER_RAW_COLUMNS})
+    drivers = drivers.assign(
+        report_number=np.array(reports, dtype=object)[driver_reports],
+        vehicle_id=[f'{i:x}-{seed}' for i in range(m)],
+        injury_severity=choice(['NO APPARENT INJURY', 'POSSIBLE INJURY', 'SUSPECTED MINOR INJURY', 'FATAL INJURY'], m),
+        driver_substance_abuse=choice(['NONE DETECTED', 'ALCOHOL PRESENT', 'UNKNOWN', None], m),
+        vehicle_body_type=choice(['PASSENGER CAR', 'SPORT UTILITY VEHICLE', 'PICKUP TRUCK', 'TRANSIT BUS'], m),
+        speed_limit=choice(['25', '35', '40', '55'], m), vehicle_year=choice([str(year - 1), str(year)], m),
+        vehicle_make=make_names, vehicle_model=[rng.choice(makes[make]) for make in make_names],
+        crash_date_time=incidents['crash_date_time'].values[driver_reports])
+    drivers[':updated_at'] = incidents[':updated_at'].values[driver_reports]
+
+    nonmoto_reports = rng.choice(n, size=max(1, n // 10), replace=True)
+    nonmotorists = pd.DataFrame({
+        'report_number': np.array(reports, dtype=object)[nonmoto_reports],
+        'crash_date_time': incidents['crash_date_time'].values[nonmoto_reports],
+        'injury_severity': choice(['NO APPARENT INJURY', 'SUSPECTED MINOR INJURY', 'FATAL INJURY', None],
+                                  len(nonmoto_reports)),
+        ':updated_at': incidents[':updated_at'].values[nonmoto_reports]})
+    return {'incidents': incidents, 'drivers': drivers, 'non-motorists': nonmotorists}, vehicles
+
+
+def record_sources(directory, start_date, end_date):
+    """ saves portal datasets of the window and fueleconomy file from live services, see read_recording """
+    os.makedirs(directory, exist_ok=True)
+    for dataset in SODA_DATASETS:
+        soda_montgomery_request(dataset, start_date, end_date).to_csv(os.path.join(directory, f'{dataset}.csv'),
+                                                                    index=False)
+    read_fueleconomy_vehicles().to_csv(os.path.join(directory, 'vehicles.csv'), index=False)
+
+
+def read_recording(directory):
+    """ returns recorded datasets and vehicles saved by record_sources, see MockServices """
+    datasets = {dataset: pd.read_csv(os.path.join(directory, f'{dataset}.csv'), dtype=str, keep_default_na=False,
+                                     na_values=[''])
+                for dataset in SODA_DATASETS}
+    return datasets, pd.read_csv(os.path.join(directory, 'vehicles.csv'), low_memory=False)
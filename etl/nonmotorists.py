@@ -1,5 +1,14 @@
 import pandas as pd
 
+from config import Config
+
+NONMOTO_AGGREGATES = {
+    'non_motorist_total': 'NonMotoristTotal',
+    'non_motorist_injury': 'NonMotoristInjury',
+    'non_motorist_fatal': 'NonMotoristFatal'
+}
+""" SoQL aliases of non-motorist aggregates per report and their column names """
+
 
 def prepare_nonmoto_data(data):
     data = data[['report_number', 'injury_severity']]
@@ -20,9 +29,7 @@ def classify_injury(injury):
         return 'No injury'
 
 
-def transform_nonmoto_data(data):
-    nonmoto = data.copy()
-
+def transform_nonmoto_data(nonmoto):
     nonmoto['InjurySeverity'] = nonmoto['InjurySeverity'].apply(classify_injury)
 
     nonmoto['Fatal'] = nonmoto['InjurySeverity'].apply(lambda x: 1 if x == 'Fatal' else 0)
@@ -36,6 +43,66 @@ def transform_nonmoto_data(data):
 
 
 def nonmoto_pipeline(raw_data):
+    if is_aggregated(raw_data):
+        # aggregated by the portal at extraction
+        return raw_data
     nonmoto = prepare_nonmoto_data(raw_data)
     nonmoto_agg = transform_nonmoto_data(nonmoto)
     return nonmoto_agg
+
+
+def soql_has_word(column, word):
+    """ SoQL condition true if word is one of the space separated words of column, case insensitive """
+    value = f"upper({column})"
+    word = word.upper()
+    return (f"({value} = '{word}' OR {value} like '{word} %' OR {value} like '% {word}' "
+            f"OR {value} like '% {word} %')")
+
+
+def soql_nonmoto_aggregates():
+    """ returns SoQL select of non-motorist aggregates per report, injuries are classified like classify_injury """
+    fatal = soql_has_word('injury_severity', 'fatal')
+    no_injury = soql_has_word('injury_severity', 'no')
+    injury = soql_has_word('injury_severity', 'injury')
+    return (f"report_number, count(*) AS non_motorist_total, "
+            f"sum(case({injury} AND NOT {fatal} AND NOT {no_injury}, 1, true, 0)) AS non_motorist_injury, "
+            f"sum(case({fatal}, 1, true, 0)) AS non_motorist_fatal")
+
+
+def prepare_nonmoto_aggregates(data):
+    """ converts aggregates computed by the portal to the output of nonmoto_pipeline """
+    if data.empty:
+        data = pd.DataFrame(columns=['report_number'] + list(NONMOTO_AGGREGATES))
+    data = data[['report_number'] + list(NONMOTO_AGGREGATES)].rename(columns={'report_number': 'ReportNumber',
+                                                                             **NONMOTO_AGGREGATES})
+    data = data.astype({'ReportNumber': str, **{col: 'int64' for col in NONMOTO_AGGREGATES.values()}})
+    return data.sort_values('ReportNumber', kind='stable').reset_index(drop=True)
+
+
+def is_aggregated(data):
+    """ if non-motorist data was already aggregated per report at extraction """
+    return set(NONMOTO_AGGREGATES.values()) <= set(data.columns)
+
+
+def extract_nonmoto_data(request, *args, aggregate=None):
+    """
+    Request non-motorist data, aggregated per report by the portal or as raw records.
+
+    Args:
+        request (callable): portal request function such as soda_montgomery_request, called with
+            dataset name, given args and SoQL select and group clauses
+        args: further arguments of request, e.g. window or report numbers
+        aggregate (bool): if aggregates are computed by the portal, defaults to Config.SODA_AGGREGATE_NONMOTORISTS,
+            raw records are requested if aggregation fails
+
+    Returns:
+        DataFrame: aggregates per report, or raw records
+    """
+    aggregate = Config.SODA_AGGREGATE_NONMOTORISTS if aggregate is None else aggregate
+    if aggregate:
+        try:
+            return prepare_nonmoto_aggregates(request('non-motorists', *args, select=soql_nonmoto_aggregates(),
+                                                      group='report_number'))
+        except (Exception, ) as e:
+            print("WARNING: non-motorists not aggregated by the portal, requesting raw records", e)
+    return request('non-motorists', *args)
@@ -0,0 +1,114 @@
+import os
+import shutil
+import uuid
+from abc import ABC, abstractmethod
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from config import Config
+
+PARTITION_COLUMNS = ['PartitionYear', 'PartitionMonth']
+""" hive partition columns derived from DateHourKey """
+
+
+class OutputSink(ABC):
+    """ base class for sinks saving ETL tables locally, subclasses implement all abstract methods """
+
+    def __init__(self, directory=None, append=None):
+        self.directory = Config.OUTPUT_DIR if directory is None else directory
+        self.append = Config.OUTPUT_APPEND if append is None else append
+
+    @abstractmethod
+    def write(self, table, table_name):
+        pass
+
+    @abstractmethod
+    def read(self, table_name):
+        pass
+
+    @abstractmethod
+    def exists(self, table_name):
+        pass
+
+    @abstractmethod
+    def path(self, table_name):
+        pass
+
+
+class CsvSink(OutputSink):
+    """ writes every table to a single csv file """
+
+    def path(self, table_name):
+        return os.path.join(self.directory, f"{table_name}.csv")
+
+    def exists(self, table_name):
+        return os.path.isfile(self.path(table_name))
+
+    def write(self, table, table_name):
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path(table_name)
+        if self.append and os.path.isfile(path):
+            table.to_csv(path, mode='a', header=False, index=False)
+        else:
+            table.to_csv(path, index=False)
+
+    def read(self, table_name):
+        return pd.read_csv(self.path(table_name))
+
+
+class ParquetSink(OutputSink):
+    """
+    Writes every table to a compressed parquet dataset directory. Tables with DateHourKey column
+    are optionally partitioned by year and month, appended windows are written as new files.
+    """
+
+    def __init__(self, directory=None, append=None, partitioned=None, compression=None):
+        super().__init__(directory=directory, append=append)
+        self.partitioned = Config.OUTPUT_PARTITIONED if partitioned is None else partitioned
+        self.compression = Config.OUTPUT_COMPRESSION if compression is None else compression
+
+    def path(self, table_name):
+        return os.path.join(self.directory, table_name)
+
+    def exists(self, table_name):
+        return os.path.isdir(self.path(table_name))
+
+    def write(self, table, table_name):
+        path = self.path(table_name)
+        if not self.append and os.path.isdir(path):
+            shutil.rmtree(path)
+
+        partition_cols = None
+        if self.partitioned and 'DateHourKey' in table.columns:
+            table = table.assign(PartitionYear=table['DateHourKey'] // 1000000,
+                                 PartitionMonth=table['DateHourKey'] // 10000 % 100)
+            partition_cols = PARTITION_COLUMNS
+
+        pq.write_to_dataset(pa.Table.from_pandas(table, preserve_index=False), path,
+                            partition_cols=partition_cols,
+                            compression=self.compression,
+                            basename_template=f"part-{uuid.uuid4().hex}-{{i}}.parquet")
+
+    def read(self, table_name):
+        data = pd.read_parquet(self.path(table_name))
+        data = data.drop(columns=[col for col in PARTITION_COLUMNS if col in data.columns])
+        return data
+
+
+def get_output_sink(output_format=None, **kwargs):
+    """ returns output sink for given format, available options: 'parquet', 'csv' """
+    output_format = Config.OUTPUT_FORMAT if output_format is None else output_format
+    sinks = {'parquet': ParquetSink,
+             'csv': CsvSink}
+    return sinks[output_format](**kwargs)
+
+
+def read_output(table_name, directory=None):
+    """ reads a locally saved table, parquet datasets take precedence over csv files """
+    for output_format in ['parquet', 'csv']:
+        sink = get_output_sink(output_format, directory=directory)
+        if sink.exists(table_name):
+            return sink.read(table_name)
+    raise FileNotFoundError(f"no output saved for {table_name}")
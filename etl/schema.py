@@ -0,0 +1,134 @@
+STAR_SCHEMA = {
+    'RoadDim': {
+        'columns': [('RoadName', 'VARCHAR'), ('RouteType', 'VARCHAR'), ('RoadKey', 'BIGINT')],
+        'primary_key': ['RoadKey']
+    },
+    'VehicleDim': {
+        'columns': [('Make', 'VARCHAR'), ('Year', 'INTEGER'), ('BaseModel', 'VARCHAR'), ('VehicleKey', 'BIGINT'),
+                    ('BodyClass', 'VARCHAR'), ('Cylinders', 'INTEGER'), ('Displacement', 'DOUBLE'),
+                    ('Transmission', 'VARCHAR'), ('Drivetrain', 'VARCHAR'), ('FuelType', 'VARCHAR'),
+                    ('CityMPG', 'INTEGER'), ('HighwayMPG', 'INTEGER')],
+        'primary_key': ['VehicleKey']
+    },
+    'LocationAreaDim': {
+        'columns': [('LocationAreaKey', 'BIGINT'), ('Zipcode', 'INTEGER'), ('MailCity', 'VARCHAR'),
+                    ('ShapeLength', 'DOUBLE'), ('ShapeArea', 'DOUBLE'), ('CentroidLatitude', 'DOUBLE'),
+                    ('CentroidLongitude', 'DOUBLE')],
+        'primary_key': ['LocationAreaKey']
+    },
+    'DateHourDim': {
+        'columns': [('Datetime', 'TIMESTAMP'), ('DateHourKey', 'BIGINT'), ('Hour', 'INTEGER'), ('TimeOfDay', 'VARCHAR'),
+                    ('DayNumber', 'INTEGER'), ('WeekDayNumber', 'INTEGER'), ('WeekDayName', 'VARCHAR'),
+                    ('WeekendFlag', 'INTEGER'), ('MonthNumber', 'INTEGER'), ('MonthName', 'VARCHAR'),
+                    ('Year', 'INTEGER'), ('HolidayFlag', 'INTEGER'), ('HolidayName', 'VARCHAR')],
+        'primary_key': ['DateHourKey']
+    },
+    'WeatherFact': {
+        'columns': [('Temperature', 'DOUBLE'), ('Humidity', 'DOUBLE'), ('Precipitation', 'DOUBLE'), ('Rain', 'DOUBLE'),
+                    ('Snow', 'DOUBLE'), ('WindSpeed', 'DOUBLE'), ('WindDirection', 'DOUBLE'),
+                    ('LocationAreaKey', 'BIGINT'), ('DateHourKey', 'BIGINT'), ('WeatherKey', 'BIGINT')],
+        'primary_key': ['WeatherKey']
+    },
+    'VehicleCrashFact': {
+        'columns': [('ReportNumber', 'VARCHAR'), ('VehicleCrashKey', 'VARCHAR'), ('DriverAtFault', 'BOOLEAN'),
+                    ('DriverInjurySeverity', 'VARCHAR'), ('DriverSubstanceAbuse', 'VARCHAR'),
+                    ('DriverDistractedBy', 'VARCHAR'), ('VehicleType', 'VARCHAR'), ('VehicleMovement', 'VARCHAR'),
+                    ('VehicleGoingDir', 'VARCHAR'), ('VehicleDamageExtent', 'VARCHAR'), ('SpeedLimit', 'INTEGER'),
+                    ('ParkedVehicle', 'BOOLEAN'), ('SubstanceAbuseContributed', 'BOOLEAN'),
+                    ('VehiclesCrashedTotal', 'INTEGER'), ('VehicleKey', 'BIGINT'), ('LocalCaseNumber', 'VARCHAR'),
+                    ('AgencyName', 'VARCHAR'), ('ACRSReportType', 'VARCHAR'), ('HitRun', 'BOOLEAN'),
+                    ('LaneDirection', 'VARCHAR'), ('LaneNumber', 'INTEGER'), ('NumberOfLanes', 'INTEGER'),
+                    ('RoadGrade', 'VARCHAR'), ('NonTraffic', 'BOOLEAN'), ('OffRoadIncident', 'BOOLEAN'),
+                    ('AccidentAtFault', 'VARCHAR'), ('CollisionType', 'VARCHAR'), ('SurfaceCondition', 'VARCHAR'),
+                    ('Light', 'VARCHAR'), ('TrafficControl', 'VARCHAR'), ('Junction', 'VARCHAR'),
+                    ('IntersectionType', 'VARCHAR'), ('RoadAlignment', 'VARCHAR'), ('RoadCondition', 'VARCHAR'),
+                    ('RoadDivision', 'VARCHAR'), ('Latitude', 'DOUBLE'), ('Longitude', 'DOUBLE'),
+                    ('RoadKey', 'BIGINT'), ('CrossStreetKey', 'BIGINT'), ('NonMotoristTotal', 'INTEGER'),
+                    ('NonMotoristInjury', 'INTEGER'), ('NonMotoristFatal', 'INTEGER'), ('DateHourKey', 'BIGINT'),
+                    ('LocationAreaKey', 'BIGINT'), ('RowHash', 'BIGINT')],
+        'primary_key': ['VehicleCrashKey']
+    },
+    'CrashDayAreaAgg': {
+        'columns': [('DateKey', 'INTEGER'), ('LocationAreaKey', 'BIGINT'), ('Crashes', 'INTEGER'),
+                    ('Vehicles', 'INTEGER'), ('InjuredDrivers', 'INTEGER'), ('FatalDrivers', 'INTEGER'),
+                    ('AtFaultDrivers', 'INTEGER'), ('NonMotorists', 'INTEGER'), ('NonMotoristInjuries', 'INTEGER'),
+                    ('NonMotoristFatalities', 'INTEGER')],
+        'primary_key': ['DateKey', 'LocationAreaKey']
+    },
+    'CrashHourAgg': {
+        'columns': [('DateKey', 'INTEGER'), ('Hour', 'INTEGER'), ('Crashes', 'INTEGER'), ('Vehicles', 'INTEGER'),
+                    ('InjuredDrivers', 'INTEGER'), ('FatalDrivers', 'INTEGER'), ('AtFaultDrivers', 'INTEGER'),
+                    ('NonMotorists', 'INTEGER'), ('NonMotoristInjuries', 'INTEGER'),
+                    ('NonMotoristFatalities', 'INTEGER'), ('WeekDayNumber', 'INTEGER')],
+        'primary_key': ['DateKey', 'Hour']
+    },
+    'CrashWeatherAgg': {
+        'columns': [('DateKey', 'INTEGER'), ('TemperatureBucket', 'VARCHAR'), ('PrecipitationBucket', 'VARCHAR'),
+                    ('Crashes', 'INTEGER'), ('Vehicles', 'INTEGER'), ('InjuredDrivers', 'INTEGER'),
+                    ('FatalDrivers', 'INTEGER'), ('AtFaultDrivers', 'INTEGER'), ('NonMotorists', 'INTEGER'),
+                    ('NonMotoristInjuries', 'INTEGER'), ('NonMotoristFatalities', 'INTEGER')],
+        'primary_key': ['DateKey', 'TemperatureBucket', 'PrecipitationBucket']
+    },
+    'Metadata': {
+        'columns': [('LastUpdate', 'TIMESTAMP'), ('StartDate', 'TIMESTAMP'), ('EndDate', 'TIMESTAMP'),
+                    ('UpdateMessage', 'VARCHAR'), ('IncidentsWatermark', 'TIMESTAMP'),
+                    ('DriversWatermark', 'TIMESTAMP'), ('NonMotoristsWatermark', 'TIMESTAMP'),
+                    ('WindowRows', 'BIGINT'), ('QuarantinedRows', 'BIGINT')],
+        'primary_key': []
+    }
+}
+""" tables of the star schema with column types and primary keys, used by embedded backends """
+
+MIGRATED_COLUMNS = {
+    'VehicleCrashFact': ['RowHash'],
+    'Metadata': ['IncidentsWatermark', 'DriversWatermark', 'NonMotoristsWatermark', 'WindowRows', 'QuarantinedRows']
+}
+""" columns added to tables of the initial SQL Server dwh, by table """
+
+MIGRATED_TABLES = ['CrashDayAreaAgg', 'CrashHourAgg', 'CrashWeatherAgg']
+""" tables missing from the initial SQL Server dwh """
+
+SQLSERVER_TYPES = {
+    'VARCHAR': 'NVARCHAR(100)',
+    'INTEGER': 'INT',
+    'BIGINT': 'BIGINT',
+    'DOUBLE': 'FLOAT',
+    'BOOLEAN': 'BIT',
+    'TIMESTAMP': 'DATETIME'
+}
+""" SQL Server types of star schema column types """
+
+
+def generate_create_statements(schema=None):
+    """ returns CREATE TABLE statements of the star schema """
+    schema = STAR_SCHEMA if schema is None else schema
+    statements = []
+    for table_name, table in schema.items():
+        definitions = [f"{column} {column_type}" for column, column_type in table['columns']]
+        if table['primary_key']:
+            definitions.append(f"PRIMARY KEY ({', '.join(table['primary_key'])})")
+        statements.append(f"CREATE TABLE IF NOT EXISTS {table_name} ({', '.join(definitions)})")
+    return statements
+
+
+def generate_sqlserver_migration(schema=None):
+    """
+    returns statements adding migrated columns and tables of the star schema to SQL Server dwh,
+    statements skip columns and tables which already exist so the migration can be run repeatedly
+    """
+    schema = STAR_SCHEMA if schema is None else schema
+    statements = []
+    for table_name, columns in MIGRATED_COLUMNS.items():
+        types = dict(schema[table_name]['columns'])
+        for column in columns:
+            statements.append(f"IF COL_LENGTH('{table_name}', '{column}') IS NULL "
+                              f"ALTER TABLE {table_name} ADD {column} {SQLSERVER_TYPES[types[column]]}")
+    for table_name in MIGRATED_TABLES:
+        table = schema[table_name]
+        # primary key columns have to be declared NOT NULL
+        definitions = [f"{column} {SQLSERVER_TYPES[column_type]}{' NOT NULL' if column in table['primary_key'] else ''}"
+                       for column, column_type in table['columns']]
+        definitions.append(f"PRIMARY KEY ({', '.join(table['primary_key'])})")
+        statements.append(f"IF OBJECT_ID('{table_name}', 'U') IS NULL "
+                          f"CREATE TABLE {table_name} ({', '.join(definitions)})")
+    return statements
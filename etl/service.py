@@ -0,0 +1,195 @@
+import json
+import os
+import queue
+import threading
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from utils import load_brands_dict, load_models_dict, load_area_mapper, load_zipcodes, load_zipcode_geometry
+from insertion import ConnectionPool
+from etl import etl_pipeline
+from config import Config
+
+MAPPER_LOADERS = {
+    'static/car_makes.txt': [load_brands_dict],
+    'static/car_models.csv': [load_models_dict],
+    'static/area_mapper.csv': [load_area_mapper],
+    'static/ZIPCODES.csv': [load_zipcodes, load_zipcode_geometry]
+}
+""" functions reloading Static mappers, by file they are read from """
+
+
+class MapperWatcher:
+    """ reloads Static mappers whose files were modified since they were loaded """
+
+    def __init__(self, loaders=None):
+        self.loaders = MAPPER_LOADERS if loaders is None else loaders
+        self.mtimes = {}
+        self.snapshot()
+
+    def snapshot(self):
+        """ marks current state of mapper files as loaded, e.g. after the run updated a mapper itself """
+        self.mtimes = {path: os.path.getmtime(path) for path in self.loaders}
+
+    def refresh(self, force=False):
+        """ reloads mappers with modified files, or all of them if forced, returns reloaded files """
+        reloaded = []
+        for path, loaders in self.loaders.items():
+            if force or os.path.getmtime(path) != self.mtimes.get(path):
+                for load in loaders:
+                    load()
+                reloaded.append(path)
+        self.snapshot()
+        return reloaded
+
+
+class ETLService:
+    """
+    Long running ETL process keeping Static mappers, dwh connections, dimension keys, downloaded sources
+    and http sessions in memory. Regular updates run on schedule, updates and mapper reloads can be requested
+    through local HTTP control interface.
+    """
+
+    def __init__(self, interval_hours=None, watcher=None, pipeline=etl_pipeline):
+        """
+        Args:
+            interval_hours (float): hours between scheduled updates, defaults to Config.SERVICE_INTERVAL_HOURS
+            watcher (MapperWatcher): mapper watcher, watches all Static mapper files if None
+            pipeline (callable): pipeline function, called with window arguments and warm resources
+        """
+        self.interval_hours = Config.SERVICE_INTERVAL_HOURS if interval_hours is None else interval_hours
+        self.watcher = MapperWatcher() if watcher is None else watcher
+        self.pipeline = pipeline
+        self.pool = None if Config.DEBUG else ConnectionPool(Config.LOAD_WORKERS)
+        self.dimension_keys = {}
+        self.source_cache = {}
+        self.requests = queue.Queue()
+        self.stopping = threading.Event()
+        self.reload_requested = threading.Event()
+        self.server = None
+        self.status = {'state': 'idle', 'runs': 0, 'last_run': None, 'last_success': None,
+                       'next_scheduled': self.next_scheduled()}
+
+    def next_scheduled(self):
+        if not self.interval_hours:
+            return None
+        return (datetime.now() + timedelta(hours=self.interval_hours)).strftime("%Y-%m-%d %H:%M:%S")
+
+    def request_run(self, start_date=None, end_date=None, message=None, resume=False):
+        """ queues pipeline run, regular update if window is not given, returns number of queued runs """
+        self.requests.put({'start_date': start_date, 'end_date': end_date, 'message': message, 'resume': resume})
+        return self.requests.qsize()
+
+    def run(self, start_date=None, end_date=None, message=None, resume=False):
+        """ runs pipeline with warm resources, mappers modified on disk are reloaded first """
+        reloaded = self.watcher.refresh(force=self.reload_requested.is_set())
+        self.reload_requested.clear()
+        if reloaded:
+            # cached keys may be stale if mappers changed
+            self.dimension_keys.clear()
+            print(f'Mappers reloaded: {reloaded}')
+
+        self.status.update(state='running', last_run=datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+        try:
+            success = bool(self.pipeline(start_date, end_date, message=message, resume=resume, pool=self.pool,
+                                         dimension_keys=self.dimension_keys, source_cache=self.source_cache))
+        except (Exception, ) as e:
+            print("Error ocurred during service run", e)
+            success = False
+        # models mapper is updated by the run itself and already reloaded
+        self.watcher.snapshot()
+        self.status.update(state='idle', runs=self.status['runs'] + 1, last_success=success)
+        return success
+
+    def start_control(self, host=None, port=None):
+        """ starts HTTP control interface in background thread, returns bound (host, port) """
+        host = Config.SERVICE_HOST if host is None else host
+        port = Config.SERVICE_PORT if port is None else port
+        self.server = ThreadingHTTPServer((host, port), ControlHandler)
+        self.server.service = self
+        threading.Thread(target=self.server.serve_forever, name='etl-control', daemon=True).start()
+        print(f'ETL service control listening on http://{host}:{self.server.server_port}')
+        return host, self.server.server_port
+
+    def serve(self, host=None, port=None):
+        """ processes requested and scheduled runs one at a time until stopped """
+        self.start_control(host, port)
+        deadline = datetime.now() + timedelta(hours=self.interval_hours) if self.interval_hours else None
+        try:
+            while not self.stopping.is_set():
+                timeout = None if deadline is None else max(0, (deadline - datetime.now()).total_seconds())
+                try:
+                    request = self.requests.get(timeout=timeout)
+                except queue.Empty:
+                    request = {}
+                    deadline = datetime.now() + timedelta(hours=self.interval_hours)
+                    self.status['next_scheduled'] = deadline.strftime("%Y-%m-%d %H:%M:%S")
+                if request is None:
+                    break
+                self.run(**request)
+        finally:
+            self.stop()
+
+    def stop(self):
+        self.stopping.set()
+        # wakes up serving loop
+        self.requests.put(None)
+        if self.server is not None:
+            self.server.shutdown()
+            self.server = None
+        if self.pool is not None:
+            self.pool.close()
+
+
+class ControlHandler(BaseHTTPRequestHandler):
+    """
+    Control interface of ETL service:
+        GET /status - service state
+        POST /run - queues run, optional JSON body with start_date, end_date, message and resume
+        POST /reload - reloads all mappers before next run, modified ones are reloaded anyway
+        POST /stop - stops service after current run
+    """
+
+    def reply(self, code, body):
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == '/status':
+            self.reply(200, dict(self.server.service.status, queued=self.server.service.requests.qsize()))
+        else:
+            self.reply(404, {'error': f'unknown endpoint {self.path}'})
+
+    def do_POST(self):
+        service = self.server.service
+        length = int(self.headers.get('Content-Length', 0))
+        try:
+            body = json.loads(self.rfile.read(length) or b'{}')
+        except ValueError:
+            self.reply(400, {'error': 'body is not valid JSON'})
+            return
+
+        if self.path == '/run':
+            window = {key: body[key] for key in ['start_date', 'end_date', 'message', 'resume'] if key in body}
+            self.reply(202, {'queued': service.request_run(**window)})
+        elif self.path == '/reload':
+            # mappers are replaced by serving thread, never during a run
+            service.reload_requested.set()
+            self.reply(202, {'reload': 'before next run'})
+        elif self.path == '/stop':
+            service.stopping.set()
+            service.requests.put(None)
+            self.reply(202, {'stopping': True})
+        else:
+            self.reply(404, {'error': f'unknown endpoint {self.path}'})
+
+    def log_message(self, format, *args):
+        print('Control request:', format % args)
+
+
+if __name__ == "__main__":
+    ETLService().serve()
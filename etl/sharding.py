@@ -0,0 +1,94 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from math import ceil
+
+from utils import load_brands_dict, load_models_dict, load_area_mapper
+from config import Config
+
+MAPPER_LOADERS = {
+    'BRANDS_DICT': load_brands_dict,
+    'MODELS_DICT': load_models_dict,
+    'AREA_MAPPER': load_area_mapper
+}
+""" functions loading Static mappers inside worker processes, by Static attribute name """
+
+
+WORKER_KWARGS = {}
+""" keyword arguments of the mapped function, set once by initializer of every worker process """
+
+
+def init_mapping_worker(mappers, kwargs=None):
+    """
+    Loads Static mappers once when worker process starts, so they are not sent with every shard.
+
+    Args:
+        mappers (list): names of Static mappers used by the mapped function, see MAPPER_LOADERS
+        kwargs (dict): keyword arguments of the mapped function, e.g. models mapper not written to disk
+    """
+    for name in mappers:
+        MAPPER_LOADERS[name]()
+    WORKER_KWARGS.clear()
+    WORKER_KWARGS.update(kwargs or {})
+
+
+def map_shard(func, shard, kwargs=None):
+    """ maps single shard of work items, keyword arguments default to the ones set by the worker initializer """
+    kwargs = WORKER_KWARGS if kwargs is None else kwargs
+    return [func(*item, **kwargs) for item in shard]
+
+
+def shard_map(func, items, mappers=(), kwargs=None, workers=None, min_items=None):
+    """
+    Map work items with module level function, sharded across process pool.
+
+    Args:
+        func (callable): module level function called with unpacked item
+        items (list): tuples of function arguments
+        mappers (list): names of Static mappers loaded by each worker
+        kwargs (dict): keyword arguments passed to func in every call, sent to each worker once
+        workers (int): number of processes, defaults to Config.MAPPING_WORKERS
+        min_items (int): items count below which mapping runs serially, defaults to Config.MAPPING_SERIAL_BELOW
+
+    Returns:
+        list: results in order of items
+    """
+    workers = Config.MAPPING_WORKERS if workers is None else workers
+    min_items = Config.MAPPING_SERIAL_BELOW if min_items is None else min_items
+    if workers <= 1 or len(items) < min_items:
+        return map_shard(func, items, kwargs or {})
+
+    # several shards per worker balance uneven item costs
+    size = ceil(len(items) / (workers * 4))
+    shards = [items[i:i + size] for i in range(0, len(items), size)]
+    # workers do not inherit state or locks of threads running in the caller, e.g. background loaders
+    context = multiprocessing.get_context(Config.MAPPING_START_METHOD)
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=init_mapping_worker,
+                             initargs=(list(mappers), kwargs)) as pool:
+        # map keeps order of shards regardless of which worker finishes first
+        results = pool.map(map_shard, [func] * len(shards), shards)
+        return [result for shard in results for result in shard]
+
+
+def map_distinct(data, columns, func, result, mappers=(), kwargs=None, workers=None):
+    """
+    Map distinct combinations of columns once and merge results back to all rows.
+
+    Args:
+        data (DataFrame): mapped data
+        columns (list): columns passed to func as arguments, in order
+        func (callable): module level function mapping single combination
+        result (str): name of result column
+        mappers (list): names of Static mappers used by func
+        kwargs (dict): keyword arguments passed to func in every call
+        workers (int): number of processes, defaults to Config.MAPPING_WORKERS
+
+    Returns:
+        DataFrame: data with result column, rows and index unchanged
+    """
+    distinct = data[columns].drop_duplicates()
+    items = list(distinct.itertuples(index=False, name=None))
+    distinct[result] = shard_map(func, items, mappers, kwargs, workers)
+    print(f'{result}: {len(items)} distinct items mapped for {len(data)} rows')
+    mapped = data.merge(distinct, on=columns, how='left')
+    mapped.index = data.index
+    return mapped
@@ -0,0 +1,138 @@
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from time import perf_counter
+
+from config import Config
+
+
+class Stage:
+    """ ETL stage with explicitly declared input and output names """
+
+    def __init__(self, name, func, inputs, outputs, in_process=False):
+        """
+        Args:
+            name (str): stage name
+            func (callable): module level function called with inputs in declared order,
+                returns single value for one output or tuple of values for several outputs
+            inputs (list): names of consumed data
+            outputs (list): names of produced data
+            in_process (bool): if stage has to run in main process, e.g. because it updates Static mappers
+        """
+        self.name = name
+        self.func = func
+        self.inputs = inputs
+        self.outputs = outputs
+        self.in_process = in_process
+
+
+def run_stage(func, args):
+    """ runs stage function and measures its duration, executed inside worker processes """
+    start = perf_counter()
+    result = func(*args)
+    return result, perf_counter() - start
+
+
+def critical_path(stages, timings):
+    """
+    Find the longest chain of dependent stages.
+
+    Args:
+        stages (list): executed stages
+        timings (dict): mapping of stage name to duration in seconds
+
+    Returns:
+        tuple: list of stage names on the critical path and its total duration
+    """
+    producers = {output: stage for stage in stages for output in stage.outputs}
+    finish = {}
+    previous = {}
+
+    def resolve(stage):
+        if stage.name not in finish:
+            parents = [producers[name] for name in stage.inputs if name in producers]
+            parent = max(parents, key=resolve, default=None)
+            previous[stage.name] = parent.name if parent is not None else None
+            finish[stage.name] = timings.get(stage.name, 0) + (finish[parent.name] if parent is not None else 0)
+        return finish[stage.name]
+
+    last = max(stages, key=resolve)
+    path = [last.name]
+    while previous[path[-1]] is not None:
+        path.append(previous[path[-1]])
+    return path[::-1], finish[last.name]
+
+
+class StageExecutor:
+    """ runs stages as soon as their inputs are available, independent stages run concurrently in a process pool """
+
+    def __init__(self, stages, workers=None, release=False):
+        """
+        Args:
+            stages (list): executed stages
+            workers (int): number of processes, defaults to Config.STAGE_WORKERS
+            release (bool): if data is dropped as soon as no remaining stage consumes it, so frames owned
+                by the run are freed before later stages finish
+        """
+        self.stages = stages
+        self.workers = Config.STAGE_WORKERS if workers is None else workers
+        self.release = release
+        self.timings = {}
+
+    def run(self, data, on_output=None):
+        """
+        Execute all stages.
+
+        Args:
+            data (dict): initially available data by name, updated in place with stage outputs
+            on_output (callable): called with (name, value) as soon as an output is produced
+
+        Returns:
+            dict: data with all stage outputs, without released data
+        """
+        start = perf_counter()
+        pending = list(self.stages)
+        running = {}
+        pool = ProcessPoolExecutor(max_workers=self.workers) if self.workers > 1 else None
+
+        def finish(stage, result, seconds):
+            values = result if len(stage.outputs) > 1 else (result, )
+            for name, value in zip(stage.outputs, values):
+                data[name] = value
+                if on_output is not None:
+                    on_output(name, value)
+            self.timings[stage.name] = seconds
+            print(f'Stage {stage.name} finished in {seconds:.1f}s')
+            if self.release:
+                consumers = pending + list(running.values())
+                for name in stage.inputs:
+                    if name in data and not any(name in other.inputs for other in consumers):
+                        del data[name]
+
+        try:
+            while pending or running:
+                ready = [stage for stage in pending if all(name in data for name in stage.inputs)]
+                if not ready and not running:
+                    missing = {name for stage in pending for name in stage.inputs if name not in data}
+                    raise ValueError(f"stages {[stage.name for stage in pending]} have unavailable inputs {missing}")
+
+                for stage in ready:
+                    pending.remove(stage)
+                    args = [data[name] for name in stage.inputs]
+                    if pool is None or stage.in_process:
+                        finish(stage, *run_stage(stage.func, args))
+                    else:
+                        running[pool.submit(run_stage, stage.func, args)] = stage
+                    del args
+
+                if running and not any(all(name in data for name in stage.inputs) for stage in pending):
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        finish(running.pop(future), *future.result())
+        finally:
+            if pool is not None:
+                pool.shutdown(cancel_futures=True)
+
+        path, path_seconds = critical_path(self.stages, self.timings)
+        print(f'Stages finished in {perf_counter() - start:.1f}s, '
+              f'sum of stage times {sum(self.timings.values()):.1f}s, '
+              f'critical path {" -> ".join(path)} ({path_seconds:.1f}s)')
+        return data
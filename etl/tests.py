@@ -1,20 +1,56 @@
+import importlib.util
+import io
+import json
+import os
+import re
+import sqlite3
+import tempfile
+import threading
 import unittest
+from datetime import datetime, timedelta
+from difflib import get_close_matches
+from unittest.mock import MagicMock, patch
+from urllib.request import urlopen, Request
 
 import pandas as pd
+import requests_cache
 
-from utils import soda_montgomery_request, Static, fnv1a_hash_16_digit
+from utils import soda_montgomery_request, soda_montgomery_query, soda_montgomery_count, Static, fnv1a_hash_16_digit, sample_mask, \
+    read_fueleconomy_vehicles, refresh_models_mapper, window_where_clause
 from location import generate_location_area_dim
-from weather import extract_weather_data, transform_weather_fact
+from weather import extract_weather_data, transform_weather_fact, assign_weather_cells, fetch_cell_weather
 from datehour import generate_date_hour_dim
-from insertion import load_data_to_dwh, check_last_update
-from crashes import crashes_pipeline, map_location
-from drivers import map_models, map_makes
+from insertion import ConnectionPool, load_data_to_dwh, upsert_data_to_dwh, add_row_hash, replace_partitions_in_dwh, \
+    check_last_update, check_watermarks, fetch_table_keys, migrate_dwh, write_in_batches, LoadStats, SQLiteBackend, \
+    get_backend, WATERMARK_COLUMNS
+from crashes import crashes_pipeline, map_location, CRASH_RAW_COLUMNS
+from drivers import map_models, map_makes, drivers_mapping_pipeline, DRIVER_RAW_COLUMNS
+from vehicles import generate_vehicle_key
+from nonmotorists import nonmoto_pipeline, extract_nonmoto_data
+from fuzzy import TrigramIndex
+from output import OutputSink, ParquetSink, read_output
+from integrity import check_referential_integrity
+from weather_store import WeatherStore, find_missing_ranges
+from loader import TableLoader
+from stages import Stage, StageExecutor
+from checkpoint import RunCheckpoint
+from windows import plan_window
+from schema import generate_sqlserver_migration
+from memory import SpilledTable
+from engines import TRANSFORM_ENGINES, engine_functions
+from aggregates import aggregates_pipeline
+from service import ETLService, MapperWatcher
+from mock_services import MockServices, NetworkProfile, synthetic_sources
+from benchmarks import mocked_sources
+from config import Config
+from microbatch import MicroBatchService
+from etl import ETL, etl_pipeline, backfill_pipeline, plan_next_window, transform_stages
 
 
 class TestInsertion(unittest.TestCase):
 
     def test_insert_roaddim(self):
-        roaddim = pd.read_csv("out/RoadDim.csv")
+        roaddim = read_output('RoadDim')
         success = load_data_to_dwh(roaddim, 'RoadDim')
         self.assertTrue(success)
 
@@ -23,12 +59,443 @@ class TestInsertion(unittest.TestCase):
         print(end_date)
 
 
+class TestEmbeddedBackend(unittest.TestCase):
+
+    def load_and_check(self, backend):
+        roaddim = pd.DataFrame({'RoadName': ['GEORGIA AVE', 'UNKNOWN'], 'RouteType': ['Maryland (State)', 'UNKNOWN'],
+                                'RoadKey': [1234, -1]})
+        metadata = pd.DataFrame({'LastUpdate': [pd.Timestamp('2024-01-02 10:00:00')],
+                                 'StartDate': ['2023-12-01 00:00:00'], 'EndDate': ['2023-12-31 23:00:00'],
+                                 'UpdateMessage': [None]})
+        with tempfile.TemporaryDirectory() as directory, \
+                patch.object(Config, 'DWH_BACKEND', backend), \
+                patch.object(Config, 'DWH_PATH', os.path.join(directory, 'dwh.db')):
+            self.assertTrue(load_data_to_dwh(roaddim, 'RoadDim'))
+            pool = ConnectionPool(2)
+            self.assertTrue(load_data_to_dwh(roaddim, 'RoadDim', pool=pool))
+            pool.close()
+            self.assertTrue(load_data_to_dwh(metadata, 'Metadata'))
+
+            keys = fetch_table_keys('RoadDim', ['RoadKey'])
+            self.assertEqual(sorted(keys['RoadKey']), [-1, 1234])
+            self.assertEqual(check_last_update(), datetime(2023, 12, 31, 23))
+
+            # watermarks missing in Metadata fall back to last update time
+            self.assertEqual(check_watermarks()['drivers'], datetime(2024, 1, 1, 10))
+            metadata = metadata.assign(LastUpdate=pd.Timestamp('2024-02-01 10:00:00'),
+                                       IncidentsWatermark=pd.Timestamp('2024-01-30 08:00:00'),
+                                       DriversWatermark=pd.Timestamp('2024-01-31 08:00:00'),
+                                       NonMotoristsWatermark=pd.Timestamp('2024-01-29 08:00:00'))
+            self.assertTrue(load_data_to_dwh(metadata, 'Metadata'))
+            self.assertEqual(check_watermarks(), {'incidents': datetime(2024, 1, 30, 8),
+                                                  'drivers': datetime(2024, 1, 31, 8),
+                                                  'non-motorists': datetime(2024, 1, 29, 8)})
+
+    def upsert_and_check(self, backend):
+        fact = pd.DataFrame({'ReportNumber': ['R1', 'R2'], 'VehicleCrashKey': ['K1', 'K2'], 'SpeedLimit': [25, 35]})
+        corrected = pd.DataFrame({'ReportNumber': ['R1', 'R2', 'R3'], 'VehicleCrashKey': ['K1', 'K2', 'K3'],
+                                  'SpeedLimit': [25, 40, 55]})
+        with tempfile.TemporaryDirectory() as directory, \
+                patch.object(Config, 'DWH_BACKEND', backend), \
+                patch.object(Config, 'DWH_PATH', os.path.join(directory, 'dwh.db')):
+            self.assertTrue(upsert_data_to_dwh(add_row_hash(fact), 'VehicleCrashFact'))
+            self.assertTrue(upsert_data_to_dwh(add_row_hash(corrected), 'VehicleCrashFact'))
+
+            stored = fetch_table_keys('VehicleCrashFact', ['VehicleCrashKey', 'SpeedLimit', 'RowHash'])
+            stored = stored.sort_values('VehicleCrashKey').reset_index(drop=True)
+            self.assertEqual(list(stored['SpeedLimit']), [25, 40, 55])
+            self.assertEqual(list(stored['RowHash']), list(add_row_hash(corrected)['RowHash']))
+
+    def quarantine_and_check(self, backend):
+        roaddim = pd.DataFrame({'RoadName': [f'ROAD {i}' for i in range(10)], 'RouteType': 'County',
+                                'RoadKey': range(10)})
+        # values which cannot be bound as parameters are rejected by the driver
+        roaddim['RoadName'] = roaddim['RoadName'].astype(object)
+        roaddim.at[3, 'RoadName'] = ['malformed']
+        roaddim.at[8, 'RoadName'] = {'malformed': True}
+        with tempfile.TemporaryDirectory() as directory, \
+                patch.object(Config, 'DWH_BACKEND', backend), \
+                patch.object(Config, 'DWH_PATH', os.path.join(directory, 'dwh.db')), \
+                patch.object(Config, 'QUARANTINE_DIR', os.path.join(directory, 'quarantine')), \
+                patch.object(Config, 'LOAD_BATCH_SIZE', 4):
+            stats = load_data_to_dwh(roaddim, 'RoadDim', quarantine=True)
+            self.assertTrue(stats)
+            self.assertEqual((stats.inserted, stats.rejected), (8, 2))
+            keys = fetch_table_keys('RoadDim', ['RoadKey'])
+            self.assertEqual(sorted(keys['RoadKey']), [0, 1, 2, 4, 5, 6, 7, 9])
+            quarantined = pd.read_csv(stats.quarantine_path)
+            self.assertEqual(list(quarantined['RoadKey']), [3, 8])
+            self.assertTrue(quarantined['QuarantineError'].notna().all())
+
+            # table fails once rejected rows exceed the limit
+            with patch.object(Config, 'QUARANTINE_MAX_ROWS', 1):
+                self.assertFalse(load_data_to_dwh(roaddim.assign(RoadKey=range(10, 20)), 'RoadDim'))
+            # batches committed before the load failed are kept, whole table is rolled back in single transaction mode
+            self.assertFalse(load_data_to_dwh(roaddim.assign(RoadKey=range(20, 30)), 'RoadDim', quarantine=False))
+            self.assertEqual(fetch_table_keys('RoadDim', ['RoadKey'])['RoadKey'].max(), 17)
+
+    def test_dwh_errors_not_quarantined(self):
+        table = pd.DataFrame({'RoadKey': range(8)})
+        conn = MagicMock()
+        stats = LoadStats('RoadDim', len(table))
+        write = MagicMock(side_effect=sqlite3.OperationalError('disk I/O error'))
+        with patch('builtins.print'):
+            self.assertEqual(write_in_batches(SQLiteBackend(), conn, table, write, stats, batch_size=4), (0, False))
+            self.assertEqual((write.call_count, stats.rejected), (1, 0))
+
+            # rollback on a dead connection aborts the load instead of raising
+            conn.rollback.side_effect = sqlite3.OperationalError('connection lost')
+            write = MagicMock(side_effect=sqlite3.IntegrityError('UNIQUE constraint failed'))
+            self.assertEqual(write_in_batches(SQLiteBackend(), conn, table, write, stats, batch_size=4), (0, False))
+        self.assertEqual((write.call_count, stats.rejected), (1, 0))
+
+    def test_dropped_connection_replaced(self):
+        with tempfile.TemporaryDirectory() as directory, \
+                patch.object(Config, 'DWH_BACKEND', 'sqlite'), \
+                patch.object(Config, 'DWH_PATH', os.path.join(directory, 'dwh.db')), patch('builtins.print'):
+            pool = ConnectionPool(1)
+            with pool.connection() as conn:
+                dropped = conn
+            # connection closed by the server while idle in the pool
+            dropped.close()
+            with pool.connection() as conn:
+                self.assertIsNot(conn, dropped)
+                self.assertTrue(pool.backend.is_alive(conn))
+            self.assertTrue(load_data_to_dwh(pd.DataFrame({'RoadName': ['A'], 'RouteType': ['County'],
+                                                           'RoadKey': [1]}), 'RoadDim', pool=pool))
+            pool.close()
+
+    def test_sqlite(self):
+        self.load_and_check('sqlite')
+        self.upsert_and_check('sqlite')
+        self.quarantine_and_check('sqlite')
+
+    @unittest.skipUnless(importlib.util.find_spec('duckdb'), 'duckdb not installed')
+    def test_duckdb(self):
+        self.load_and_check('duckdb')
+        self.upsert_and_check('duckdb')
+
+
+class TestMigration(unittest.TestCase):
+
+    def test_sqlserver_migration(self):
+        conn = MagicMock()
+        with patch.object(Config, 'DWH_BACKEND', 'sqlserver'), \
+                patch('insertion.SqlServerBackend.connect', return_value=conn), patch('builtins.print'):
+            self.assertTrue(migrate_dwh())
+        executed = [call.args[0] for call in conn.cursor.return_value.execute.call_args_list]
+        self.assertEqual(executed, generate_sqlserver_migration())
+        self.assertEqual(executed[0], "IF COL_LENGTH('VehicleCrashFact', 'RowHash') IS NULL "
+                                      "ALTER TABLE VehicleCrashFact ADD RowHash BIGINT")
+        for table_name in ['CrashDayAreaAgg', 'CrashHourAgg', 'CrashWeatherAgg']:
+            self.assertTrue(any(f'CREATE TABLE {table_name} ' in statement for statement in executed))
+        for column in ['IncidentsWatermark', 'WindowRows', 'QuarantinedRows']:
+            self.assertTrue(any(f'ALTER TABLE Metadata ADD {column} ' in statement for statement in executed))
+        conn.commit.assert_called_once()
+
+        with patch.object(Config, 'DWH_BACKEND', 'sqlite'), patch('insertion.run_on_dwh') as run:
+            self.assertTrue(migrate_dwh())
+        run.assert_not_called()
+
+    def test_row_hash_dtypes(self):
+        fact = pd.DataFrame({'VehicleCrashKey': ['K1', 'K2'], 'SpeedLimit': [25, 40], 'HitRun': [True, False],
+                             'Latitude': [39.15, 39.2]})
+        hashes = list(add_row_hash(fact)['RowHash'])
+        # integers become floats once a value is missing, checkpoints and spills may restore objects
+        self.assertEqual(list(add_row_hash(fact.astype({'SpeedLimit': 'float64'}))['RowHash']), hashes)
+        self.assertEqual(list(add_row_hash(fact.astype(object))['RowHash']), hashes)
+        missing = fact.assign(SpeedLimit=[25, None])
+        self.assertEqual(list(add_row_hash(missing.astype({'SpeedLimit': 'Int64'}))['RowHash']),
+                         list(add_row_hash(missing)['RowHash']))
+        self.assertNotEqual(list(add_row_hash(fact.assign(SpeedLimit=[25, 45]))['RowHash']), hashes)
+
+    def test_migrated_before_watermarks(self):
+        calls = []
+        with patch.object(Config, 'DEBUG', False), patch.object(Config, 'INCREMENTAL_EXTRACT', True), \
+                patch('etl.migrate_dwh', side_effect=lambda pool=None: calls.append('migrate')), \
+                patch('etl.check_watermarks', side_effect=lambda pool=None: calls.append('watermarks')), \
+                patch('builtins.print'):
+            self.assertFalse(etl_pipeline())
+        # failed migration aborts the run before watermarks are read
+        self.assertEqual(calls, ['migrate'])
+
+    def test_upsert_disabled(self):
+        fact = pd.DataFrame({'ReportNumber': ['R1'], 'VehicleCrashKey': ['K1']})
+        with patch.object(Config, 'FACT_UPSERT', False), patch.object(Config, 'DEBUG', False), \
+                patch('etl.load_data_to_dwh', return_value=True) as load, patch('etl.upsert_data_to_dwh') as upsert:
+            self.assertTrue(ETL().load_table(fact, 'VehicleCrashFact'))
+        upsert.assert_not_called()
+        self.assertNotIn('RowHash', load.call_args.args[0].columns)
+
+
+class TestIncrementalExtraction(unittest.TestCase):
+
+    changes = {
+        'incidents': pd.DataFrame({'report_number': ['A1'], 'crash_date_time': ['2023-11-05T10:00:00.000'],
+                                   ':updated_at': ['2024-01-03T12:00:00.000Z']}),
+        'drivers': pd.DataFrame({'report_number': ['B2'], 'crash_date_time': ['2023-12-20T08:00:00.000'],
+                                 ':updated_at': ['2024-01-04T09:30:00.000Z']}),
+        'non-motorists': pd.DataFrame()
+    }
+
+    @staticmethod
+    def related_reports(dataset, report_numbers):
+        return pd.DataFrame({'report_number': report_numbers, 'crash_date_time': '2023-12-20T08:00:00.000',
+                             ':updated_at': '2023-12-21T00:00:00.000Z'})
+
+    def test_extract_changes(self):
+        watermarks = {dataset: datetime(2024, 1, 1) for dataset in self.changes}
+        with patch('etl.soda_montgomery_changes', side_effect=lambda dataset, since: self.changes[dataset]), \
+                patch('etl.soda_montgomery_reports', side_effect=self.related_reports):
+            etl = ETL()
+            etl.extract_changes(watermarks)
+
+        self.assertEqual(sorted(etl.crash_data['report_number']), ['A1', 'B2'])
+        self.assertEqual(sorted(etl.drivers_data['report_number']), ['A1', 'B2'])
+        self.assertEqual(sorted(etl.nonmotorists_data['report_number']), ['A1', 'B2'])
+        self.assertEqual(etl.changed_ranges(), [('2023-11-05 00:00:00', '2023-11-05 23:00:00'),
+                                                ('2023-12-20 00:00:00', '2023-12-20 23:00:00')])
+        self.assertEqual(etl.updated_watermarks(), {'incidents': datetime(2024, 1, 3, 12),
+                                                    'drivers': datetime(2024, 1, 4, 9, 30),
+                                                    'non-motorists': datetime(2024, 1, 1)})
+
+    def test_sampled_changes(self):
+        watermarks = {dataset: datetime(2024, 1, 1) for dataset in self.changes}
+        kept = [report for report in ['A1', 'B2'] if sample_mask(pd.Series([report]), 0.5)[0]]
+        with patch('etl.soda_montgomery_changes', side_effect=lambda dataset, since: self.changes[dataset]), \
+                patch('etl.soda_montgomery_reports', side_effect=self.related_reports):
+            etl = ETL(sample=0.5)
+            etl.extract_changes(watermarks)
+
+        for data in [etl.crash_data, etl.drivers_data, etl.nonmotorists_data]:
+            self.assertEqual(sorted(data['report_number']) if not data.empty else [], kept)
+
+    def test_sampled_run_not_loaded(self):
+        etl = ETL(sample=0.5, dimension_keys={'RoadDim': pd.DataFrame({'RoadKey': []})})
+        etl.drivers_data = pd.DataFrame({'ReportNumber': ['R1'], 'VehicleCrashKey': ['K1']})
+        etl.road_data = pd.DataFrame({'RoadName': ['A'], 'RouteType': ['County'], 'RoadKey': [1]})
+        with tempfile.TemporaryDirectory() as directory, patch.object(Config, 'DEBUG', False), \
+                patch.object(Config, 'AGGREGATES', True), patch.object(Config, 'OUTPUT_DIR', directory), \
+                patch.object(Config, 'OUTPUT_FORMAT', 'csv'), patch('etl.load_data_to_dwh') as load, \
+                patch('etl.upsert_data_to_dwh') as upsert, patch('etl.replace_partitions_in_dwh') as replace, \
+                patch('builtins.print'):
+            results = etl.load_data()
+            etl.remember_keys()
+            saved = read_output('VehicleCrashFact', directory=directory)
+
+        for dwh_load in [load, upsert, replace]:
+            dwh_load.assert_not_called()
+        self.assertTrue(all(results.values()))
+        self.assertNotIn('CrashDayAreaAgg', results)
+        self.assertEqual(list(saved['VehicleCrashKey']), ['K1'])
+        self.assertTrue(etl.dimension_keys['RoadDim'].empty)
+
+    def test_changed_days_extracted(self):
+        watermarks = {dataset: datetime(2024, 1, 1) for dataset in self.changes}
+        with patch('etl.soda_montgomery_changes', side_effect=lambda dataset, since: self.changes[dataset]), \
+                patch('etl.soda_montgomery_reports', side_effect=self.related_reports), \
+                patch('etl.extract_weather_data', return_value=pd.DataFrame()) as weather, \
+                patch.object(ETL, 'fueleconomy_vehicles', return_value=pd.DataFrame()), patch('builtins.print'):
+            etl = ETL()
+            etl.extract_data(None, None, watermarks)
+
+        self.assertEqual([call.kwargs['start_date'] for call in weather.call_args_list],
+                         ['2023-11-05 00:00:00', '2023-12-20 00:00:00'])
+        self.assertEqual(len(etl.datehour_data), 48)
+
+    def test_end_date_not_moved_back(self):
+        def extract(etl, start_date, end_date, watermarks=None, weather_start=None):
+            # late correction of a report from an already loaded month
+            etl.datehour_data = generate_date_hour_dim('2023-11-05 00:00:00', '2023-11-05 23:00:00')
+            etl.source_watermarks = pd.DataFrame({'Dataset': list(WATERMARK_COLUMNS), 'Watermark': datetime(2024, 2, 2)})
+
+        metadata = pd.DataFrame({'LastUpdate': [datetime(2024, 2, 1)], 'StartDate': [datetime(2024, 1, 1)],
+                                 'EndDate': [datetime(2024, 1, 31, 23)], 'UpdateMessage': ['regular update']})
+        with tempfile.TemporaryDirectory() as directory, \
+                patch.object(Config, 'DWH_BACKEND', 'sqlite'), \
+                patch.object(Config, 'DWH_PATH', os.path.join(directory, 'dwh.db')), \
+                patch.object(Config, 'DEBUG', False), patch.object(Config, 'INCREMENTAL_EXTRACT', True), \
+                patch.object(Config, 'AGGREGATES', False), patch.object(ETL, 'extract_data', extract), \
+                patch.object(ETL, 'transform_data'), patch.object(ETL, 'join_data'), patch('builtins.print'):
+            self.assertTrue(load_data_to_dwh(metadata, 'Metadata', skip_duplicates=False))
+            self.assertTrue(etl_pipeline())
+            self.assertEqual(check_last_update(), datetime(2024, 1, 31, 23))
+            self.assertEqual(check_watermarks()['drivers'], datetime(2024, 2, 2))
+
+
+class TestAggregates(unittest.TestCase):
+
+    fact = pd.DataFrame({'ReportNumber': ['R1', 'R1', 'R2', 'R3'], 'VehicleCrashKey': ['K1', 'K2', 'K3', 'K4'],
+                         'DriverAtFault': [True, False, True, False],
+                         'DriverInjurySeverity': ['NO APPARENT INJURY', 'SUSPECTED MINOR INJURY', 'FATAL INJURY',
+                                                  'nan'],
+                         'NonMotoristTotal': [1, 1, 0, 0], 'NonMotoristInjury': [1, 1, 0, 0],
+                         'NonMotoristFatal': [0, 0, 0, 0],
+                         'DateHourKey': [2023120108, 2023120108, 2023120108, 2023120217],
+                         'LocationAreaKey': [11, 11, 11, 22]})
+    weather = pd.DataFrame({'LocationAreaKey': [11, 22], 'DateHourKey': [2023120108, 2023120217],
+                            'Temperature': [4.5, -2.0], 'Precipitation': [0.0, 1.0], 'Snow': [0.0, 0.5]})
+
+    def test_aggregates(self):
+        day_area, hour, weather = aggregates_pipeline(self.fact, self.weather, pd.DataFrame())
+        first = day_area[day_area['DateKey'] == 20231201].iloc[0]
+        self.assertEqual((first['Crashes'], first['Vehicles'], first['InjuredDrivers'], first['FatalDrivers'],
+                          first['AtFaultDrivers'], first['NonMotorists']), (2, 3, 2, 1, 2, 1))
+        self.assertEqual(list(hour['WeekDayNumber']), [4, 5])
+        self.assertEqual(sorted(zip(weather['TemperatureBucket'], weather['PrecipitationBucket'])),
+                         [('0 to 10', 'dry'), ('below 0', 'snow')])
+
+    def test_history_replaced_by_window(self):
+        history = self.fact.assign(DriverAtFault=False)
+        corrected = self.fact[self.fact['ReportNumber'] == 'R2']
+        day_area, _, _ = aggregates_pipeline(corrected, self.weather, history)
+        self.assertEqual(list(day_area['Crashes']), [2, 1])
+        self.assertEqual(list(day_area['AtFaultDrivers']), [1, 0])
+
+    def test_replace_partitions(self):
+        day_area, _, _ = aggregates_pipeline(self.fact, self.weather, pd.DataFrame())
+        corrected, _, _ = aggregates_pipeline(self.fact[self.fact['ReportNumber'] != 'R2'], self.weather,
+                                              pd.DataFrame())
+        with tempfile.TemporaryDirectory() as directory, \
+                patch.object(Config, 'DWH_BACKEND', 'sqlite'), \
+                patch.object(Config, 'DWH_PATH', os.path.join(directory, 'dwh.db')):
+            self.assertTrue(replace_partitions_in_dwh(day_area, 'CrashDayAreaAgg', 'DateKey'))
+            self.assertTrue(replace_partitions_in_dwh(corrected[corrected['DateKey'] == 20231201],
+                                                      'CrashDayAreaAgg', 'DateKey'))
+            stored = fetch_table_keys('CrashDayAreaAgg', ['DateKey', 'Crashes']).sort_values('DateKey')
+        self.assertEqual(list(stored['Crashes']), [1, 1])
+
+
+    def test_batches_of_same_day_kept(self):
+        batches = [self.fact[self.fact['ReportNumber'] == 'R1'],
+                   self.fact[self.fact['ReportNumber'] == 'R2'].assign(DateHourKey=2023120109)]
+        weather = pd.concat([self.weather, self.weather.assign(DateHourKey=2023120109)], ignore_index=True)
+        with tempfile.TemporaryDirectory() as directory, \
+                patch.object(Config, 'DWH_BACKEND', 'sqlite'), \
+                patch.object(Config, 'DWH_PATH', os.path.join(directory, 'dwh.db')), \
+                patch.object(Config, 'DEBUG', False), patch.object(Config, 'AGGREGATES', True), \
+                patch('builtins.print'):
+            pool = ConnectionPool(2)
+            for fact in batches:
+                # hourly micro-batch holds a single hour of the day
+                etl = ETL(pool=pool)
+                etl.drivers_data = fact.reset_index(drop=True)
+                etl.weather_data = weather[weather['DateHourKey'] == fact['DateHourKey'].iloc[0]].assign(
+                    WeatherKey=lambda frame: frame['DateHourKey'] * 100 + frame['LocationAreaKey'])
+                etl.aggregate_data()
+                self.assertTrue(all(etl.load_data().values()))
+            stored = fetch_table_keys('CrashHourAgg', ['DateKey', 'Hour', 'Crashes', 'Vehicles'], pool=pool)
+            weather_agg = fetch_table_keys('CrashWeatherAgg', ['TemperatureBucket', 'Crashes'], pool=pool)
+            pool.close()
+        stored = stored.sort_values('Hour')
+        self.assertEqual(list(stored['Hour']), [8, 9])
+        self.assertEqual(list(stored['Crashes']), [1, 1])
+        self.assertEqual(list(stored['Vehicles']), [2, 1])
+        self.assertEqual(list(weather_agg['TemperatureBucket']), ['0 to 10'])
+        self.assertEqual(list(weather_agg['Crashes']), [2])
+
+class TestService(unittest.TestCase):
+
+    def test_requested_run_reloads_modified_mapper(self):
+        calls = []
+        with tempfile.TemporaryDirectory() as directory:
+            mapper = os.path.join(directory, 'mapper.csv')
+            with open(mapper, 'w') as f:
+                f.write('a')
+            watcher = MapperWatcher({mapper: [lambda: calls.append('reload')]})
+            service = ETLService(interval_hours=0, watcher=watcher,
+                                 pipeline=lambda *args, **kwargs: calls.append((args, kwargs['message'])) or True)
+            host, port = service.start_control(port=0)
+            try:
+                os.utime(mapper, (0, 0))
+                body = json.dumps({'start_date': '2023-12-01 00:00:00', 'end_date': '2023-12-31 23:00:00',
+                                   'message': 'backfill'}).encode()
+                urlopen(Request(f'http://{host}:{port}/run', data=body, method='POST'), timeout=5)
+                self.assertTrue(service.run(**service.requests.get(timeout=5)))
+                status = json.load(urlopen(f'http://{host}:{port}/status', timeout=5))
+            finally:
+                service.stop()
+
+        self.assertEqual(calls, ['reload', (('2023-12-01 00:00:00', '2023-12-31 23:00:00'), 'backfill')])
+        self.assertEqual((status['runs'], status['last_success'], status['state']), (1, True, 'idle'))
+
+
+class TestMockServices(unittest.TestCase):
+
+    def test_extraction_with_injected_failures(self):
+        datasets, vehicles = synthetic_sources('2023-12-01', '2023-12-04', crashes_per_day=5)
+        services = MockServices(datasets, vehicles, profiles={'soda': NetworkProfile(failure_rate=0.3),
+                                                              'openmeteo': NetworkProfile(failure_rate=0.2)},
+                                seed=1)
+        services.start()
+        try:
+            with mocked_sources(services), patch('builtins.print'):
+                frames = {}
+                for mode in [False, True]:
+                    with patch.object(Config, 'SODA_CSV_EXPORT', mode):
+                        frames[mode] = soda_montgomery_request('drivers', '2023-12-02', '2023-12-03')
+                soda = services.source_stats('soda')
+                nonmotorists = extract_nonmoto_data(soda_montgomery_request, '2023-12-01', '2023-12-04',
+                                                    aggregate=True)
+                vehicles_data = read_fueleconomy_vehicles()
+                weather = extract_weather_data(Static.ZIPCODE_GEOMETRY, '2023-12-01', '2023-12-01')
+                openmeteo = services.source_stats('openmeteo')
+        finally:
+            services.stop()
+
+        drivers = datasets['drivers']
+        window = drivers[(drivers['crash_date_time'] >= '2023-12-02') & (drivers['crash_date_time'] < '2023-12-04')]
+        for frame in frames.values():
+            self.assertEqual(sorted(frame['vehicle_id']), sorted(window['vehicle_id']))
+        self.assertGreater(soda['Failures'], 0)
+        self.assertEqual(soda['Retries'], soda['Failures'])
+        pd.testing.assert_frame_equal(nonmotorists, nonmoto_pipeline(datasets['non-motorists']))
+        self.assertEqual(len(vehicles_data), len(vehicles))
+        self.assertGreater(openmeteo['Failures'], 0)
+        self.assertEqual(openmeteo['Retries'], openmeteo['Failures'])
+        self.assertEqual(len(weather), 24 * Static.ZIPCODE_GEOMETRY['LocationAreaKey'].nunique())
+        self.assertEqual(weather['date'].min(), pd.Timestamp('2023-12-01', tz='UTC'))
+
+
 class TestUtils(unittest.TestCase):
 
     def test_soda_request(self):
         df = soda_montgomery_request('incidents', start_date='2023-12-01', end_date='2023-12-31')
         self.assertGreater(len(df), 900)
 
+    def test_soda_csv_export(self):
+        response = MagicMock()
+        response.__enter__.return_value = response
+        response.raw = io.BytesIO(b'report_number,vehicle_year,driver_substance_abuse,:updated_at\n'
+                                  b'MCP1,2015,N/A,2024-01-02T10:00:00.000Z\n'
+                                  b'MCP2,,NONE DETECTED,2024-01-03T10:00:00.000Z\n')
+        client = MagicMock(uri_prefix='https://', domain='portal', timeout=10)
+        client.session.get.return_value = response
+        with patch('utils.get_soda_client', return_value=client), patch.object(Config, 'SODA_CSV_EXPORT', True):
+            df = soda_montgomery_query('drivers', "report_number = 'MCP1'", select='report_number')
+        self.assertEqual(client.session.get.call_args.args[0], 'https://portal/resource/mmzv-x632.csv')
+        self.assertEqual(client.session.get.call_args.kwargs['params']['$select'], 'report_number')
+        self.assertEqual(list(df['vehicle_year'].isna()), [False, True])
+        self.assertEqual(df.loc[0, 'vehicle_year'], '2015')
+        self.assertEqual(df.loc[0, 'driver_substance_abuse'], 'N/A')
+
+    def test_soda_csv_fallback(self):
+        rows = pd.DataFrame({'report_number': ['MCP1'], ':updated_at': ['2024-01-01T00:00:00.000Z']})
+        with patch.object(Config, 'SODA_CSV_EXPORT', True), \
+                patch('utils.read_soda_csv', return_value=rows.drop(columns=[':updated_at'])) as csv, \
+                patch('utils.read_soda_json', return_value=rows) as json_records, patch('builtins.print'):
+            pd.testing.assert_frame_equal(soda_montgomery_query('drivers', "report_number = 'MCP1'"), rows)
+            soda_montgomery_query('drivers', "report_number = 'MCP1'", select='count(*) AS row_count')
+        self.assertEqual(csv.call_count, 2)
+        self.assertEqual(json_records.call_count, 1)
+
+    def test_sample_mask(self):
+        reports = pd.Series([f'MCP{number:08d}' for number in range(2000)])
+        mask = sample_mask(reports, 0.1)
+        self.assertTrue(0.07 < mask.mean() < 0.13)
+        self.assertTrue(mask.equals(sample_mask(reports.sample(frac=1, random_state=1), 0.1).sort_index()))
+        self.assertFalse((mask & ~sample_mask(reports, 0.2)).any())
+
     def test_hash_function(self):
         hash1 = fnv1a_hash_16_digit("ANDERSONAVECounty")
         hash2 = fnv1a_hash_16_digit("ANDERSONAVECounty")
@@ -40,9 +507,14 @@ class TestUtils(unittest.TestCase):
 class TestLocation(unittest.TestCase):
 
     def test_location_generation(self):
-        df = generate_location_area_dim(Static.ZIPCODES)
+        df = generate_location_area_dim(Static.ZIPCODE_GEOMETRY)
         self.assertEqual(len(df), 98)
 
+    def test_location_keys_match_area_mapper(self):
+        keys = Static.ZIPCODE_GEOMETRY['LocationAreaKey']
+        self.assertEqual(list(keys), list(Static.AREA_MAPPER['LocationAreaKey']))
+        self.assertNotIn('geometry', Static.ZIPCODES.columns)
+
 
 class TestCrashes(unittest.TestCase):
 
@@ -63,12 +535,90 @@ class TestCrashes(unittest.TestCase):
 
 class TestWeather(unittest.TestCase):
 
+    def test_weather_keys(self):
+        areas = Static.ZIPCODE_GEOMETRY.head(3)
+        df_raw = pd.DataFrame({
+            'date': pd.to_datetime(['2023-12-01 05:00:00', '2023-12-31 23:00:00', '2024-01-01 00:00:00']),
+            'temperature_2m': [1.0, 2.0, 3.0],
+            'ZIPCODE': areas['ZIPCODE'].values,
+            'LocationAreaKey': areas['LocationAreaKey'].values,
+            'Latitude': areas['CentroidLatitude'].values,
+            'Longitude': areas['CentroidLongitude'].values
+        })
+        df = transform_weather_fact(df_raw)
+        for date_hour_key, area_key, weather_key in zip(df['DateHourKey'], df['LocationAreaKey'], df['WeatherKey']):
+            expected = int(str(date_hour_key)[2:] + str(area_key)[1:6] + str(area_key)[9:14])
+            self.assertEqual(weather_key, expected)
+        self.assertEqual(list(df['DateHourKey']), [2023120105, 2023123123, 2024010100])
+
     def test_weather_generation(self):
-        df_raw = extract_weather_data(Static.ZIPCODES, '2023-12-01 00:00:00', '2023-12-31 23:00:00')
+        df_raw = extract_weather_data(Static.ZIPCODE_GEOMETRY, '2023-12-01 00:00:00', '2023-12-31 23:00:00')
         df = transform_weather_fact(df_raw)
         nulls = len(df[df.isna().any(axis=1)])
         self.assertEqual(nulls, 0)
 
+    def test_weather_cells(self):
+        locations = pd.DataFrame({'ZIPCODE': [20812, 20812, 20850], 'LocationAreaKey': [11, 22, 33],
+                                  'CentroidLatitude': [38.96, 39.04, 39.09],
+                                  'CentroidLongitude': [-77.14, -77.20, -77.06]})
+        cells = assign_weather_cells(locations, resolution=0.25)
+        self.assertEqual(list(cells['WeatherCell']), [0, 0, 1])
+        self.assertEqual(list(cells['CellLatitude']), [39.0, 39.0, 39.0])
+
+        requested = []
+
+        def fetch(openmeteo, cell, start_date, end_date):
+            requested.append((cell['CellLatitude'], cell['CellLongitude']))
+            dates = pd.date_range(start_date, f'{end_date} 23:00:00', freq='h')
+            return pd.DataFrame({'date': dates, 'temperature_2m': cell['CellLongitude']})
+
+        with patch('weather.fetch_cell_weather', fetch), patch.object(Config, 'WEATHER_GRID_RESOLUTION', 0.25), \
+                patch.object(Config, 'WEATHER_STORE', False):
+            df_raw = extract_weather_data(locations, '2023-12-01 00:00:00', '2023-12-02 23:00:00')
+        self.assertEqual(sorted(requested), [(39.0, -77.25), (39.0, -77.0)])
+        self.assertEqual(len(df_raw), 3 * 48)
+        temperatures = df_raw.groupby('LocationAreaKey')['temperature_2m'].first()
+        self.assertEqual(list(temperatures), [-77.25, -77.25, -77.0])
+
+
+    def test_recent_weather_not_cached(self):
+        cell = pd.Series({'CellLatitude': 39.1, 'CellLongitude': -77.2})
+        session = requests_cache.CachedSession(backend='memory')
+        cached = []
+        openmeteo = MagicMock(session=session, weather_api=MagicMock(
+            side_effect=lambda url, params: cached.append(not session.settings.disabled) or []))
+        today = datetime.now().strftime('%Y-%m-%d')
+        with patch('builtins.print'):
+            self.assertIsNone(fetch_cell_weather(openmeteo, cell, '2023-12-01', '2023-12-31'))
+            fetch_cell_weather(openmeteo, cell, (datetime.now() - timedelta(days=7)).strftime('%Y-%m-%d'), today)
+            fetch_cell_weather(openmeteo, cell, '2023-12-01', '2023-12-31')
+        self.assertEqual(cached, [True, False, True])
+
+class TestWeatherStore(unittest.TestCase):
+
+    @staticmethod
+    def hourly_weather(location_key, start_date, end_date):
+        dates = pd.date_range(start_date, end_date, freq='h', tz='UTC')
+        return pd.DataFrame({'date': dates, 'temperature_2m': 1.0, 'ZIPCODE': 20812,
+                             'LocationAreaKey': location_key, 'Latitude': 38.9, 'Longitude': -77.1})
+
+    def test_store_complete_days(self):
+        hourly = pd.concat([self.hourly_weather(1, '2023-12-30 00:00:00', '2024-01-01 23:00:00'),
+                            self.hourly_weather(2, '2023-12-31 00:00:00', '2023-12-31 11:00:00')])
+        with tempfile.TemporaryDirectory() as directory:
+            store = WeatherStore(directory)
+            self.assertEqual(store.write(hourly), 3)
+            stored = store.read('2023-12-31', '2024-01-01')
+        self.assertEqual(len(stored), 48)
+        self.assertEqual(set(stored['LocationAreaKey']), {1})
+
+    def test_missing_ranges(self):
+        stored = pd.DataFrame({'LocationAreaKey': [1, 1], 'Day': ['2023-12-02', '2023-12-03']})
+        locations = pd.DataFrame({'LocationAreaKey': [1, 2]})
+        ranges = find_missing_ranges(stored, locations, '2023-12-01', '2023-12-05')
+        self.assertEqual(ranges, [(0, '2023-12-01', '2023-12-01'), (0, '2023-12-04', '2023-12-05'),
+                                  (1, '2023-12-01', '2023-12-05')])
+
 
 class TestDrivers(unittest.TestCase):
 
@@ -84,6 +634,85 @@ class TestDrivers(unittest.TestCase):
         model = map_models('X3', 'Toyota', 2015)
         self.assertEqual(model, 'Unknown')
 
+    def test_difflib_compatibility(self):
+        with patch.object(Config, 'FUZZY_INDEX', False):
+            expected = [map_makes('oYOTA'), map_models('yrs', 'Toyota', 2015), map_models('X3', 'Toyota', 2015)]
+        for compatible in [True, False]:
+            with patch.object(Config, 'FUZZY_COMPATIBLE', compatible):
+                matched = [map_makes('oYOTA'), map_models('yrs', 'Toyota', 2015), map_models('X3', 'Toyota', 2015)]
+            self.assertEqual(matched, expected)
+
+    def test_trigram_index(self):
+        brands = list(Static.BRANDS_DICT.values())
+        index = TrigramIndex(brands)
+        brands_lower = [brand.lower() for brand in brands]
+        for query in ['mercedes bnz', 'chevy', 'vw', 'lnd rover', 'xyz', 'q']:
+            found = get_close_matches(query, brands_lower, n=1, cutoff=0.5)
+            expected = brands[brands_lower.index(found[0])] if found else None
+            self.assertEqual(index.match(query, cutoff=0.5, compatible=True), expected)
+        self.assertEqual(index.match('TOYOT', cutoff=0.5, compatible=False), 'Toyota')
+
+    def test_sharded_mapping(self):
+        data = pd.DataFrame({'ReportNumber': ['R1', 'R2', 'R3', 'R4', 'R5'],
+                             'VehicleMake': ['TOYOTA', 'oYOTA', 'TOYOTA', 'HONDA', 'TOYOTA'],
+                             'VehicleModel': ['yrs', 'YARIS', 'yrs', 'CIVIC', 'X3'],
+                             'VehicleYear': [2015, 2015, 2015, 2015, 2015]})
+        serial = drivers_mapping_pipeline(data)
+        with patch.object(Config, 'MAPPING_WORKERS', 2), patch.object(Config, 'MAPPING_SERIAL_BELOW', 0):
+            sharded = drivers_mapping_pipeline(data)
+        pd.testing.assert_frame_equal(serial, sharded)
+        self.assertEqual(list(serial['ReportNumber']), ['R1', 'R2', 'R3', 'R4', 'R5'])
+        self.assertEqual(serial.loc[0, 'VehicleKey'], serial.loc[2, 'VehicleKey'])
+
+    def test_mapping_keeps_static_models(self):
+        data = pd.DataFrame({'ReportNumber': ['R1', 'R2'], 'VehicleMake': ['TOYOTA', 'TOYOTA'],
+                             'VehicleModel': ['YARIS', 'NEWMODEL'], 'VehicleYear': [2015, 2015]})
+        models_dict = {**Static.MODELS_DICT, (2015, 'Toyota'): ['NewModel']}
+        static_models = Static.MODELS_DICT
+        serial = drivers_mapping_pipeline(data, models_dict)
+        with patch.object(Config, 'MAPPING_WORKERS', 2), patch.object(Config, 'MAPPING_SERIAL_BELOW', 0):
+            sharded = drivers_mapping_pipeline(data, models_dict)
+        self.assertIs(Static.MODELS_DICT, static_models)
+        pd.testing.assert_frame_equal(serial, sharded)
+        self.assertEqual(serial.loc[1, 'VehicleKey'], generate_vehicle_key('Toyota', 'NewModel', 2015))
+
+
+class TestNonMotorists(unittest.TestCase):
+
+    raw = pd.DataFrame({'report_number': ['MCP2', 'MCP1', 'MCP2', 'MCP3', 'MCP1', 'MCP2'],
+                        'injury_severity': ['FATAL INJURY', 'NO APPARENT INJURY', 'SUSPECTED MINOR INJURY', None,
+                                            'Possible Injury', 'NO  INJURY']})
+
+    def portal(self, dataset, where_clause, select=None, group=None):
+        """ returns raw records, or evaluates SoQL aggregation of them with sqlite """
+        if select is None:
+            return self.raw
+        query = re.sub(r"case\((.+?), 1, true, 0\)", r"CASE WHEN \1 THEN 1 ELSE 0 END", select)
+        with sqlite3.connect(':memory:') as conn:
+            self.raw.to_sql('nonmotorists', conn, index=False)
+            return pd.read_sql(f"select {query} from nonmotorists group by {group}", conn).astype(str)
+
+    def test_portal_aggregation(self):
+        with patch('utils.soda_montgomery_query', side_effect=self.portal) as query:
+            aggregated = extract_nonmoto_data(soda_montgomery_request, '2023-12-01', '2023-12-31', aggregate=True)
+            self.assertEqual(query.call_args.kwargs['group'], 'report_number')
+            raw = extract_nonmoto_data(soda_montgomery_request, '2023-12-01', '2023-12-31', aggregate=False)
+
+        self.assertEqual(len(aggregated), 3)
+        pd.testing.assert_frame_equal(nonmoto_pipeline(aggregated), nonmoto_pipeline(raw))
+        self.assertEqual(list(aggregated['NonMotoristInjury']), [1, 1, 0])
+        self.assertEqual(list(aggregated['NonMotoristFatal']), [0, 1, 0])
+
+    def test_aggregation_fallback(self):
+        def portal(dataset, where_clause, select=None, group=None):
+            if group is not None:
+                raise ConnectionError("query not supported")
+            return self.raw
+
+        with patch('utils.soda_montgomery_query', side_effect=portal):
+            data = extract_nonmoto_data(soda_montgomery_request, '2023-12-01', '2023-12-31', aggregate=True)
+        pd.testing.assert_frame_equal(data, self.raw)
+
 
 class TestDateHour(unittest.TestCase):
 
@@ -91,3 +720,402 @@ class TestDateHour(unittest.TestCase):
         df = generate_date_hour_dim()
         nulls = len(df[df.isna().any(axis=1)])
         self.assertEqual(nulls, 0)
+
+
+class TestOutput(unittest.TestCase):
+
+    def test_parquet_partitioned_append(self):
+        window = generate_date_hour_dim('2023-12-31 00:00:00', '2024-01-01 23:00:00')
+        with tempfile.TemporaryDirectory() as directory:
+            ParquetSink(directory=directory, append=False).write(window, 'DateHourDim')
+            ParquetSink(directory=directory, append=True).write(window, 'DateHourDim')
+            df = read_output('DateHourDim', directory=directory)
+        self.assertEqual(len(df), 2 * len(window))
+        self.assertEqual(list(df.columns), list(window.columns))
+
+    def test_parquet_overwrite(self):
+        window = generate_date_hour_dim('2023-12-31 00:00:00', '2024-01-01 23:00:00')
+        with tempfile.TemporaryDirectory() as directory:
+            ParquetSink(directory=directory, append=False).write(window, 'DateHourDim')
+            ParquetSink(directory=directory, append=False).write(window, 'DateHourDim')
+            df = read_output('DateHourDim', directory=directory)
+        self.assertEqual(len(df), len(window))
+
+    def test_incomplete_sink(self):
+        class WriteOnlySink(OutputSink):
+            def write(self, table, table_name):
+                pass
+
+        with self.assertRaises(TypeError):
+            WriteOnlySink()
+
+
+class TestIntegrity(unittest.TestCase):
+
+    def test_orphaned_keys(self):
+        fact = pd.DataFrame({'VehicleKey': [1, 2, 3, 3], 'RoadKey': [10, 10, 11, 12], 'CrossStreetKey': [10, 13, 13, 13],
+                             'LocationAreaKey': [100, 100, 0, 0], 'DateHourKey': [2023120100] * 4})
+        dimensions = {'VehicleDim': [pd.DataFrame({'VehicleKey': [1, 2]})],
+                      'RoadDim': [pd.DataFrame({'RoadKey': [10, 11]}), pd.DataFrame({'RoadKey': [12]})],
+                      'LocationAreaDim': [pd.DataFrame({'LocationAreaKey': [0, 100]})],
+                      'WeatherFact': [pd.DataFrame({'LocationAreaKey': [100], 'DateHourKey': [2023120100]})],
+                      'DateHourDim': [pd.DataFrame({'DateHourKey': [2023120100]})]}
+        report = check_referential_integrity(fact, dimensions).set_index('ForeignKey')
+        self.assertEqual(report.loc['VehicleKey', 'OrphanRows'], 2)
+        self.assertEqual(report.loc['VehicleKey', 'SampleKeys'], [3])
+        self.assertEqual(report.loc['RoadKey', 'OrphanRows'], 0)
+        self.assertEqual(report.loc['CrossStreetKey', 'OrphanRows'], 3)
+        self.assertEqual(report.loc['WeatherKey', 'OrphanRows'], 2)
+        self.assertEqual(report.loc['WeatherKey', 'SampleKeys'], [(0, 2023120100)])
+        self.assertEqual(report.loc['DateHourKey', 'OrphanRows'], 0)
+
+
+class TestLoader(unittest.TestCase):
+
+    def test_loading_order(self):
+        loaded = []
+
+        def load_table(table, table_name):
+            loaded.append(table_name)
+            return table_name != 'WeatherFact'
+
+        loader = TableLoader(load_table, workers=1)
+        for table_name in ['DateHourDim', 'RoadDim', 'WeatherFact', 'VehicleCrashFact']:
+            loader.submit(pd.DataFrame(), table_name)
+        results = loader.close()
+        self.assertEqual(loaded, ['DateHourDim', 'RoadDim', 'WeatherFact', 'VehicleCrashFact'])
+        self.assertFalse(results['WeatherFact'])
+        self.assertTrue(results['VehicleCrashFact'])
+
+    def test_concurrent_dimensions(self):
+        # both dimensions have to be loading at the same time to pass the barrier
+        barrier = threading.Barrier(2, timeout=5)
+        loaded = []
+
+        def load_table(table, table_name):
+            if table_name != 'VehicleCrashFact':
+                barrier.wait()
+            loaded.append(table_name)
+            return table_name != 'VehicleDim'
+
+        loader = TableLoader(load_table, workers=2,
+                             dependencies={'VehicleCrashFact': ['RoadDim', 'DateHourDim'],
+                                           'WeatherFact': ['VehicleDim']})
+        loader.submit(pd.DataFrame(), 'VehicleCrashFact')
+        for table_name in ['RoadDim', 'DateHourDim']:
+            loader.submit(pd.DataFrame(), table_name)
+        loader.submit(pd.DataFrame(), 'WeatherFact')
+        results = loader.close()
+        self.assertEqual(loaded[-1], 'VehicleCrashFact')
+        self.assertTrue(results['VehicleCrashFact'])
+        self.assertFalse(results['WeatherFact'])
+        self.assertEqual(set(loader.timings), {'RoadDim', 'DateHourDim', 'VehicleCrashFact'})
+
+
+def add(a, b):
+    return a + b
+
+
+def split(a):
+    return a, -a
+
+
+class TestStages(unittest.TestCase):
+
+    def stages(self):
+        return [Stage('sum', add, ['x', 'y'], ['z']),
+                Stage('split', split, ['x'], ['x_pos', 'x_neg']),
+                Stage('total', add, ['z', 'x_neg'], ['total'], in_process=True)]
+
+    def test_serial_execution(self):
+        data = StageExecutor(self.stages(), workers=1).run({'x': 2, 'y': 3})
+        self.assertEqual(data['total'], 3)
+        self.assertEqual(data['x_pos'], 2)
+
+    def test_parallel_execution(self):
+        outputs = []
+        executor = StageExecutor(self.stages(), workers=2)
+        data = executor.run({'x': 2, 'y': 3}, on_output=lambda name, value: outputs.append(name))
+        self.assertEqual(data['total'], 3)
+        self.assertEqual(outputs[-1], 'total')
+        self.assertEqual(set(executor.timings), {'sum', 'split', 'total'})
+
+    def test_missing_input(self):
+        with self.assertRaises(ValueError):
+            StageExecutor(self.stages(), workers=1).run({'x': 2})
+
+    def test_release_consumed(self):
+        data = StageExecutor(self.stages(), workers=1, release=True).run({'x': 2, 'y': 3})
+        self.assertEqual(set(data), {'x_pos', 'total'})
+
+    def test_released_final_tables_kept(self):
+        raw = TestEngines.raw_datasets()
+        etl = ETL()
+        etl.vehicles_data, etl.drivers_data = raw['vehicles'], raw['drivers']
+        etl.crash_data, etl.nonmotorists_data = raw['crashes'], raw['nonmotorists']
+        with patch('etl.refresh_models_mapper', return_value=Static.MODELS_DICT), \
+                patch('etl.transform_weather_fact', return_value=pd.DataFrame()), patch('builtins.print'):
+            etl.transform_data()
+        # vehicles are consumed and released by the models mapper stage
+        self.assertFalse(etl.vehicles_data.empty)
+        self.assertFalse(etl.road_data.empty)
+
+
+class TestMemoryBudget(unittest.TestCase):
+
+    def test_spill_completed_tables(self):
+        datehour = generate_date_hour_dim('2023-12-01 00:00:00', '2023-12-31 23:00:00')
+        with tempfile.TemporaryDirectory() as directory, patch.object(Config, 'MEMORY_BUDGET_MB', 0.01), \
+                patch.object(Config, 'SPILL_DIR', directory):
+            etl = ETL()
+            etl.datehour_data = datehour
+            etl.crash_data = pd.DataFrame({'report_number': ['MCP1'] * 1000})
+            etl.enforce_memory_budget(['extract'])
+            self.assertIsInstance(etl.datehour_data, SpilledTable)
+            self.assertIsInstance(etl.crash_data, pd.DataFrame)
+            self.assertEqual(len(etl.datehour_data), len(datehour))
+            pd.testing.assert_frame_equal(etl.frame('datehour_data'), datehour.reset_index(drop=True))
+            self.assertEqual(etl.window(), ('2023-12-01 00:00:00', '2023-12-31 23:00:00'))
+            etl.release_spilled()
+            self.assertEqual(os.listdir(directory), [])
+
+
+class TestEngines(unittest.TestCase):
+
+    @staticmethod
+    def raw_datasets():
+        values = ['Yes', 'No', 'Unknown', 'N/A', 'nan', '', None, 'Injury Crash']
+        incidents = pd.DataFrame({col: [values[(i + j) % len(values)] for i in range(12)]
+                                  for j, col in enumerate(CRASH_RAW_COLUMNS)})
+        incidents = incidents.assign(report_number=[f'MCP{i % 9}' for i in range(12)],
+                                     crash_date_time=[f'2023-12-{i + 1:02d}T10:00:00.000' for i in range(12)],
+                                     lane_number='1', number_of_lanes=['2', '3'] * 6, latitude='39.1',
+                                     longitude='-77.2', road_name=['GEORGIA AVE', 'nan', 'Unknown', None] * 3,
+                                     cross_street_name=['GEORGIA AVE', 'NAN'] * 6)
+        drivers = pd.DataFrame({col: [values[(i + j) % len(values)] for i in range(12)]
+                                for j, col in enumerate(DRIVER_RAW_COLUMNS)})
+        drivers = drivers.assign(report_number=[f'MCP{i % 5}' for i in range(12)],
+                                 vehicle_id=[f'{i}-AB-{i}' for i in range(12)],
+                                 driver_substance_abuse=['ALCOHOL CONTRIBUTED', ' COMBINED SUBSTANCE PRESENT',
+                                                         'NONE DETECTED', None] * 3,
+                                 vehicle_body_type=['PASSENGER CAR', 'CARGO VAN (OVER 10,000LBS)', 'TRANSIT BUS',
+                                                    'MOPED', 'POLICE VEHICLE/EMERGENCY', None] * 2,
+                                 vehicle_year=['2015', '1800', '2099'] * 4)
+        nonmotorists = pd.DataFrame({'report_number': [f'MCP{i % 4}' for i in range(12)],
+                                     'injury_severity': ['FATAL INJURY', 'NO APPARENT INJURY', 'POSSIBLE INJURY',
+                                                         None] * 3})
+        year = datetime.now().year
+        vehicles = pd.DataFrame({'id': range(8), 'make': ['Toyota'] * 4 + ['Honda'] * 4,
+                                 'baseModel': ['Camry', 'Camry', 'Camry', 'Corolla', 'Civic', 'Civic', None, 'Fit'],
+                                 'model': 'Base', 'year': [year] * 6 + [year - 1] * 2,
+                                 'VClass': ['Midsize Cars', 'Compact Cars', 'Compact Cars', None] * 2,
+                                 'cylinders': [4.0, 6.0, 6.0, None] * 2, 'displ': [2.5, 3.5, 2.5, 1.8] * 2,
+                                 'trany': ['Automatic (S6)', 'Manual 5-spd', 'Automatic (AV)', None] * 2,
+                                 'drive': ['Front-Wheel Drive', '4-Wheel Drive', 'All-Wheel Drive', None] * 2,
+                                 'fuelType1': 'Regular Gasoline', 'city08': [25, 20, 20, 30] * 2,
+                                 'highway08': [35, 30, 30, 38] * 2})
+        return {'crashes': incidents, 'roads': incidents, 'drivers': drivers, 'nonmotorists': nonmotorists,
+                'vehicles': vehicles}
+
+    def test_missing_duckdb(self):
+        with patch('importlib.util.find_spec', return_value=None):
+            with self.assertRaisesRegex(ImportError, 'pip install duckdb'):
+                engine_functions('duckdb')
+            with self.assertRaisesRegex(ImportError, 'pip install duckdb'):
+                get_backend('duckdb')
+            self.assertIs(engine_functions('pandas'), TRANSFORM_ENGINES['pandas'])
+
+    @unittest.skipUnless(importlib.util.find_spec('duckdb'), 'duckdb not installed')
+    def test_duckdb_engine_identical(self):
+        pandas_engine, duckdb_engine = TRANSFORM_ENGINES['pandas'], TRANSFORM_ENGINES['duckdb']
+        outputs = {}
+        for stage, raw in self.raw_datasets().items():
+            outputs[stage] = pandas_engine[stage](raw.copy())
+            pd.testing.assert_frame_equal(duckdb_engine[stage](raw.copy()), outputs[stage])
+        pd.testing.assert_frame_equal(duckdb_engine['fact_join'](outputs['drivers'], outputs['crashes']),
+                                      pandas_engine['fact_join'](outputs['drivers'], outputs['crashes']))
+
+
+class TestWindows(unittest.TestCase):
+
+    @staticmethod
+    def probe(start, end):
+        # 100 rows per hour in December, 10 otherwise
+        hours = pd.date_range(start, end, freq='h')
+        return int(sum(100 if hour.month == 12 else 10 for hour in hours))
+
+    def test_split_window(self):
+        end, rows = plan_window(datetime(2023, 12, 1), limit=datetime(2024, 6, 30, 23), target_rows=20000,
+                                probe=self.probe)
+        self.assertEqual(end, datetime(2023, 12, 7, 23))
+        self.assertEqual(rows, 16800)
+
+    def test_merge_windows(self):
+        end, rows = plan_window(datetime(2024, 1, 1), limit=datetime(2024, 6, 30, 23), target_rows=25000,
+                                probe=self.probe)
+        self.assertEqual(end, datetime(2024, 3, 31, 23))
+        end, _ = plan_window(datetime(2024, 1, 1), limit=datetime(2024, 2, 10, 23), target_rows=25000,
+                             probe=self.probe)
+        self.assertEqual(end, datetime(2024, 2, 10, 23))
+        self.assertIsNone(plan_window(datetime(2024, 3, 1), limit=datetime(2024, 2, 29, 23), probe=self.probe))
+
+    def test_count_probe(self):
+        with patch('utils.soda_montgomery_query', return_value=pd.DataFrame({'row_count': ['1234']})) as query:
+            self.assertEqual(soda_montgomery_count('drivers', '2023-12-01 00:00:00', '2023-12-31 23:00:00'), 1234)
+        self.assertEqual(query.call_args.kwargs['select'], 'count(*) AS row_count')
+
+    def test_split_window_boundary(self):
+        # windows split at a day boundary cover the last day of the first window and nothing twice
+        first = window_where_clause('2023-12-01 00:00:00', '2023-12-07 23:00:00')
+        second = window_where_clause('2023-12-08 00:00:00', '2023-12-14 23:00:00')
+        self.assertEqual(first, "crash_date_time >= '2023-12-01T00:00:00' AND crash_date_time < '2023-12-08T00:00:00'")
+        self.assertEqual(second, "crash_date_time >= '2023-12-08T00:00:00' AND crash_date_time < '2023-12-15T00:00:00'")
+        self.assertEqual(window_where_clause('2023-12-07', '2023-12-07'),
+                         "crash_date_time >= '2023-12-07T00:00:00' AND crash_date_time < '2023-12-08T00:00:00'")
+        with patch('utils.soda_montgomery_query', return_value=pd.DataFrame({'row_count': ['10']})) as query:
+            soda_montgomery_count('drivers', '2023-12-01 00:00:00', '2023-12-07 23:00:00')
+        self.assertEqual(query.call_args.args[1], first)
+
+    def test_backfill_windows(self):
+        windows = []
+
+        def pipeline(start_date, end_date, message=None, window_rows=None):
+            windows.append((start_date, end_date, window_rows))
+            return True
+
+        def planner(start, limit):
+            return plan_window(start, limit, target_rows=25000, probe=self.probe)
+
+        with patch('etl.etl_pipeline', pipeline), patch('etl.plan_window', planner):
+            self.assertTrue(backfill_pipeline('2023-11-01 00:00:00', '2024-01-31 23:00:00'))
+        self.assertEqual([window[:2] for window in windows], [
+            ('2023-11-01 00:00:00', '2023-11-30 23:00:00'), ('2023-12-01 00:00:00', '2023-12-07 23:00:00'),
+            ('2023-12-08 00:00:00', '2023-12-14 23:00:00'), ('2023-12-15 00:00:00', '2023-12-21 23:00:00'),
+            ('2023-12-22 00:00:00', '2023-12-28 23:00:00'), ('2023-12-29 00:00:00', '2024-01-31 23:00:00')])
+        self.assertEqual(windows[-1][2], 14640)
+
+    def test_micro_batch_windows(self):
+        start = datetime(2024, 1, 1, 5)
+        self.assertEqual(plan_next_window(start, datetime(2024, 1, 2, 23), batch_hours=1), ('2024-01-01 05:00:00', None))
+        self.assertEqual(plan_next_window(start, datetime(2024, 1, 1, 20), batch_hours=24),
+                         ('2024-01-01 20:00:00', None))
+        self.assertIsNone(plan_next_window(start, datetime(2024, 1, 1, 4), batch_hours=1))
+
+
+class TestMicroBatch(unittest.TestCase):
+
+    def test_batches_share_warm_resources(self):
+        calls = []
+
+        def pipeline(start_date, end_date, timings=None, **kwargs):
+            calls.append(kwargs)
+            timings.update(extract=0.5, load=0.25, total=1.0)
+            return len(calls) < 3
+
+        service = MicroBatchService(batch_hours=1, watcher=MagicMock(refresh=MagicMock(return_value=[])),
+                                    pipeline=pipeline)
+        with patch('microbatch.check_last_update', return_value=datetime.now() - timedelta(hours=2)), \
+                patch('builtins.print'):
+            self.assertTrue(service.run())
+        service.stop()
+
+        self.assertEqual(len(calls), 3)
+        self.assertEqual({call['batch_hours'] for call in calls}, {1})
+        for name in ['pool', 'dimension_keys', 'source_cache']:
+            self.assertTrue(all(call[name] is calls[0][name] for call in calls))
+        report = service.latency_report()
+        self.assertEqual(list(report['Success']), [True, True, False])
+        self.assertEqual(list(report['LoadSeconds']), [0.25] * 3)
+        self.assertAlmostEqual(report.loc[0, 'LagHours'], 1, places=1)
+
+    def test_only_new_rows_loaded(self):
+        datehour = generate_date_hour_dim('2023-12-01 00:00:00', '2023-12-01 05:00:00')
+        roads = pd.DataFrame({'RoadName': ['A', 'B', 'C'], 'RouteType': 'County', 'RoadKey': [1, 2, 3]})
+        with tempfile.TemporaryDirectory() as directory, \
+                patch.object(Config, 'DWH_BACKEND', 'sqlite'), \
+                patch.object(Config, 'DWH_PATH', os.path.join(directory, 'dwh.db')), \
+                patch('builtins.print'):
+            pool = ConnectionPool(2)
+            self.assertTrue(load_data_to_dwh(datehour.iloc[:4], 'DateHourDim', pool=pool))
+            self.assertTrue(load_data_to_dwh(roads.iloc[:2], 'RoadDim', pool=pool))
+            etl = ETL(pool=pool, dimension_keys={}, source_cache={})
+            new_hours = etl.new_rows(datehour.iloc[2:], 'DateHourDim')
+            new_roads = etl.new_rows(roads, 'RoadDim')
+            pool.close()
+        self.assertEqual(list(new_hours['DateHourKey']), list(datehour['DateHourKey'].iloc[4:]))
+        self.assertEqual(list(new_roads['RoadKey']), [3])
+        self.assertEqual(len(ETL().new_rows(roads, 'RoadDim')), 3)
+
+    def test_batches_run_planned_windows(self):
+        calls = []
+
+        def extract(etl, start_date, end_date, watermarks=None, weather_start=None):
+            calls.append((start_date, end_date, watermarks, weather_start))
+            raise ConnectionError('portal not reachable')
+
+        with patch.object(Config, 'INCREMENTAL_EXTRACT', True), patch.object(Config, 'DWH_MIGRATE', False), \
+                patch('etl.check_watermarks', return_value={'drivers': datetime(2024, 1, 1)}), \
+                patch('etl.check_last_update', return_value=datetime(2024, 1, 1, 4)), \
+                patch.object(ETL, 'extract_data', extract), patch('builtins.print'):
+            self.assertFalse(etl_pipeline(batch_hours=1))
+        self.assertEqual(calls, [('2024-01-01 05:00:00', '2024-01-01 05:00:00', None, '2023-12-27 05:00:00')])
+
+    def test_unarchived_weather_extracted_again(self):
+        weather = pd.DataFrame({'LocationAreaKey': 1, 'temperature_2m': [1.5, None, None],
+                                'date': pd.date_range('2023-12-31 05:00:00', periods=3, freq='h', tz='UTC')})
+        with patch('etl.soda_montgomery_request', return_value=pd.DataFrame()), \
+                patch('etl.extract_nonmoto_data', return_value=pd.DataFrame()), \
+                patch('etl.extract_weather_data', return_value=weather) as extract_weather, \
+                patch.object(ETL, 'fueleconomy_vehicles', return_value=pd.DataFrame()), patch('builtins.print'):
+            etl = ETL()
+            etl.extract_data('2024-01-01 05:00:00', '2024-01-01 05:00:00', weather_start='2023-12-27 05:00:00')
+        self.assertEqual(extract_weather.call_args.kwargs['start_date'], '2023-12-27 05:00:00')
+        self.assertEqual(list(etl.weather_data['temperature_2m']), [1.5])
+        self.assertEqual(len(etl.datehour_data), 1)
+
+    def test_window_without_reports(self):
+        etl = ETL()
+        self.assertFalse(etl.has_reports())
+        self.assertEqual([stage.name for stage in transform_stages(reports=False)], ['vehicles', 'models_mapper', 'weather'])
+        with patch('builtins.print'):
+            etl.join_data()
+            self.assertTrue(etl.check_integrity())
+        self.assertNotIn('VehicleCrashFact', etl.tables())
+
+    def test_sources_and_mappers_reused(self):
+        vehicles = pd.DataFrame({'id': [1], 'make': ['Toyota']})
+        etl = ETL(source_cache={})
+        with patch('etl.read_fueleconomy_vehicles', return_value=vehicles) as download, patch('builtins.print'):
+            etl.fueleconomy_vehicles()
+            pd.testing.assert_frame_equal(ETL(source_cache=etl.source_cache).fueleconomy_vehicles(), vehicles)
+        self.assertEqual(download.call_count, 1)
+
+        (year, make), models = next(iter(Static.MODELS_DICT.items()))
+        models_dict = Static.MODELS_DICT
+        known = pd.DataFrame({'Make': [make], 'Year': [float(year)], 'BaseModel': [models[0]]})
+        with patch('utils.update_models_mapper') as update:
+            self.assertIs(refresh_models_mapper(known), models_dict)
+        update.assert_not_called()
+
+
+class TestCheckpoint(unittest.TestCase):
+
+    def test_resume_phases(self):
+        datehour = generate_date_hour_dim('2023-12-01 00:00:00', '2023-12-01 23:00:00')
+        mixed = pd.DataFrame({'Datetime': [pd.Timestamp('2023-12-01'), '']})
+        with tempfile.TemporaryDirectory() as directory:
+            checkpoint = RunCheckpoint('2023-12-01 00:00:00', '2023-12-01 23:00:00', directory=directory)
+            checkpoint.save_phase('extract', {'datehour_data': datehour, 'crash_data': mixed})
+            checkpoint.mark_loaded('DateHourDim')
+
+            resumed = RunCheckpoint('2023-12-01 00:00:00', '2023-12-01 23:00:00', directory=directory)
+            frames = resumed.load_phase('extract')
+            self.assertEqual(resumed.completed_phases(), ['extract'])
+            self.assertTrue(resumed.is_loaded('DateHourDim'))
+            self.assertFalse(resumed.is_loaded('WeatherFact'))
+            pd.testing.assert_frame_equal(frames['datehour_data'], datehour.reset_index(drop=True))
+            pd.testing.assert_frame_equal(frames['crash_data'], mixed)
+
+            resumed.clear()
+            self.assertEqual(RunCheckpoint('2023-12-01 00:00:00', '2023-12-01 23:00:00', directory=directory)
+                             .completed_phases(), [])
@@ -1,3 +1,6 @@
+from functools import lru_cache
+
+from requests.adapters import HTTPAdapter
 from sodapy import Socrata
 import pandas as pd
 import geopandas as gpd
@@ -42,6 +45,21 @@ def update_models_mapper(vehicles_agg):
     print('Models mapper updated')
 
 
+def refresh_models_mapper(vehicles):
+    """
+    updates models mapper with transformed vehicles data and reloads it, returns loaded models dictionary,
+    loaded mapper and fuzzy indexes built on it are kept if it already contains all models
+    """
+    known = all(model in Static.MODELS_DICT.get((year, make), ())
+                for make, year, model in vehicles[['Make', 'Year', 'BaseModel']].drop_duplicates().itertuples(
+                    index=False, name=None))
+    if known:
+        return Static.MODELS_DICT
+    update_models_mapper(vehicles[['Make', 'Year', 'BaseModel']])
+    load_models_dict()
+    return Static.MODELS_DICT
+
+
 def load_area_mapper(return_=False):
     area_mapper = pd.read_csv("static/area_mapper.csv")
     area_mapper['Geometry'] = area_mapper['Geometry'].apply(load_wkt)
@@ -62,6 +80,46 @@ def load_zipcodes(return_=False):
         Static.ZIPCODES = zipcodes
 
 
+def generate_location_area_key(latitude, longitude):
+    """ generates LocationAreaKey by concatenating first 8 digits of centroid longitude and latitude """
+    longitude_digits = str(longitude).replace('.', '').replace('-', '')[:8]
+    latitude_digits = str(latitude).replace('.', '').replace('-', '')[:8]
+    return int(longitude_digits + latitude_digits)
+
+
+def load_zipcode_geometry(zipcodes=None, return_=False):
+    """
+    Parses zipcode geometries once and computes their centroids and LocationAreaKey.
+
+    Args:
+        zipcodes (DataFrame): zipcodes data with WKT geometries, read from static file if not given
+        return_ (bool): if table is returned instead of being stored in Static
+
+    Returns:
+        DataFrame: zipcode areas with centroid coordinates and LocationAreaKey
+    """
+    if zipcodes is None:
+        zipcodes = pd.read_csv("static/ZIPCODES.csv")
+    centroids = gpd.GeoSeries(zipcodes['the_geom'].apply(load_wkt)).centroid
+    zipcode_geometry = pd.DataFrame({
+        'ZIPCODE': zipcodes['ZIPCODE'],
+        'MAIL_CITY': zipcodes['MAIL_CITY'],
+        'Shape_Leng': zipcodes['Shape_Leng'],
+        'Shape_Area': zipcodes['Shape_Area'],
+        'CentroidLatitude': centroids.y,
+        'CentroidLongitude': centroids.x
+    })
+    zipcode_geometry['LocationAreaKey'] = [
+        generate_location_area_key(lat, long)
+        for lat, long in zip(zipcode_geometry['CentroidLatitude'], zipcode_geometry['CentroidLongitude'])
+    ]
+    print('Zipcode geometry loaded')
+    if return_:
+        return zipcode_geometry
+    else:
+        Static.ZIPCODE_GEOMETRY = zipcode_geometry
+
+
 class Static:
 
     BRANDS_DICT = load_brands_dict(return_=True)
@@ -76,50 +134,198 @@ class Static:
     ZIPCODES = load_zipcodes(return_=True)
     """ zipcodes data """
 
+    ZIPCODE_GEOMETRY = load_zipcode_geometry(ZIPCODES, return_=True)
+    """ zipcode areas with centroid coordinates and precomputed LocationAreaKey """
+
+
+SODA_DATASETS = {'incidents': 'bhju-22kf',
+                 'drivers': 'mmzv-x632',
+                 'non-motorists': 'n7fk-dce5'}
+""" montgomery data portal dataset identifiers """
+
+
+@lru_cache(maxsize=None)
+def get_soda_client():
+    """ returns montgomery data portal client, created once so its http session is reused between requests """
+    session_adapter = None
+    if Config.SODA_URI_PREFIX != 'https://':
+        session_adapter = {'prefix': Config.SODA_URI_PREFIX, 'adapter': HTTPAdapter()}
+    return Socrata(Config.SODA_DOMAIN,
+                   Config.SOTA_TOKEN,
+                   username=Config.SOTA_USER,
+                   password=Config.SOTA_PWD,
+                   session_adapter=session_adapter)
+
+
+def read_fueleconomy_vehicles():
+    """ downloads fueleconomy vehicles file """
+    return pd.read_csv(Config.FUELECONOMY_URL, low_memory=False)
 
-def soda_montgomery_request(dataset, start_date, end_date):
+
+def read_soda_json(dataset, where_clause, select=None, group=None):
+    """ fetches rows matching SoQL filter as JSON records through sodapy, every value is a string """
+    results = get_soda_client().get(SODA_DATASETS[dataset], where=where_clause, select=select, group=group,
+                                     limit=1000000, exclude_system_fields=False)
+    return pd.DataFrame.from_records(results)
+
+
+def read_soda_csv(dataset, where_clause, select=None, group=None):
     """
-    Fetch data from montgomery county data portal for given dataset and date interval
+    Streams CSV export of rows matching SoQL filter straight into the parser, without building
+    JSON records first. Columns are read as strings like JSON values, only empty fields are missing.
+    """
+    client = get_soda_client()
+    url = f"{client.uri_prefix}{client.domain}/resource/{SODA_DATASETS[dataset]}.csv"
+    params = {'$where': where_clause, '$limit': 1000000, '$$exclude_system_fields': 'false'}
+    if select is not None:
+        params['$select'] = select
+    if group is not None:
+        params['$group'] = group
+    with client.session.get(url, params=params, stream=True, timeout=client.timeout) as response:
+        response.raise_for_status()
+        response.raw.decode_content = True
+        return pd.read_csv(response.raw, dtype=str, keep_default_na=False, na_values=[''])
+
+
+def read_soda(dataset, where_clause, select=None, group=None):
+    """
+    fetches rows matching SoQL filter from CSV export if enabled, falls back to JSON records if the export
+    misses ':updated_at' system field needed by incremental extraction
+    """
+    if Config.SODA_CSV_EXPORT:
+        results = read_soda_csv(dataset, where_clause, select, group)
+        if select is not None or ':updated_at' in results.columns:
+            return results
+        print(f"WARNING: CSV export of {dataset} has no ':updated_at' column, falling back to JSON records")
+    return read_soda_json(dataset, where_clause, select, group)
+
+
+def soda_montgomery_query(dataset, where_clause, select=None, group=None):
+    """
+    Fetch rows of montgomery county data portal dataset matching SoQL filter, including system fields
+    such as ':updated_at'
 
     Args:
         dataset (str): type of dataset to pull, available options: 'incidents', 'drivers', 'non-motorists'
-        start_date (str): The start date for data retrieval in "YYYY-MM-DD" format.
-        end_date (str): The end date for the data retrieval in "YYYY-MM-DD" format.
+        where_clause (str): SoQL where clause
+        select (str): SoQL select clause, all columns if None
+        group (str): SoQL group clause, rows are not grouped if None
 
     Returns:
-        DataFrame: A DataFrame containing
+        DataFrame: A DataFrame containing matching rows
     """
-    dataset_keys = {'incidents': 'bhju-22kf',
-                    'drivers': 'mmzv-x632',
-                    'non-motorists': 'n7fk-dce5'}
-    data_key = dataset_keys[dataset]
-
-    client = Socrata("data.montgomerycountymd.gov",
-                     Config.SOTA_TOKEN,
-                     username=Config.SOTA_USER,
-                     password=Config.SOTA_PWD)
-
-    start_date = start_date.split(' ')[0]
-    end_date = end_date.split(' ')[0]
-    where_clause = f"crash_date_time >= '{start_date}' AND crash_date_time <= '{end_date}'"
-
     results_df = None
-    e = None
+    error = None
     for _ in range(Config.N_RETRIES):
         try:
-            results = client.get(data_key, where=where_clause, limit=1000000)
-            results_df = pd.DataFrame.from_records(results)
+            results_df = read_soda(dataset, where_clause, select, group)
             break
         except (Exception, ) as e:
             print("Error ocurred, sending another request", e)
+            error = e
             continue
 
     if results_df is None:
-        raise ConnectionError(f"could not get {dataset} from montgomery data portal:", e)
+        raise ConnectionError(f"could not get {dataset} from montgomery data portal:", error)
 
     return results_df
 
 
+def soda_montgomery_request(dataset, start_date, end_date, select=None, group=None):
+    """
+    Fetch data from montgomery county data portal for given dataset and date interval
+
+    Args:
+        dataset (str): type of dataset to pull, available options: 'incidents', 'drivers', 'non-motorists'
+        start_date (str): The start date for data retrieval in "YYYY-MM-DD" format.
+        end_date (str): The end date for the data retrieval in "YYYY-MM-DD" format.
+        select (str): SoQL select clause, all columns if None
+        group (str): SoQL group clause, rows are not grouped if None
+
+    Returns:
+        DataFrame: A DataFrame containing
+    """
+    return soda_montgomery_query(dataset, window_where_clause(start_date, end_date), select=select, group=group)
+
+
+def window_where_clause(start_date, end_date):
+    """
+    returns SoQL filter of crash reports within date interval, the whole end hour is included,
+    or the whole end day if end date has no time
+    """
+    start = pd.Timestamp(start_date)
+    end = pd.Timestamp(end_date) + (pd.Timedelta(hours=1) if ' ' in end_date.strip() else pd.Timedelta(days=1))
+    return f"crash_date_time >= '{start:%Y-%m-%dT%H:%M:%S}' AND crash_date_time < '{end:%Y-%m-%dT%H:%M:%S}'"
+
+
+def soda_montgomery_count(dataset, start_date, end_date):
+    """
+    Count rows of montgomery county data portal dataset within date interval, without downloading them
+
+    Args:
+        dataset (str): type of dataset to count, available options: 'incidents', 'drivers', 'non-motorists'
+        start_date (str): The start date in "YYYY-MM-DD" format.
+        end_date (str): The end date in "YYYY-MM-DD" format.
+
+    Returns:
+        int: number of rows
+    """
+    counted = soda_montgomery_query(dataset, window_where_clause(start_date, end_date), select='count(*) AS row_count')
+    return int(counted['row_count'].iloc[0]) if len(counted) > 0 else 0
+
+
+def soda_montgomery_changes(dataset, updated_since):
+    """
+    Fetch rows of given dataset created or updated on the portal after the watermark
+
+    Args:
+        dataset (str): type of dataset to pull, available options: 'incidents', 'drivers', 'non-motorists'
+        updated_since (datetime): watermark, portal ':updated_at' of the latest row already processed
+
+    Returns:
+        DataFrame: A DataFrame containing changed rows
+    """
+    where_clause = f":updated_at > '{updated_since.strftime('%Y-%m-%dT%H:%M:%S')}'"
+    return soda_montgomery_query(dataset, where_clause)
+
+
+def soda_montgomery_reports(dataset, report_numbers, batch_size=200, select=None, group=None):
+    """
+    Fetch all rows of given dataset belonging to listed crash reports, in batches keeping request urls short
+
+    Args:
+        dataset (str): type of dataset to pull, available options: 'incidents', 'drivers', 'non-motorists'
+        report_numbers (list): report numbers to fetch
+        batch_size (int): number of report numbers per request
+        select (str): SoQL select clause, all columns if None
+        group (str): SoQL group clause, rows are not grouped if None
+
+    Returns:
+        DataFrame: A DataFrame containing rows of given reports
+    """
+    batches = []
+    for i in range(0, len(report_numbers), batch_size):
+        numbers = ", ".join(f"'{number}'" for number in report_numbers[i:i + batch_size])
+        batches.append(soda_montgomery_query(dataset, f"report_number in ({numbers})", select=select, group=group))
+    if not batches:
+        return pd.DataFrame()
+    return pd.concat(batches, ignore_index=True)
+
+
+def sample_mask(report_numbers, fraction):
+    """
+    Select deterministic sample of crash reports, the same reports are selected in every dataset and run.
+
+    Args:
+        report_numbers (Series): report numbers
+        fraction (float): fraction of reports kept, between 0 and 1
+
+    Returns:
+        Series: boolean mask of kept reports
+    """
+    return report_numbers.astype(str).map(lambda number: fnv1a_hash_16_digit(number) % 10000 < fraction * 10000)
+
+
 def fnv1a_hash_16_digit(s: str) -> int:
     """
     FNV-1a Hash Function to hash a string to a 16-digit deterministic integer value.
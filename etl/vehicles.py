@@ -61,30 +61,26 @@ def transform_drivetrain(drive):
 
 
 def generate_blank_models(data):
-    data = data.copy()
-
     if Config.DWH_INITIALIZATION:
         makes = list(data['Make'].unique()) + list(Static.BRANDS_DICT.values())
     else:
         makes = list(data['Make'].unique())
 
     makes_unique = np.unique(makes)
-    for make in makes_unique:
-        row = {'Make': make,
-               'Year': 0,
-               'BaseModel': "Unknown",
-               'VehicleKey': 'Unknown',
-               'BodyClass': 'Unknown',
-               'Cylinders': 0,
-               'Displacement': 0,
-               'Transmission': 'Unknown',
-               'Drivetrain': 'Unknown',
-               'FuelType': 'Unknown',
-               'CityMPG': 0,
-               'HighwayMPG': 0}
-        data = pd.concat([data, pd.DataFrame([row])], ignore_index=True)
-
-    return data
+    blanks = pd.DataFrame({'Make': makes_unique,
+                           'Year': 0,
+                           'BaseModel': "Unknown",
+                           'VehicleKey': 'Unknown',
+                           'BodyClass': 'Unknown',
+                           'Cylinders': 0,
+                           'Displacement': 0,
+                           'Transmission': 'Unknown',
+                           'Drivetrain': 'Unknown',
+                           'FuelType': 'Unknown',
+                           'CityMPG': 0,
+                           'HighwayMPG': 0})
+    # single concatenation instead of copying the table once per make
+    return pd.concat([data, blanks], ignore_index=True)
 
 
 def aggregate_models(data):
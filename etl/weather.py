@@ -1,107 +1,212 @@
+from contextlib import nullcontext
+from functools import lru_cache
+
 import pandas as pd
 import numpy as np
-from shapely.wkt import loads as load_wkt
-import geopandas as gpd
 import openmeteo_requests
 import requests_cache
 from retry_requests import retry
 
+from weather_store import WeatherStore, find_missing_ranges
+from config import Config
+
 
-def extract_weather_data(zipcodes, start_date="2023-12-01 00:00:00", end_date="2023-12-31 23:00:00"):
+@lru_cache(maxsize=None)
+def get_openmeteo_client():
+    """ returns Open-Meteo API client with cache and retry on error, created once and reused between extractions """
+    cache_session = requests_cache.CachedSession('.cache', expire_after=-1)
+    retry_session = retry(cache_session, retries=5, backoff_factor=0.2)
+    return openmeteo_requests.Client(session=retry_session)
+
+
+def cache_bypassed(openmeteo, end_date):
+    """
+    returns context disabling http cache of the client for ranges ending within Config.WEATHER_ARCHIVE_LAG_DAYS
+    of today, Open-Meteo fills their hours later and cached responses would keep them missing
     """
-    Extract a weather DataFrame for given ZIP codes within a specified date range.
+    recent = pd.Timestamp.today().normalize() - pd.Timedelta(days=Config.WEATHER_ARCHIVE_LAG_DAYS)
+    session = getattr(openmeteo, 'session', None)
+    if pd.Timestamp(end_date) >= recent and hasattr(session, 'cache_disabled'):
+        return session.cache_disabled()
+    return nullcontext()
+
+
+def assign_weather_cells(locations, resolution=None):
+    """
+    Snap location centroids to the weather grid, areas in the same cell get identical series from the archive.
 
     Args:
-        zipcodes (DataFrame): A DataFrame containing ZIP codes and their geometries.
+        locations (DataFrame): locations with CentroidLatitude and CentroidLongitude columns
+        resolution (float): grid resolution in degrees, defaults to Config.WEATHER_GRID_RESOLUTION,
+            every location is its own cell if None
+
+    Returns:
+        DataFrame: locations with CellLatitude, CellLongitude and WeatherCell index of distinct cell
+    """
+    resolution = Config.WEATHER_GRID_RESOLUTION if resolution is None else resolution
+    locations = locations.copy()
+    if resolution:
+        # rounded again to avoid floating point noise in coordinates of the same cell
+        locations['CellLatitude'] = np.round(np.round(locations['CentroidLatitude'] / resolution) * resolution, 6)
+        locations['CellLongitude'] = np.round(np.round(locations['CentroidLongitude'] / resolution) * resolution, 6)
+    else:
+        locations['CellLatitude'] = locations['CentroidLatitude']
+        locations['CellLongitude'] = locations['CentroidLongitude']
+    locations['WeatherCell'] = locations.groupby(['CellLatitude', 'CellLongitude'], sort=True).ngroup()
+    return locations
+
+
+def fetch_cell_weather(openmeteo, cell, start_date, end_date):
+    """
+    Fetch hourly weather of a single grid cell from open meteo archive.
+
+    Args:
+        openmeteo (Client): open meteo api client
+        cell (Series): location with CellLatitude and CellLongitude, see assign_weather_cells
         start_date (str): The start date for the weather data retrieval in "YYYY-MM-DD" format.
         end_date (str): The end date for the weather data retrieval in "YYYY-MM-DD" format.
 
     Returns:
-        DataFrame: A DataFrame containing weather data for the specified ZIP codes and date range.
+        DataFrame: hourly weather of the cell, None if request failed
     """
-    # Convert 'the_geom' to geometry and calculate centroids
-    zipcodes['geometry'] = zipcodes['the_geom'].apply(load_wkt)
-    gdf = gpd.GeoDataFrame(zipcodes, geometry='geometry')
-    gdf['centroid'] = gdf['geometry'].centroid
+    url = Config.OPENMETEO_ARCHIVE_URL
+
+    params = {
+        "latitude": cell['CellLatitude'],
+        "longitude": cell['CellLongitude'],
+        "start_date": start_date,
+        "end_date": end_date,
+        "hourly": [
+            "temperature_2m", "relative_humidity_2m", "precipitation", "rain",
+            "snowfall", "windspeed_10m", "winddirection_10m"
+        ],
+        "timezone": "auto"
+    }
+
+    responses = None
+    try:
+        with cache_bypassed(openmeteo, end_date):
+            responses = openmeteo.weather_api(url, params=params)
+        # Process first location
+        response = responses[0]
+
+        # Use indices based on the API documentation
+        hourly = response.Hourly()
+        hourly_temperature_2m = hourly.Variables(0).ValuesAsNumpy()
+        hourly_relative_humidity_2m = hourly.Variables(1).ValuesAsNumpy()
+        hourly_precipitation = hourly.Variables(2).ValuesAsNumpy()
+        hourly_rain = hourly.Variables(3).ValuesAsNumpy()
+        hourly_snowfall = hourly.Variables(4).ValuesAsNumpy()
+        hourly_windspeed_10m = hourly.Variables(5).ValuesAsNumpy()
+        hourly_winddirection_10m = hourly.Variables(6).ValuesAsNumpy()
+
+        utc_offset = response.UtcOffsetSeconds()
+
+        hourly_data = {
+            "date": pd.date_range(
+                start=pd.to_datetime(hourly.Time(), unit="s", utc=True),
+                end=pd.to_datetime(hourly.TimeEnd(), unit="s", utc=True),
+                freq=pd.Timedelta(seconds=hourly.Interval()),
+                inclusive="left"
+            ),
+            "temperature_2m": hourly_temperature_2m,
+            "relative_humidity_2m": hourly_relative_humidity_2m,
+            "precipitation": hourly_precipitation,
+            "rain": hourly_rain,
+            "snowfall": hourly_snowfall,
+            "windspeed_10m": hourly_windspeed_10m,
+            "winddirection_10m": hourly_winddirection_10m
+        }
 
-    gdf['centroid_latitude'] = gdf['centroid'].y
-    gdf['centroid_longitude'] = gdf['centroid'].x
+        hourly_dataframe = pd.DataFrame(data=hourly_data)
+        hourly_dataframe['date'] = hourly_dataframe['date'] + pd.Timedelta(seconds=utc_offset)
 
-    # Extract unique locations
-    unique_locations = gdf[['ZIPCODE', 'centroid_latitude', 'centroid_longitude']].drop_duplicates()
+        return hourly_dataframe
+
+    except Exception as e:
+        print("An error occurred:", e)
+        print("Response content:", responses)
+        return None
+
+
+def fan_out_weather(hourly, members):
+    """
+    Copy hourly series of a cell to every location area snapped to it.
+
+    Args:
+        hourly (DataFrame): hourly weather of a cell, see fetch_cell_weather
+        members (DataFrame): locations of the cell with ZIPCODE, LocationAreaKey and centroid coordinates
+
+    Returns:
+        DataFrame: hourly weather rows of every location area, keyed by LocationAreaKey
+    """
+    members = pd.DataFrame({
+        'ZIPCODE': members['ZIPCODE'].values,
+        'LocationAreaKey': members['LocationAreaKey'].astype(np.int64).values,
+        'Latitude': members['CentroidLatitude'].values,
+        'Longitude': members['CentroidLongitude'].values
+    })
+    return hourly.merge(members, how='cross')
+
+
+def extract_weather_data(zipcodes, start_date="2023-12-01 00:00:00", end_date="2023-12-31 23:00:00", store=None):
+    """
+    Extract a weather DataFrame for given ZIP codes within a specified date range. Days already present
+    in the local weather store are read from it, only missing (location, day) ranges are requested.
+    Locations are snapped to the weather grid and each cell range is requested once for all its areas.
+
+    Args:
+        zipcodes (DataFrame): A DataFrame containing ZIP code areas with centroids and LocationAreaKey,
+            see utils.load_zipcode_geometry.
+        start_date (str): The start date for the weather data retrieval in "YYYY-MM-DD" format.
+        end_date (str): The end date for the weather data retrieval in "YYYY-MM-DD" format.
+        store (WeatherStore): weather store to use, defaults to store in Config.WEATHER_STORE_DIR
+            if Config.WEATHER_STORE is enabled
+
+    Returns:
+        DataFrame: A DataFrame containing weather data for the specified ZIP codes and date range.
+    """
+    # Extract unique locations, ZIPCODE alone is not unique as some zipcodes consist of several areas
+    unique_locations = zipcodes[['ZIPCODE', 'LocationAreaKey', 'CentroidLatitude', 'CentroidLongitude']].drop_duplicates()
+    unique_locations = assign_weather_cells(unique_locations)
 
     start_date = start_date.split(' ')[0]
     end_date = end_date.split(' ')[0]
 
-    # Setup the Open-Meteo API client with cache and retry on error
-    cache_session = requests_cache.CachedSession('.cache', expire_after=-1)
-    retry_session = retry(cache_session, retries=5, backoff_factor=0.2)
-    openmeteo = openmeteo_requests.Client(session=retry_session)
+    if store is None and Config.WEATHER_STORE:
+        store = WeatherStore()
+
+    if store is None:
+        stored = pd.DataFrame()
+        missing_ranges = [(index, start_date, end_date) for index in unique_locations.index]
+    else:
+        stored = store.read(start_date, end_date, unique_locations['LocationAreaKey'])
+        missing_ranges = find_missing_ranges(stored, unique_locations, start_date, end_date)
+        print(f'Weather store: {len(stored)} hourly rows found, {len(missing_ranges)} location ranges missing')
 
-    url = "https://archive-api.open-meteo.com/v1/archive"
+    # areas of the same cell missing the same days share a single request
+    requests = {}
+    for index, range_start, range_end in missing_ranges:
+        cell = unique_locations.at[index, 'WeatherCell']
+        requests.setdefault((cell, range_start, range_end), []).append(index)
+    print(f'Weather: {len(requests)} cell requests needed for {len(missing_ranges)} location ranges')
+
+    openmeteo = get_openmeteo_client()
 
     # List to store all dataframes
     dfs = []
 
-    # Iterate over DataFrame rows
-    for _, row in unique_locations.iterrows():
-        params = {
-            "latitude": row['centroid_latitude'],
-            "longitude": row['centroid_longitude'],
-            "start_date": start_date,
-            "end_date": end_date,
-            "hourly": [
-                "temperature_2m", "relative_humidity_2m", "precipitation", "rain",
-                "snowfall", "windspeed_10m", "winddirection_10m"
-            ],
-            "timezone": "auto"
-        }
+    for (_, range_start, range_end), indices in requests.items():
+        members = unique_locations.loc[indices]
+        hourly_dataframe = fetch_cell_weather(openmeteo, members.iloc[0], range_start, range_end)
+        if hourly_dataframe is not None:
+            dfs.append(fan_out_weather(hourly_dataframe, members))
 
-        try:
-            responses = openmeteo.weather_api(url, params=params)
-            # Process first location
-            response = responses[0]
-
-            # Use indices based on the API documentation
-            hourly = response.Hourly()
-            hourly_temperature_2m = hourly.Variables(0).ValuesAsNumpy()
-            hourly_relative_humidity_2m = hourly.Variables(1).ValuesAsNumpy()
-            hourly_precipitation = hourly.Variables(2).ValuesAsNumpy()
-            hourly_rain = hourly.Variables(3).ValuesAsNumpy()
-            hourly_snowfall = hourly.Variables(4).ValuesAsNumpy()
-            hourly_windspeed_10m = hourly.Variables(5).ValuesAsNumpy()
-            hourly_winddirection_10m = hourly.Variables(6).ValuesAsNumpy()
-
-            utc_offset = response.UtcOffsetSeconds()
-
-            hourly_data = {
-                "date": pd.date_range(
-                    start=pd.to_datetime(hourly.Time(), unit="s", utc=True),
-                    end=pd.to_datetime(hourly.TimeEnd(), unit="s", utc=True),
-                    freq=pd.Timedelta(seconds=hourly.Interval()),
-                    inclusive="left"
-                ),
-                "temperature_2m": hourly_temperature_2m,
-                "relative_humidity_2m": hourly_relative_humidity_2m,
-                "precipitation": hourly_precipitation,
-                "rain": hourly_rain,
-                "snowfall": hourly_snowfall,
-                "windspeed_10m": hourly_windspeed_10m,
-                "winddirection_10m": hourly_winddirection_10m
-            }
-
-            hourly_dataframe = pd.DataFrame(data=hourly_data)
-            hourly_dataframe['ZIPCODE'] = row['ZIPCODE']  # Add ZIP code to the dataframe
-            hourly_dataframe['Latitude'] = row['centroid_latitude']  # Add Latitude to the dataframe
-            hourly_dataframe['Longitude'] = row['centroid_longitude']  # Add Longitude to the dataframe
-
-            hourly_dataframe['date'] = hourly_dataframe['date'] + pd.Timedelta(seconds=utc_offset)
-
-            dfs.append(hourly_dataframe)
-
-        except Exception as e:
-            print("An error occurred:", e)
-            print("Response content:", responses)
+    if store is not None and len(dfs) > 0:
+        store.write(pd.concat(dfs, ignore_index=True))
+
+    if len(stored) > 0:
+        dfs.insert(0, stored.drop(columns=['Day']))
 
     # Concatenate all dataframes
     result = pd.concat(dfs, ignore_index=True)
@@ -119,21 +224,18 @@ def transform_weather_fact(result):
     Returns:
         DataFrame: A DataFrame containing weather facts for the specified ZIP codes and date range.
     """
-    # Generate unique keys
-    result['LocationAreaKey'] = (
-            result['Longitude'].astype(str).str.replace('.', '', regex=False).str.replace('-', '', regex=False).str[
-            :8] +
-            result['Latitude'].astype(str).str.replace('.', '', regex=False).str.replace('-', '', regex=False).str[:8]
-    )
+    # LocationAreaKey is precomputed per area during extraction, only keys of each hour are generated here
     result['LocationAreaKey'] = result['LocationAreaKey'].astype(np.int64)
 
-    result['DateHourKey'] = result['date'].dt.strftime('%Y%m%d%H').astype(np.int64)
+    date = result['date'].dt
+    result['DateHourKey'] = (date.year * 1000000 + date.month * 10000 + date.day * 100 + date.hour).astype(np.int64)
 
+    # yymmddhh followed by digits 2-6 and 10-14 of the 16-digit LocationAreaKey
     result['WeatherKey'] = (
-            result['DateHourKey'].astype(str).str[2:] +
-            result['LocationAreaKey'].astype(str).str[1:6] +
-            result['LocationAreaKey'].astype(str).str[9:14]
-    ).astype(np.int64)
+            result['DateHourKey'] % 10 ** 8 * 10 ** 10 +
+            result['LocationAreaKey'] // 10 ** 10 % 10 ** 5 * 10 ** 5 +
+            result['LocationAreaKey'] // 10 ** 2 % 10 ** 5
+    )
 
     # Prepare the WeatherFact DataFrame
     WeatherFact = result.drop(columns=['date', 'Latitude', 'Longitude', 'ZIPCODE'])
@@ -0,0 +1,94 @@
+import os
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from config import Config
+
+
+class WeatherStore:
+    """
+    Local parquet store of decoded hourly weather, keyed by location area and local day.
+    Archived weather never changes, so only complete days are stored and they are never fetched again.
+    """
+
+    def __init__(self, directory=None):
+        self.directory = Config.WEATHER_STORE_DIR if directory is None else directory
+
+    def read(self, start_day, end_day, location_keys=None):
+        """
+        Read stored hourly weather for given day interval.
+
+        Args:
+            start_day (str): first day in "YYYY-MM-DD" format
+            end_day (str): last day in "YYYY-MM-DD" format
+            location_keys (list): LocationAreaKeys to read, all areas if None
+
+        Returns:
+            DataFrame: hourly weather rows with 'Day' column
+        """
+        if not os.path.isdir(self.directory):
+            return pd.DataFrame()
+
+        months = list(pd.period_range(start_day, end_day, freq='M').strftime('%Y-%m'))
+        filters = [('Month', 'in', months), ('Day', '>=', start_day), ('Day', '<=', end_day)]
+        if location_keys is not None:
+            filters.append(('LocationAreaKey', 'in', list(location_keys)))
+
+        stored = pd.read_parquet(self.directory, filters=filters)
+        stored = stored.drop(columns=['Month'])
+        stored['Day'] = stored['Day'].astype(str)
+        return stored.drop_duplicates(subset=['LocationAreaKey', 'date'], keep='last').reset_index(drop=True)
+
+    def write(self, hourly):
+        """ stores complete days of given hourly weather, returns number of stored (location, day) cells """
+        if len(hourly) == 0:
+            return 0
+
+        hourly = hourly.assign(Day=hourly['date'].dt.strftime('%Y-%m-%d'))
+        cells = hourly.groupby(['LocationAreaKey', 'Day']).agg(
+            Hours=pd.NamedAgg('date', 'count'),
+            Missing=pd.NamedAgg('temperature_2m', lambda x: x.isna().sum())).reset_index()
+        # days not archived yet are returned with missing values, 23 hours are possible on DST change
+        complete = cells[(cells['Hours'] >= 23) & (cells['Missing'] == 0)]
+        hourly = hourly.merge(complete[['LocationAreaKey', 'Day']], on=['LocationAreaKey', 'Day'])
+        if len(hourly) == 0:
+            return 0
+
+        hourly['Month'] = hourly['Day'].str[:7]
+        pq.write_to_dataset(pa.Table.from_pandas(hourly, preserve_index=False), self.directory,
+                            partition_cols=['Month'], compression=Config.OUTPUT_COMPRESSION)
+        return len(complete)
+
+
+def find_missing_ranges(stored, locations, start_day, end_day):
+    """
+    Find contiguous day ranges missing from the store for each location.
+
+    Args:
+        stored (DataFrame): rows read from the store with 'LocationAreaKey' and 'Day' columns
+        locations (DataFrame): locations with 'LocationAreaKey' column
+        start_day (str): first day in "YYYY-MM-DD" format
+        end_day (str): last day in "YYYY-MM-DD" format
+
+    Returns:
+        list: tuples of (location index, first missing day, last missing day)
+    """
+    days = list(pd.date_range(start_day, end_day, freq='D').strftime('%Y-%m-%d'))
+    available = set(zip(stored['LocationAreaKey'], stored['Day'])) if len(stored) > 0 else set()
+
+    missing_ranges = []
+    for index, location_key in zip(locations.index, locations['LocationAreaKey']):
+        range_start = range_end = None
+        for day in days:
+            if (location_key, day) in available:
+                if range_start is not None:
+                    missing_ranges.append((index, range_start, range_end))
+                    range_start = None
+            else:
+                range_start = day if range_start is None else range_start
+                range_end = day
+        if range_start is not None:
+            missing_ranges.append((index, range_start, range_end))
+    return missing_ranges
@@ -0,0 +1,76 @@
+from datetime import datetime, timedelta
+from dateutil.relativedelta import relativedelta
+
+from utils import soda_montgomery_count, Static
+from config import Config
+
+PROBED_DATASETS = ['incidents', 'drivers']
+""" portal datasets counted for candidate windows, non-motorists are too few to matter """
+
+
+def window_hours(start, end):
+    """ returns number of hours of the window, both ends included """
+    return int((end - start) / timedelta(hours=1)) + 1
+
+
+def probe_window_rows(start, end):
+    """
+    Estimate rows extracted for a window from portal row counts and hourly weather of every location area.
+
+    Args:
+        start (datetime): first hour of the window
+        end (datetime): last hour of the window
+
+    Returns:
+        int: estimated number of rows
+    """
+    start_date, end_date = start.strftime("%Y-%m-%d %H:%M:%S"), end.strftime("%Y-%m-%d %H:%M:%S")
+    rows = sum(soda_montgomery_count(dataset, start_date, end_date) for dataset in PROBED_DATASETS)
+    areas = Static.ZIPCODE_GEOMETRY['LocationAreaKey'].nunique()
+    return rows + areas * window_hours(start, end)
+
+
+def plan_window(start, limit=None, target_rows=None, max_months=None, probe=probe_window_rows):
+    """
+    Size window starting at given hour from row count probes. A month long window is halved in whole days
+    while it exceeds the target and extended by whole months while the extended window still fits.
+
+    Args:
+        start (datetime): first hour of the window
+        limit (datetime): last hour a window may cover, end of yesterday if None
+        target_rows (int): target number of rows per window, defaults to Config.WINDOW_TARGET_ROWS
+        max_months (int): maximal number of merged months, defaults to Config.WINDOW_MAX_MONTHS
+        probe (callable): returns estimated rows of window given by its first and last hour
+
+    Returns:
+        tuple: last hour of the window and its estimated rows, None if start is after limit
+    """
+    if limit is None:
+        limit = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(hours=1)
+    target_rows = Config.WINDOW_TARGET_ROWS if target_rows is None else target_rows
+    max_months = Config.WINDOW_MAX_MONTHS if max_months is None else max_months
+    if start > limit:
+        return None
+
+    end = min(start + relativedelta(months=1) - timedelta(hours=1), limit)
+    rows = probe(start, end)
+
+    # split, a single day is never split further
+    split = False
+    while rows > target_rows and window_hours(start, end) > 24:
+        days = window_hours(start, end) // 24
+        end = start + timedelta(days=max(1, days // 2)) - timedelta(hours=1)
+        rows = probe(start, end)
+        split = True
+
+    # merge following months while they fit
+    months = 1
+    while not split and rows <= target_rows and end < limit and months < max_months:
+        extended = min(start + relativedelta(months=months + 1) - timedelta(hours=1), limit)
+        extended_rows = probe(start, extended)
+        if extended_rows > target_rows:
+            break
+        end, rows, months = extended, extended_rows, months + 1
+
+    print(f'Window planned from {start} to {end}, {rows} estimated rows')
+    return end, rows